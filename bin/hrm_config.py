@@ -4,7 +4,11 @@
 
 Usually, the config is located at /etc/hrm.conf and written in shell syntax as
 this file simply gets sourced by the bash init script and other shell based
-tools.
+tools. A different location can be given in the HRM_CONF environment variable.
+
+As tokenizing the file is comparably slow and it rarely ever changes, the
+parsed result is cached in a file only accessible by the current user and
+re-used as long as the modification time and size of the config file match.
 
 This module is not meant to be executed directly and doesn't do anything in
 this case.
@@ -24,10 +28,16 @@ this case.
 # [1]: http://stackoverflow.com/questions/3503719/
 
 
+import json
+import os
 import shlex
 import sys
 
 
+# the location of the config file:
+CONFIG_FILE = os.environ.get('HRM_CONF', '/etc/hrm.conf')
+
+
 def parse_hrm_conf(filename):
     """Assemble a dict from the HRM config file (shell syntax).
 
@@ -83,6 +93,56 @@ def parse_hrm_conf(filename):
     return config
 
 
+def cache_filename(filename):
+    """Assemble the name of the cache file for a config file."""
+    tmpdir = os.environ.get('TMPDIR', '/tmp')
+    key = filename.replace(os.sep, '_')
+    return os.path.join(tmpdir, 'hrm_conf_%s%s.json' % (os.getuid(), key))
+
+
+def load_hrm_conf(filename):
+    """Get the config dict from the cache or by parsing the config file.
+
+    The cache is only used if it belongs to the current user, isn't writable
+    by anyone else and was created from a config file with the same
+    modification time and size, otherwise the file is parsed (and the result
+    stored in the cache for subsequent calls).
+
+    Parameters
+    ==========
+    filename: str  - the filename to parse
+
+    Returns
+    =======
+    config: dict - see parse_hrm_conf()
+    """
+    stat = os.stat(filename)
+    signature = [os.path.abspath(filename), stat.st_mtime, stat.st_size]
+    cache = cache_filename(signature[0])
+    try:
+        with open(cache, 'r') as infile:
+            cstat = os.fstat(infile.fileno())
+            if cstat.st_uid == os.getuid() and not cstat.st_mode & 0o022:
+                cached = json.load(infile)
+                if cached['signature'] == signature:
+                    return dict([(key.encode('utf-8'), val.encode('utf-8'))
+                                 for key, val in cached['config'].items()])
+    except (IOError, OSError, ValueError, KeyError, AttributeError):
+        pass
+    config = parse_hrm_conf(filename)
+    tmpname = '%s.%s' % (cache, os.getpid())
+    try:
+        outfd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(outfd, 'w') as outfile:
+            json.dump({'signature': signature, 'config': config}, outfile)
+        os.rename(tmpname, cache)
+    except (IOError, OSError):
+        # caching is optional, so simply carry on if it fails:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+    return config
+
+
 def check_hrm_conf(config):
     """Check the config dict for required entries."""
     required = ['OMERO_PKG', 'OMERO_HOSTNAME']
@@ -95,5 +155,5 @@ if __name__ == "__main__":
     print __doc__
     sys.exit(1)
 
-CONFIG = parse_hrm_conf('/etc/hrm.conf')
+CONFIG = load_hrm_conf(CONFIG_FILE)
 check_hrm_conf(CONFIG)
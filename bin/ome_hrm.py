@@ -16,8 +16,15 @@ to an OMERO server for listing available images, transferring data, etc.
 
 
 import sys
+import time
+
+# the points in time of the startup phases, see print_startup_timing():
+STARTUP_TIMES = [('start', time.time())]
+
 import hrm_config
 
+STARTUP_TIMES.append(('config', time.time()))
+
 # optionally put EXT_LIB into our PYTHONPATH:
 if 'PYTHON_EXTLIB' in hrm_config.CONFIG:
     sys.path.insert(0, hrm_config.CONFIG['PYTHON_EXTLIB'])
@@ -27,23 +34,33 @@ try:
     import os
     import json
     import re
+    import itertools
+    import shutil
+    import tempfile
+    import threading
 except ImportError as err:
     print "ERROR importing required Python packages:", err
     print "Current PYTHONPATH: ", sys.path
     sys.exit(1)
 
+from ome_hrm_sessions import SessionStore, secure_dir
+from ome_hrm_metrics import Metrics
+import ome_hrm_transfer
+import ome_hrm_thumbs
+
 # try to put OMERO into our PYTHONPATH:
 if 'OMERO_PKG' in hrm_config.CONFIG:
     OMERO_LIB = '%s/lib/python' % hrm_config.CONFIG['OMERO_PKG']
     sys.path.insert(0, OMERO_LIB)
 else:
-    print "Could not find configuration value 'OMERO_PKG', omitting."
-try:
-    from omero.gateway import BlitzGateway
-except ImportError as err:
-    print "ERROR importing the OMERO Python bindings:", err
-    print "Current PYTHONPATH: ", sys.path
-    sys.exit(2)
+    sys.stderr.write("Could not find configuration value 'OMERO_PKG', "
+                     "omitting.\n")
+
+# the OMERO Python bindings are only imported when actually talking to the
+# server, see import_omero():
+BlitzGateway = None
+
+STARTUP_TIMES.append(('imports', time.time()))
 
 # the connection values
 HOST = hrm_config.CONFIG['OMERO_HOSTNAME']
@@ -52,54 +69,647 @@ if 'OMERO_PORT' in hrm_config.CONFIG:
 else:
     PORT = 4064
 
+# directory for persistent data of the connector (session records, etc.):
+if 'OMERO_CONNECTOR_DIR' in hrm_config.CONFIG:
+    CONNECTOR_DIR = hrm_config.CONFIG['OMERO_CONNECTOR_DIR']
+else:
+    CONNECTOR_DIR = os.path.join(tempfile.gettempdir(),
+                                 'hrm_omero_%s' % os.getuid())
+
+# seconds after which a remembered session is not re-used any more (0 means
+# sessions are never re-used but closed after every call):
+if 'OMERO_SESSION_IDLE' in hrm_config.CONFIG:
+    SESSION_IDLE = int(hrm_config.CONFIG['OMERO_SESSION_IDLE'])
+else:
+    SESSION_IDLE = 540
+
+# seconds for which the tree nodes are cached (0 disables the cache) and the
+# maximum number of cached nodes:
+if 'OMERO_TREE_CACHE_TTL' in hrm_config.CONFIG:
+    TREE_CACHE_TTL = int(hrm_config.CONFIG['OMERO_TREE_CACHE_TTL'])
+else:
+    TREE_CACHE_TTL = 300
+if 'OMERO_TREE_CACHE_SIZE' in hrm_config.CONFIG:
+    TREE_CACHE_SIZE = int(hrm_config.CONFIG['OMERO_TREE_CACHE_SIZE'])
+else:
+    TREE_CACHE_SIZE = 10000
+
+# the maximum number of child nodes returned for a single tree node, further
+# ones are available through a "more" node (0 means no limit):
+if 'OMERO_TREE_PAGE_SIZE' in hrm_config.CONFIG:
+    TREE_PAGE_SIZE = int(hrm_config.CONFIG['OMERO_TREE_PAGE_SIZE'])
+else:
+    TREE_PAGE_SIZE = 1000
+
+# the number of rows to request from OMERO at once when listing children:
+QUERY_PAGE_SIZE = 500
+
+# the size up to which the JSON of the child nodes is kept in memory until
+# being printed (larger ones are spooled to a temporary file):
+JSON_SPOOL_SIZE = 4 * 1024 * 1024
+
+# the projection queries to get id, name and owner of all children of an object
+# together with the OMERO class of the children, using the same ordering as
+# BlitzGateway's listProjects() and listChildren() methods (plus the ID to get
+# a stable order for paging through the results):
+CHILDREN_QUERIES = {
+    'Experimenter': (
+        'Project',
+        "select p.id, p.name, o.omeName from Project p "
+        "join p.details.owner o where o.id = :id order by p.id"),
+    'Project': (
+        'Dataset',
+        "select d.id, d.name, o.omeName from ProjectDatasetLink l "
+        "join l.child d join d.details.owner o where l.parent.id = :id "
+        "order by d.name, d.id"),
+    'Dataset': (
+        'Image',
+        "select i.id, i.name, o.omeName from DatasetImageLink l "
+        "join l.child i join i.details.owner o where l.parent.id = :id "
+        "order by i.name, i.id"),
+}
+
+# the projection queries to get all images of a project or dataset together
+# with their filesets and original files (a single row for images without a
+# fileset), used to download complete containers:
+CONTAINER_QUERIES = {
+    'Project': (
+        "select i.id, i.name, fs.id, f.id, f.name from ProjectDatasetLink pl "
+        "join pl.child d join d.imageLinks l join l.child i "
+        "left outer join i.fileset fs left outer join fs.usedFiles u "
+        "left outer join u.originalFile f where pl.parent.id = :id "
+        "order by i.id, f.id"),
+    'Dataset': (
+        "select i.id, i.name, fs.id, f.id, f.name from DatasetImageLink l "
+        "join l.child i left outer join i.fileset fs "
+        "left outer join fs.usedFiles u left outer join u.originalFile f "
+        "where l.parent.id = :id order by i.id, f.id"),
+}
+
+# the query to get the objects of a class created or modified after a given
+# position (the ID of the update event and of the object), across all groups,
+# for the local search index:
+SEARCH_SYNC_QUERY = (
+    "select x.id, x.details.group.id, x.name, o.omeName, "
+    "x.details.updateEvent.id from %s x join x.details.owner o "
+    "where x.details.updateEvent.id > :event or "
+    "(x.details.updateEvent.id = :event and x.id > :id) "
+    "order by x.details.updateEvent.id, x.id")
+
+# the number of rows to request from OMERO at once when updating the index:
+SEARCH_PAGE_SIZE = 5000
+
+# seconds after which the search index is synchronized with OMERO again before
+# searching (0 means it is synchronized for every search):
+if 'OMERO_SEARCH_SYNC_INTERVAL' in hrm_config.CONFIG:
+    SEARCH_SYNC_INTERVAL = int(hrm_config.CONFIG['OMERO_SEARCH_SYNC_INTERVAL'])
+else:
+    SEARCH_SYNC_INTERVAL = 60
+
+# the default number of parallel transfers for batch up-/downloads:
+if 'OMERO_TRANSFER_JOBS' in hrm_config.CONFIG:
+    TRANSFER_JOBS = int(hrm_config.CONFIG['OMERO_TRANSFER_JOBS'])
+else:
+    TRANSFER_JOBS = 4
+
+# the size of the chunks (in bytes) for downloading original files:
+if 'OMERO_CHUNK_SIZE' in hrm_config.CONFIG:
+    CHUNK_SIZE = int(hrm_config.CONFIG['OMERO_CHUNK_SIZE'])
+else:
+    CHUNK_SIZE = ome_hrm_transfer.CHUNK_SIZE
+
+# the number of parallel streams for downloading a single (large) file:
+if 'OMERO_DOWNLOAD_STREAMS' in hrm_config.CONFIG:
+    DOWNLOAD_STREAMS = int(hrm_config.CONFIG['OMERO_DOWNLOAD_STREAMS'])
+else:
+    DOWNLOAD_STREAMS = 1
+
+# the number of transfer jobs run in parallel by the queue worker:
+if 'OMERO_QUEUE_WORKERS' in hrm_config.CONFIG:
+    QUEUE_WORKERS = int(hrm_config.CONFIG['OMERO_QUEUE_WORKERS'])
+else:
+    QUEUE_WORKERS = 2
+
+# the number of attempts for queued transfers before giving up:
+if 'OMERO_QUEUE_ATTEMPTS' in hrm_config.CONFIG:
+    QUEUE_ATTEMPTS = int(hrm_config.CONFIG['OMERO_QUEUE_ATTEMPTS'])
+else:
+    QUEUE_ATTEMPTS = 4
+
+# the delay (in seconds) before retrying a failed queued transfer the first
+# time, doubled for every further attempt:
+if 'OMERO_QUEUE_BACKOFF' in hrm_config.CONFIG:
+    QUEUE_BACKOFF = float(hrm_config.CONFIG['OMERO_QUEUE_BACKOFF'])
+else:
+    QUEUE_BACKOFF = 30
+
+# the maximum number of transfers running at the same time on this machine,
+# shared by all connector processes (0 means no limit):
+if 'OMERO_TRANSFER_SLOTS' in hrm_config.CONFIG:
+    TRANSFER_SLOTS = int(hrm_config.CONFIG['OMERO_TRANSFER_SLOTS'])
+else:
+    TRANSFER_SLOTS = 8
+
+# the maximum total bandwidth (in bytes per second) of all downloads running
+# on this machine (0 means no limit):
+if 'OMERO_TRANSFER_BANDWIDTH' in hrm_config.CONFIG:
+    TRANSFER_BANDWIDTH = int(hrm_config.CONFIG['OMERO_TRANSFER_BANDWIDTH'])
+else:
+    TRANSFER_BANDWIDTH = 0
+
+# the directory of the download cache shared by all users (has to be on the
+# same filesystem as the HRM data for hardlinks to work), None disables it:
+if 'OMERO_DOWNLOAD_CACHE_DIR' in hrm_config.CONFIG:
+    DOWNLOAD_CACHE_DIR = hrm_config.CONFIG['OMERO_DOWNLOAD_CACHE_DIR']
+else:
+    DOWNLOAD_CACHE_DIR = None
+
+# the maximum total size (in bytes) of the files in the download cache:
+if 'OMERO_DOWNLOAD_CACHE_SIZE' in hrm_config.CONFIG:
+    DOWNLOAD_CACHE_SIZE = int(hrm_config.CONFIG['OMERO_DOWNLOAD_CACHE_SIZE'])
+else:
+    DOWNLOAD_CACHE_SIZE = 100 * 1024 * 1024 * 1024
+
+# the transfer mode for importing files in-place, i.e. without copying them
+# into the managed repository of OMERO (e.g. 'ln' or 'ln_s', see the
+# "--transfer" option of "omero import"), None for regular uploads:
+if 'OMERO_IMPORT_TRANSFER' in hrm_config.CONFIG:
+    IMPORT_TRANSFER = hrm_config.CONFIG['OMERO_IMPORT_TRANSFER'] or None
+else:
+    IMPORT_TRANSFER = None
+
+# the location of the managed repository of OMERO, in-place imports are only
+# used for files on the same filesystem:
+if 'OMERO_MANAGED_REPO' in hrm_config.CONFIG:
+    MANAGED_REPO = hrm_config.CONFIG['OMERO_MANAGED_REPO']
+else:
+    MANAGED_REPO = None
+
+# how to deal with files to upload whose content already exists in OMERO:
+# 'off' (import them anyway), 'skip' (don't import them again) or 'link' (link
+# the existing image into the target dataset instead of importing the file):
+if 'OMERO_UPLOAD_DEDUP' in hrm_config.CONFIG:
+    UPLOAD_DEDUP = hrm_config.CONFIG['OMERO_UPLOAD_DEDUP']
+else:
+    UPLOAD_DEDUP = 'off'
+
+# where to look for existing files when uploading: only in the target
+# 'dataset' or in the whole 'group' of the target dataset:
+if 'OMERO_UPLOAD_DEDUP_SCOPE' in hrm_config.CONFIG:
+    UPLOAD_DEDUP_SCOPE = hrm_config.CONFIG['OMERO_UPLOAD_DEDUP_SCOPE']
+else:
+    UPLOAD_DEDUP_SCOPE = 'dataset'
+
+# the maximum number of bytes of pixel data to request at once when exporting
+# images without original files as OME-TIFF:
+if 'OMERO_EXPORT_BUFFER' in hrm_config.CONFIG:
+    EXPORT_BUFFER = int(hrm_config.CONFIG['OMERO_EXPORT_BUFFER'])
+else:
+    EXPORT_BUFFER = 16 * 1024 * 1024
+
+# the maximum total size (in bytes) of the locally cached thumbnails (0
+# disables the cache):
+if 'OMERO_THUMBNAIL_CACHE_SIZE' in hrm_config.CONFIG:
+    THUMBNAIL_CACHE_SIZE = int(hrm_config.CONFIG['OMERO_THUMBNAIL_CACHE_SIZE'])
+else:
+    THUMBNAIL_CACHE_SIZE = 50 * 1024 * 1024
+
+# the file to write the performance metrics to (none are recorded if unset):
+if 'OMERO_METRICS_FILE' in hrm_config.CONFIG:
+    METRICS_FILE = hrm_config.CONFIG['OMERO_METRICS_FILE']
+else:
+    METRICS_FILE = None
+
+# the recorder for the metrics, see ome_hrm_metrics.Metrics:
+METRICS = Metrics(METRICS_FILE)
 
-def omero_login(user, passwd, host, port):
+
+def import_omero():
+    """Import the OMERO Python bindings unless this has been done before.
+
+    Importing them takes a considerable amount of time, so this is deferred
+    until a connection to the OMERO server is actually required.
+    """
+    global BlitzGateway  # pylint: disable=global-statement
+    if BlitzGateway is not None:
+        return
+    try:
+        from omero.gateway import BlitzGateway as gateway
+    except ImportError as err:
+        print "ERROR importing the OMERO Python bindings:", err
+        print "Current PYTHONPATH: ", sys.path
+        sys.exit(2)
+    BlitzGateway = gateway
+    STARTUP_TIMES.append(('omero', time.time()))
+
+
+def startup_phases():
+    """Get the durations of the startup phases of the connector.
+
+    The phases are: loading the HRM config ('config'), importing the required
+    modules ('imports'), parsing the arguments ('arguments'), importing the
+    OMERO Python bindings ('omero') and connecting to the server ('login'),
+    followed by running the requested action ('action').
+
+    Returns
+    =======
+    list(tuple) - (phase, seconds) pairs in the order of the phases
+    """
+    phases = []
+    last = STARTUP_TIMES[0][1]
+    for phase, stamp in STARTUP_TIMES[1:]:
+        phases.append((phase, stamp - last))
+        last = stamp
+    return phases
+
+
+def print_startup_timing():
+    """Print the time spent in the startup phases of the connector to stderr.
+
+    See startup_phases() for the details.
+    """
+    phases = startup_phases()
+    phases.append(('total', sum([seconds for _, seconds in phases])))
+    for phase, seconds in phases:
+        sys.stderr.write("startup timing: %-10s %8.1f ms\n" %
+                         (phase, seconds * 1000))
+
+
+def omero_login(user, passwd, host, port, sessions=None, reuse=True):
     """Establish the connection to an OMERO server.
 
+    If a session store is given, the connection joins the session remembered
+    from a previous login of the same user (with the same password) instead of
+    creating a new one. Only if this fails, a regular login is done and the
+    new session is remembered for subsequent calls (ending the one remembered
+    before, if any).
+
     Parameters
     ==========
     user : str - OMERO user name (e.g. "demo_user_01")
     passwd : str - OMERO user password
     host : str - OMERO server hostname to connect to
     port : int - OMERO server port number (e.g. 4064)
+    sessions : ome_hrm_sessions.SessionStore - (optional) session records
+    reuse : bool - if False, a new session is created even if a valid record
+            exists (e.g. for really checking the credentials)
 
     Returns
     =======
     conn : omero.gateway._BlitzGateway - OMERO connection object
     """
+    import_omero()
+    if sessions is not None and reuse:
+        conn = omero_join(user, passwd, host, port, sessions)
+        if conn is not None:
+            return conn
     conn = BlitzGateway(user, passwd, host=host, port=port, secure=True,
                         useragent="HRM-OMERO.connector")
     conn.connect()
+    if sessions is not None and conn.isConnected():
+        old_uuid = sessions.recorded(user)
+        if old_uuid is not None:
+            # nobody would be able to join it anymore:
+            omero_end_session(host, port, old_uuid)
+        sessions.save(user, passwd, conn.c.getSessionId())
     return conn
 
 
+def omero_join(user, passwd, host, port, sessions):
+    """Join the remembered OMERO session of a user.
+
+    Parameters
+    ==========
+    user : str - OMERO user name (e.g. "demo_user_01")
+    passwd : str - OMERO user password
+    host : str - OMERO server hostname to connect to
+    port : int - OMERO server port number (e.g. 4064)
+    sessions : ome_hrm_sessions.SessionStore - the session records
+
+    Returns
+    =======
+    conn : omero.gateway._BlitzGateway - OMERO connection object joined to the
+    existing session, None if no session is known or joining it failed.
+    """
+    sess_uuid = sessions.lookup(user, passwd)
+    if sess_uuid is None:
+        return None
+    import_omero()
+    conn = BlitzGateway(host=host, port=port, secure=True,
+                        useragent="HRM-OMERO.connector")
+    try:
+        joined = conn.connect(sUuid=sess_uuid) and conn.keepAlive()
+    except Exception:  # pylint: disable=broad-except
+        joined = False
+    if not joined:
+        sessions.remove(user)
+        return None
+    sessions.touch(user)
+    return conn
+
+
+def omero_end_session(host, port, sess_uuid):
+    """Terminate an OMERO session that has been left open, ignoring errors.
+
+    Parameters
+    ==========
+    host : str - OMERO server hostname to connect to
+    port : int - OMERO server port number (e.g. 4064)
+    sess_uuid : str - the UUID of the session
+    """
+    import_omero()
+    conn = BlitzGateway(host=host, port=port, secure=True,
+                        useragent="HRM-OMERO.connector")
+    try:
+        if conn.connect(sUuid=sess_uuid):
+            conn.close()
+    except Exception:  # pylint: disable=broad-except
+        pass
+
+
+def omero_logout(conn, keep_session=False):
+    """Close the connection to the OMERO server.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway - OMERO connection object
+    keep_session : bool - if True, the session on the server is left open so
+                   it can be joined again later, otherwise it is terminated.
+    """
+    try:
+        if keep_session:
+            conn.c.detachOnDestroy()
+            conn.close(hard=False)
+        else:
+            conn.close()
+    except Exception:  # pylint: disable=broad-except
+        pass
+
+
+class MessagePrinter(object):
+
+    """Stand-in for a message list, printing the messages right away."""
+
+    @staticmethod
+    def append(msg):
+        """Print the message."""
+        print(msg)
+
+
 def tree_to_json(obj_tree):
     """Create a JSON object with a given format from a tree."""
     return json.dumps(obj_tree, sort_keys=True,
                       indent=4, separators=(',', ': '))
 
 
-def print_children_json(conn, id_str):
+def open_tree_cache():
+    """Open the shared cache for the tree nodes.
+
+    Returns
+    =======
+    ome_hrm_cache.TreeCache - the cache, None if it is disabled or the
+    connector directory is not usable.
+    """
+    if TREE_CACHE_TTL <= 0 or not secure_dir(CONNECTOR_DIR):
+        return None
+    from ome_hrm_cache import TreeCache
+    return TreeCache(os.path.join(CONNECTOR_DIR, 'tree_cache.sqlite'),
+                     TREE_CACHE_TTL, TREE_CACHE_SIZE)
+
+
+def open_thumbnail_cache():
+    """Open the local cache for the thumbnails.
+
+    Returns
+    =======
+    ome_hrm_thumbs.ThumbnailCache - the cache, None if it is disabled or the
+    cache directory is not usable.
+    """
+    path = os.path.join(CONNECTOR_DIR, 'thumbnails')
+    if (THUMBNAIL_CACHE_SIZE <= 0 or not secure_dir(CONNECTOR_DIR) or
+            not secure_dir(path)):
+        return None
+    return ome_hrm_thumbs.ThumbnailCache(path, THUMBNAIL_CACHE_SIZE)
+
+
+def open_download_cache():
+    """Open the download cache shared by all users.
+
+    Returns
+    =======
+    ome_hrm_filecache.FileCache - the cache, None if it is disabled or the
+    cache directory is not usable.
+    """
+    if (DOWNLOAD_CACHE_DIR is None or DOWNLOAD_CACHE_SIZE <= 0 or
+            not secure_dir(DOWNLOAD_CACHE_DIR)):
+        return None
+    from ome_hrm_filecache import FileCache
+    return FileCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_SIZE)
+
+
+def open_transfer_queue():
+    """Open the queue of the background transfers.
+
+    Returns
+    =======
+    ome_hrm_queue.TransferQueue - the queue, None if the connector directory
+    is not usable.
+    """
+    if not secure_dir(CONNECTOR_DIR):
+        return None
+    from ome_hrm_queue import TransferQueue
+    return TransferQueue(os.path.join(CONNECTOR_DIR, 'transfer_queue.sqlite'),
+                         QUEUE_ATTEMPTS, QUEUE_BACKOFF)
+
+
+def open_search_index():
+    """Open the local search index of the OMERO objects.
+
+    Returns
+    =======
+    ome_hrm_search.SearchIndex - the index, None if the connector directory is
+    not usable.
+    """
+    if not secure_dir(CONNECTOR_DIR):
+        return None
+    from ome_hrm_search import SearchIndex
+    return SearchIndex(os.path.join(CONNECTOR_DIR, 'search_index.sqlite'))
+
+
+def open_events(args):
+    """Set up the stream of transfer events if requested by the arguments.
+
+    In this case, stdout is reserved for the events and everything else that
+    is printed (including the messages of the transfers) goes to stderr, see
+    ome_hrm_events. Within the daemon (see ome_hrm_daemon.py), only the
+    output of the current request is redirected, as the stdout of the
+    process is shared by all of them.
+
+    Returns
+    =======
+    ome_hrm_events.EventStream - the stream, None if no events are requested
+    """
+    if not args.events:
+        return None
+    from ome_hrm_events import EventStream, redirect_stdout
+    if hasattr(sys.stdout, 'reserve'):
+        return EventStream(sys.stdout.reserve(sys.stderr))
+    return EventStream(redirect_stdout())
+
+
+def open_transfer_governor():
+    """Open the governor limiting the concurrent transfers on this machine.
+
+    Returns
+    =======
+    ome_hrm_governor.TransferGovernor - the governor, None if there is no
+    limit or the connector directory is not usable.
+    """
+    path = os.path.join(CONNECTOR_DIR, 'transfer_slots')
+    if (TRANSFER_SLOTS <= 0 or not secure_dir(CONNECTOR_DIR) or
+            not secure_dir(path)):
+        return None
+    from ome_hrm_governor import TransferGovernor
+    return TransferGovernor(path, TRANSFER_SLOTS, TRANSFER_BANDWIDTH)
+
+
+def acquire_transfer_slot(governor, conn, item, fname, events=None):
+    """Wait for a free slot of the transfer governor.
+
+    Waiting is reported right away (so it is visible while the transfer is
+    pending), as a 'waiting' event if events are requested and on stderr
+    otherwise, and in the messages of the transfer item once it is over.
+
+    Parameters
+    ==========
+    governor : ome_hrm_governor.TransferGovernor
+    conn : omero.gateway.BlitzGateway - the connection of the user
+    item : dict - the transfer item, see new_transfer_item()
+    fname : str - the local file of the transfer
+    events : ome_hrm_events.EventStream - (optional) the stream to report
+             waiting to
+
+    Returns
+    =======
+    ome_hrm_governor.TransferSlot - the slot, to be released after the transfer
+    """
+    def waiting(active, slots):
+        """Report that the transfer has to wait."""
+        if events is not None:
+            events.waiting(item, fname, active, slots)
+            return
+        sys.stderr.write("%s: waiting for a free transfer slot (%d of %d in "
+                         "use)...\n" % (item['id'], active, slots))
+        sys.stderr.flush()
+
+    with METRICS.phase('transfer_slot'):
+        slot = governor.acquire(conn.getUserId(), waiting)
+    if slot.waited >= 1:
+        item['messages'].append("Waited %.0f s for a free transfer slot." %
+                                slot.waited)
+    return slot
+
+
+def print_children_json(conn, id_str, cache=None, user=None,
+                        limit=TREE_PAGE_SIZE, refresh=False):
     """Print the child nodes of the given ID in JSON format.
 
+    The nodes are written as compact JSON while they are being retrieved from
+    OMERO, so neither the complete list nor its serialization have to be held
+    in memory for nodes having lots of children. The JSON is spooled to a
+    temporary file (if exceeding JSON_SPOOL_SIZE) and printed only once all
+    nodes have been retrieved, so a failure never leaves incomplete JSON
+    behind, but only the error message (and an exit status indicating it).
+
     Parameters
     ==========
     conn : omero.gateway._BlitzGateway
-    id_str : str - OMERO object ID string (e.g. "G:23:Image:42")
+    id_str : str - OMERO object ID string (e.g. "G:23:Image:42"), optionally
+             with the offset of the first child to print (e.g. "G:23:Dataset:
+             42:1000", see iter_children())
+    cache : ome_hrm_cache.TreeCache - (optional) the cache to use for the nodes
+    user : str - the OMERO user name (required when using the cache)
+    limit : int - the maximum number of children to print (None or 0 for all)
+    refresh : bool - ignore the cached nodes (if any), but update the cache
+              with the ones retrieved from OMERO
 
     Returns
     =======
     bool - True in case printing the nodes was successful, False otherwise.
     """
+    # only pages of the default size are shared through the cache:
+    if limit != TREE_PAGE_SIZE:
+        cache = None
+    children = None
+    if cache is not None and not refresh:
+        children = cache.get(user, id_str)
+    if children is not None:
+        write_json_list(children)
+        return True
+    collected = None
+    if cache is not None:
+        collected = []
+    spool = tempfile.SpooledTemporaryFile(JSON_SPOOL_SIZE)
     try:
-        children = gen_children(conn, id_str)
+        write_json_list(iter_children(conn, id_str, limit), collected, spool)
     except:
         print "ERROR generating OMERO tree / node!"
         return False
-    print tree_to_json(children)
+    spool.seek(0)
+    shutil.copyfileobj(spool, sys.stdout)
+    sys.stdout.flush()
+    spool.close()
+    if cache is not None:
+        cache.put(user, id_str, collected)
     return True
 
 
+def write_json_list(items, collected=None, outfile=None):
+    """Incrementally write a list of dicts as compact JSON.
+
+    Nothing at all is written before the first item is available, so errors
+    occuring right at the start don't leave any partial output behind.
+
+    Parameters
+    ==========
+    items : iterable(dict) - the items to write
+    collected : list - (optional) gets all written items appended
+    outfile : file - the file to write to, defaults to sys.stdout
+    """
+    if outfile is None:
+        outfile = sys.stdout
+    buf = []
+    buf_size = 0
+    sep = '['
+    nodes = 0
+    # the time spent encoding and writing, excluding producing the items:
+    spent = 0.0
+    for item in items:
+        start = time.time()
+        if collected is not None:
+            collected.append(item)
+        buf.append(sep + json.dumps(item, sort_keys=True,
+                                    separators=(',', ':')))
+        buf_size += len(buf[-1])
+        sep = ','
+        nodes += 1
+        # write in blocks instead of sending single nodes down the pipe:
+        if buf_size > 65536:
+            outfile.write(''.join(buf))
+            outfile.flush()
+            buf = []
+            buf_size = 0
+        spent += time.time() - start
+    start = time.time()
+    if sep == '[':
+        buf.append(sep)
+    buf.append(']\n')
+    outfile.write(''.join(buf))
+    outfile.flush()
+    spent += time.time() - start
+    METRICS.record('phase', 'json', seconds=spent, nodes=nodes)
+
+
 def gen_obj_dict(obj, id_pfx=''):
     """Create a dict from an OMERO object.
 
@@ -131,246 +741,1548 @@ def gen_obj_dict(obj, id_pfx=''):
     return obj_dict
 
 
-def gen_children(conn, id_str):
-    """Get the children for a given node.
+def gen_children(conn, id_str, limit=None):
+    """Get the children for a given node.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    id_str : str - OMERO object ID string (e.g. "G:23:Image:42")
+    limit : int - (optional) the maximum number of children, see
+            iter_children()
+
+    Returns
+    =======
+    list - a list of the child nodes dicts, having the 'load_on_demand'
+           property set to True required by the jqTree JavaScript library
+    """
+    return list(iter_children(conn, id_str, limit))
+
+
+def iter_children(conn, id_str, limit=None):
+    """Generate the children for a given node, one page at a time.
+
+    The children of an object can be requested in pages of 'limit' nodes by
+    appending the offset of the first child to the ID string. If there are
+    more children beyond the requested page, a node of class 'More' is added
+    at the end, having the ID string of the following page as its ID (e.g.
+    "G:23:Dataset:42:1000"), so the tree can load it on demand like any other
+    node. The groups of the ROOT node are paged the same way (e.g. "ROOT:1000").
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    id_str : str - OMERO object ID string (e.g. "G:23:Image:42"), optionally
+             followed by the offset of the first child (e.g. ":1000")
+    limit : int - (optional) the maximum number of children (None or 0 for all)
+
+    Returns
+    =======
+    generator(dict) - the child node dicts, see gen_children()
+    """
+    parts = id_str.split(':')
+    if parts[0] == 'ROOT':
+        offset = 0
+        if len(parts) > 1:
+            offset = int(parts[1])
+        groups = gen_base_tree(conn)
+        for group in groups[offset:offset + limit if limit else None]:
+            yield group
+        if limit and len(groups) > offset + limit:
+            yield more_node('ROOT:%s' % (offset + limit))
+        return
+    _, gid, obj_type, oid = parts[:4]
+    offset = 0
+    if len(parts) > 4:
+        offset = int(parts[4])
+    conn.SERVICE_OPTS.setOmeroGroup(gid)
+    # request one more child than necessary to know if there are further ones:
+    count = None
+    if limit:
+        count = limit + 1
+    if obj_type in CHILDREN_QUERIES:
+        # fetch id, name and owner of the children using projection queries:
+        children = query_children(conn, obj_type, oid, 'G:' + gid + ':',
+                                  offset, count)
+    else:
+        with METRICS.phase('getObject', cls=obj_type):
+            obj = conn.getObject(obj_type, oid)
+        # we need different child-wrappers, depending on the object type:
+        if obj_type == 'ExperimenterGroup':
+            children_wrapper = None  # FIXME
+        else:
+            with METRICS.phase('listChildren', cls=obj_type) as details:
+                children_wrapper = obj.listChildren()
+                details['nodes'] = len(children_wrapper)
+        children = itertools.islice(
+            (gen_obj_dict(child, 'G:' + gid + ':')
+             for child in children_wrapper),
+            offset, None if count is None else offset + count)
+    for index, child in enumerate(children):
+        if limit and index == limit:
+            yield more_node('G:%s:%s:%s:%s' % (gid, obj_type, oid,
+                                               offset + limit))
+            return
+        # set the on-demand flag unless the children are the last level:
+        if not obj_type == 'Dataset':
+            child['load_on_demand'] = True
+        yield child
+
+
+def more_node(id_str):
+    """Create the node dict standing for the next page of children.
+
+    Parameters
+    ==========
+    id_str : str - the ID string of the next page, see iter_children()
+    """
+    return {
+        'label': 'more...',
+        'class': 'More',
+        'owner': None,
+        'id': id_str,
+        'children': [],
+        'load_on_demand': True,
+    }
+
+
+def query_children(conn, obj_type, oid, id_pfx='', offset=0, count=None):
+    """Get the child node dicts of an object using projection queries.
+
+    Instead of loading the object and its children as wrapper objects (which
+    triggers several server round trips per child), only the values required
+    for the tree nodes are requested. The resulting dicts are identical to the
+    ones created by gen_obj_dict() from the wrappers. The rows are fetched in
+    pages of QUERY_PAGE_SIZE, so they can be processed before all of them have
+    been transferred.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    obj_type : str - the OMERO class of the parent object, one of the keys of
+               CHILDREN_QUERIES
+    oid : str - the ID of the parent object
+    id_pfx : str - the prefix for the child IDs (e.g. "G:23:")
+    offset : int - the number of children to skip
+    count : int - (optional) the maximum number of children
+
+    Returns
+    =======
+    generator(dict) - the child nodes dicts
+    """
+    from omero.sys import ParametersI
+    child_class, query = CHILDREN_QUERIES[obj_type]
+    params = ParametersI()
+    params.addId(long(oid))
+    query_service = conn.getQueryService()
+    while count is None or count > 0:
+        size = QUERY_PAGE_SIZE
+        if count is not None:
+            size = min(size, count)
+            count -= size
+        params.page(offset, size)
+        with METRICS.phase('query', cls=obj_type) as details:
+            rows = query_service.projection(query, params, conn.SERVICE_OPTS)
+            details['nodes'] = len(rows)
+        for child_id, name, owner in rows:
+            yield {
+                'label': name.val,
+                'class': child_class,
+                'owner': owner.val,
+                'id': id_pfx + "%s:%s" % (child_class, child_id.val),
+                'children': [],
+            }
+        if len(rows) < size:
+            return
+        offset += size
+
+
+def gen_base_tree(conn):
+    """Generate all group trees with their members as the basic tree.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+
+    Returns
+    =======
+    base : a list of grouptree dicts
+    """
+    with METRICS.phase('groups'):
+        groups = list(conn.getGroupsMemberOf())
+    try:
+        with METRICS.phase('members'):
+            members = query_group_members(
+                conn, [group.getId() for group in groups],
+                [group.getId() for group in groups if group.isPrivate()])
+    except Exception:  # pylint: disable=broad-except
+        # fall back to switching into each group and asking for its members:
+        with METRICS.phase('group_trees'):
+            return [gen_group_tree(conn, group) for group in groups]
+    user = conn.getUser()
+    tree = []
+    for group in groups:
+        gid = str(group.getId())
+        group_dict = gen_obj_dict(group)
+        # add the user's own tree first, then the other group members:
+        user_dict = gen_obj_dict(user, 'G:' + gid + ':')
+        user_dict['load_on_demand'] = True
+        group_dict['children'].append(user_dict)
+        for member in members.get(group.getId(), []):
+            if member['owner'] == user.getId():
+                continue
+            member = dict(member, id='G:' + gid + ':' + member['id'])
+            group_dict['children'].append(member)
+        tree.append(group_dict)
+    return tree
+
+
+def query_group_members(conn, group_ids, private=()):
+    """Get the member node dicts of several groups using a single query.
+
+    The query is run across all groups (instead of switching the context to
+    each group in turn) and returns the members in the same order as
+    listColleagues() does, the dicts are identical to the ones created by
+    gen_obj_dict() for the experimenter wrappers (without the group prefix of
+    the ID). Like listColleagues(), only the leaders of a private group get
+    its other members, the leaders being part of the query result as well.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    group_ids : list(long) - the IDs of the groups
+    private : list(long) - the IDs of the private groups among them
+
+    Returns
+    =======
+    dict - the lists of member dicts, keyed by group ID
+    """
+    from omero.sys import ParametersI
+    params = ParametersI()
+    params.addIds(group_ids)
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(-1)
+    rows = conn.getQueryService().projection(
+        "select m.parent.id, m.owner, e.id, e.firstName, e.middleName, "
+        "e.lastName, e.omeName from GroupExperimenterMap m join m.child e "
+        "where m.parent.id in (:ids) order by m.id", params, ctx)
+    rows = [[col.val if col is not None else None for col in row]
+            for row in rows]
+    my_id = conn.getUserId()
+    hidden = set(private) - set([row[0] for row in rows
+                                 if row[1] and row[2] == my_id])
+    members = dict()
+    for gid, _, uid, first, middle, last, ome_name in rows:
+        if gid in hidden and uid != my_id:
+            continue
+        # assemble the name the same way ExperimenterWrapper.getFullName() does:
+        if middle:
+            label = "%s %s. %s" % (first, middle, last)
+        elif first == "" and last == "":
+            label = ome_name
+        else:
+            label = "%s %s" % (first, last)
+        members.setdefault(gid, []).append({
+            'label': label,
+            'class': 'Experimenter',
+            'owner': uid,
+            'id': "%s:%s" % ('Experimenter', uid),
+            'children': [],
+            'load_on_demand': True,
+        })
+    return members
+
+
+def gen_group_tree(conn, group=None):
+    """Create the tree nodes for a group and its members.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+
+    Returns
+    =======
+    grouptree : a nested dict of a group (the default unless explicitly
+                requested) and its members as a list of dicts in the 'children'
+                item, starting with the current user as the first entry
+    """
+    if group is not None:
+        conn.SERVICE_OPTS.setOmeroGroup(group.getId())
+    else:
+        group = conn.getGroupFromContext()
+    gid = str(group.getId())
+    group_dict = gen_obj_dict(group)
+    # add the user's own tree first:
+    user = conn.getUser()
+    user_dict = gen_obj_dict(user, 'G:' + gid + ':')
+    user_dict['load_on_demand'] = True
+    group_dict['children'].append(user_dict)
+    # then add the trees for other group members
+    for user in conn.listColleagues():
+        user_dict = gen_obj_dict(user, 'G:' + gid + ':')
+        user_dict['load_on_demand'] = True
+        group_dict['children'].append(user_dict)
+    return group_dict
+
+
+def search_objects(conn, text, user, limit=100):
+    """Print the projects, datasets and images matching a search text as JSON.
+
+    The objects are looked up in the local search index, which is brought up
+    to date with OMERO first unless this happened less than
+    SEARCH_SYNC_INTERVAL seconds ago (see sync_search_index()). The nodes are
+    identical to the ones of the tree, i.e. their IDs have the form
+    "G:<gid>:<Class>:<id>".
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    text : str - the words to search for (anywhere in the names)
+    user : str - the OMERO user name
+    limit : int - the maximum number of results
+
+    Returns
+    =======
+    bool - True in case searching was successful, False otherwise.
+    """
+    index = open_search_index()
+    if index is None:
+        print("ERROR: the search index is not available.")
+        return False
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    try:
+        if time.time() - index.last_sync(user) >= SEARCH_SYNC_INTERVAL:
+            try:
+                with METRICS.phase('search_sync'):
+                    sync_search_index(conn, index, user)
+            except Exception as err:  # pylint: disable=broad-except
+                # searching the index as it is is better than nothing:
+                sys.stderr.write("WARNING: updating the search index failed: "
+                                 "%s\n" % err)
+        with METRICS.phase('search') as details:
+            rows = index.search(user, text, limit)
+            details['nodes'] = len(rows)
+    finally:
+        index.close()
+    nodes = []
+    for cls, oid, gid, name, owner in rows:
+        node = {
+            'label': name,
+            'class': cls,
+            'owner': owner,
+            'id': 'G:%s:%s:%s' % (gid, cls, oid),
+            'children': [],
+        }
+        if cls != 'Image':
+            node['load_on_demand'] = True
+        nodes.append(node)
+    write_json_list(nodes)
+    return True
+
+
+def sync_search_index(conn, index, user):
+    """Bring the local search index of a user up to date with OMERO.
+
+    For every indexed class, only the objects created or modified since the
+    last synchronization are requested (across all groups of the user, in
+    pages of SEARCH_PAGE_SIZE). If the number of objects known to OMERO
+    differs from the indexed one afterwards, objects must have been deleted
+    (or became invisible), so the IDs of all objects are compared to remove
+    them from the index (and to add objects that became visible).
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    index : ome_hrm_search.SearchIndex
+    user : str - the OMERO user name
+    """
+    from omero.sys import ParametersI
+    from ome_hrm_search import CLASSES
+    start = time.time()
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(-1)
+    query_service = conn.getQueryService()
+    for cls in CLASSES:
+        event, oid = index.position(user, cls)
+        while True:
+            params = ParametersI()
+            params.addLong('event', event)
+            params.addLong('id', oid)
+            params.page(0, SEARCH_PAGE_SIZE)
+            with METRICS.phase('query', cls=cls) as details:
+                rows = query_service.projection(SEARCH_SYNC_QUERY % cls,
+                                                params, ctx)
+                details['nodes'] = len(rows)
+            if not rows:
+                break
+            oid, event = rows[-1][0].val, rows[-1][4].val
+            index.update(user, cls,
+                         [(row[0].val, row[1].val, row[2].val, row[3].val)
+                          for row in rows], (event, oid))
+            if len(rows) < SEARCH_PAGE_SIZE:
+                break
+        params = ParametersI()
+        rows = query_service.projection(
+            "select count(x.id) from %s x" % cls, params, ctx)
+        if rows[0][0].val != index.count(user, cls):
+            reconcile_search_index(conn, index, user, cls, ctx)
+    # objects modified during the synchronization will be seen next time:
+    index.set_synced(user, start)
+
+
+def reconcile_search_index(conn, index, user, cls, ctx):
+    """Compare the IDs of all objects of a class with the indexed ones.
+
+    Objects not existing (or visible) in OMERO anymore are removed from the
+    index, missing ones are added. See sync_search_index() for the parameters.
+    """
+    from omero.sys import ParametersI
+    query_service = conn.getQueryService()
+    remote = set()
+    last = -1
+    while True:
+        params = ParametersI()
+        params.addLong('id', last)
+        params.page(0, SEARCH_PAGE_SIZE)
+        rows = query_service.projection(
+            "select x.id from %s x where x.id > :id order by x.id" % cls,
+            params, ctx)
+        remote.update([row[0].val for row in rows])
+        if len(rows) < SEARCH_PAGE_SIZE:
+            break
+        last = rows[-1][0].val
+    indexed = index.ids(user, cls)
+    index.remove(user, cls, indexed - remote)
+    missing = sorted(remote - indexed)
+    for pos in range(0, len(missing), QUERY_PAGE_SIZE):
+        params = ParametersI()
+        params.addIds(missing[pos:pos + QUERY_PAGE_SIZE])
+        rows = query_service.projection(
+            "select x.id, x.details.group.id, x.name, o.omeName from %s x "
+            "join x.details.owner o where x.id in (:ids)" % cls, params, ctx)
+        index.update(user, cls, [tuple([col.val for col in row])
+                                 for row in rows])
+
+
+def check_credentials(conn):
+    """Check if supplied credentials are valid.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+
+    Returns
+    =======
+    conntected : bool
+        True if connecting was successful (i.e. credentials are correct), False
+        otherwise. In addition, a corresponding message is printed.
+    """
+    connected = conn.connect()
+    if connected:
+        print('Success logging into OMERO with user ID %s' % conn.getUserId())
+    else:
+        print('ERROR logging into OMERO.')
+    return connected
+
+
+def omero_to_hrm(conn, id_str, dest, chunk_size=CHUNK_SIZE,
+                 streams=DOWNLOAD_STREAMS, subvolume=None):
+    """Download the corresponding original file(s) from an image ID.
+
+    Instead of a single image, a whole dataset or project can be requested,
+    downloading every fileset of its images once (see omero_to_hrm_batch()).
+
+    Images that were created with OMERO versions before 5.0 don't have an
+    "original file" linked to them, they are exported as OME-TIFF instead.
+    The same applies if only a sub-volume of the image is requested (e.g. a
+    single channel or a few timepoints of a time-lapse), in this case only
+    the pixel data of the selected planes and region is transferred.
+
+    Note that files will be downloaded with their original name, which is not
+    necessarily the name shown by OMERO, e.g. if an image name was changed in
+    OMERO. To keep filesets consistent, we have to preserve the original names!
+
+    In addition to the original file(s), it also downloads a thumbnail of the
+    requested file from OMERO and puts it into the appropriate place so HRM
+    will show it as a preview until the user hits "re-generate preview".
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    id_str: str - the ID of the OMERO image (e.g. "G:23:Image:42"), dataset or
+            project
+    dest: str - destination directory
+    chunk_size: int - the number of bytes to request from OMERO at once
+    streams: int - the number of parallel streams per file
+    subvolume: dict - (optional) the part of the image to download, see
+               ome_hrm_transfer.select_subvolume()
+
+    Returns
+    =======
+    True in case the download was successful, False otherwise.
+    """
+    item = new_transfer_item(id_str, dest=dest)
+    if subvolume:
+        item['subvolume'] = subvolume
+    omero_to_hrm_batch(conn, [item], chunk_size=chunk_size, streams=streams)
+    for msg in item['messages']:
+        print(msg)
+    return item['success']
+
+
+def new_transfer_item(id_str, **details):
+    """Create the dict describing a single transfer of a batch.
+
+    Parameters
+    ==========
+    id_str : str - the OMERO ID of the image, dataset or project (downloads)
+             or of the target dataset (uploads), e.g. "G:23:Image:42"
+    details : the local side of the transfer, 'dest' for downloads (the
+              destination directory) and 'file' for uploads (the image file),
+              optionally 'subvolume' for downloads of a part of an image (see
+              ome_hrm_transfer.select_subvolume())
+
+    Returns
+    =======
+    item : dict - dictionary with the following structure:
+    {
+        'id': 'G:23:Image:42',
+        'dest': '/export/hrm_data/demo01/src',
+        'success': None,
+        'messages': []
+    }
+    """
+    item = {'id': id_str, 'success': None, 'messages': []}
+    item.update(details)
+    return item
+
+
+def read_manifest(fname, key):
+    """Read the list of transfer items from a JSON manifest file.
+
+    The manifest is expected to contain a list of objects, each having an 'id'
+    and a 'dest' entry (downloads), e.g. [{"id": "G:23:Image:42", "dest":
+    "/path"}, ...], respectively a 'file' entry (uploads). Downloads may also
+    have a 'subvolume' entry, e.g. {"c": [0], "t": [0, 1, 2]}.
+
+    Parameters
+    ==========
+    fname : str - the manifest file
+    key : str - the name of the entry for the local side ('dest' or 'file')
+
+    Returns
+    =======
+    list(dict) - the transfer items, see new_transfer_item()
+    """
+    with open(fname, 'r') as infile:
+        entries = json.load(infile)
+    items = []
+    for entry in entries:
+        item = new_transfer_item(entry['id'], **{key: entry[key]})
+        if entry.get('subvolume'):
+            item['subvolume'] = entry['subvolume']
+        items.append(item)
+    return items
+
+
+def print_report(items, fname=None):
+    """Print the messages of transfer items, optionally write a JSON report.
+
+    Parameters
+    ==========
+    items : list(dict) - the transfer items, see new_transfer_item()
+    fname : str - (optional) the file to write the JSON report to
+    """
+    for item in items:
+        # uploads are labeled by their file, downloads by their OMERO ID:
+        label = item.get('file', item['id'])
+        for msg in item['messages']:
+            print("%s: %s" % (label, msg))
+    if fname is not None:
+        with open(fname, 'w') as outfile:
+            outfile.write(tree_to_json(items))
+
+
+def omero_to_hrm_batch(conn, items, jobs=1, chunk_size=CHUNK_SIZE,
+                       streams=DOWNLOAD_STREAMS, progress=None, events=None):
+    """Download the original files for a list of image, dataset or project IDs.
+
+    First, the original files for all requested images are determined and the
+    targets are checked, then all files are downloaded using a pool of 'jobs'
+    parallel transfers on the same connection. Finally, the thumbnails of all
+    successfully downloaded images are placed as HRM previews.
+
+    Datasets and projects are expanded to their images using a single query.
+    Images sharing a fileset (e.g. the series of a LIF file) are downloaded
+    only once, no matter whether they are requested through a container or
+    as several items of the batch, but get a preview each (see
+    gen_download_list()).
+
+    If the shared download cache is enabled, files available there are not
+    transferred again but linked to the target location, all others are
+    added to the cache after being downloaded (see ome_hrm_filecache).
+
+    Images without original files and items requesting only a sub-volume of
+    an image are exported as OME-TIFF, streaming their pixel data in blocks
+    of at most EXPORT_BUFFER bytes (see ome_hrm_transfer.export_ome_tiff()).
+
+    Every transfer from OMERO (i.e. not served by the cache) takes a slot of
+    the machine-wide transfer governor first, waiting for one to become free
+    if all are in use, and is throttled to its share of the bandwidth limit
+    (see ome_hrm_governor).
+
+    The files are transferred in chunks and verified against the checksum
+    stored in OMERO, interrupted transfers are resumed when being requested
+    again (see ome_hrm_transfer.download_original_file() for details). Files
+    larger than a chunk can optionally be fetched using several streams.
+
+    Optionally, the progress is reported as a stream of events while the
+    files are being transferred, e.g. every file as soon as it is complete
+    (see ome_hrm_events).
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    items : list(dict) - the transfer items, see new_transfer_item()
+    jobs : int - the number of parallel transfers
+    chunk_size : int - the number of bytes to request from OMERO at once
+    streams : int - the number of parallel streams per file
+    progress : callable - (optional) called as progress(item, fname, done,
+               total) with the number of bytes of every file transferred so
+               far (from the threads of the transfers)
+    events : ome_hrm_events.EventStream - (optional) the stream to report the
+             progress to
+
+    Returns
+    =======
+    True in case all downloads were successful, False otherwise. The details
+    are recorded in the 'success' and 'messages' entries of each item, the
+    'retry' entry is set to False for failures that retrying can't fix (e.g.
+    targets existing already).
+    """
+    claimed = dict()
+    tasks = []
+    # the items sharing every file to transfer:
+    owners = dict()
+    for item in items:
+        downloads = gen_download_list(conn, item, claimed)
+        item['downloads'] = downloads
+        item['success'] = downloads is not None
+        if downloads is None:
+            if events is not None:
+                events.failed(item, item['messages'][-1])
+            continue
+        if events is not None:
+            events.started(item, [tgt for (_, tgt) in downloads])
+        # the items of a batch may belong to different groups, so every
+        # transfer gets the context of its own item (the group set on the
+        # connection is the one of the item planned last):
+        ctx = conn.SERVICE_OPTS.copy()
+        ctx.setOmeroGroup(item['id'].split(':')[1])
+        # files shared with other items of the batch are transferred once:
+        for fset_id, tgt in downloads:
+            if tgt not in owners:
+                owners[tgt] = []
+                tasks.append((item, ctx, fset_id, tgt))
+            if item not in owners[tgt]:
+                owners[tgt].append(item)
+
+    cache = open_download_cache()
+    # only files cached by the same user are hardlinked into the targets:
+    user_id = str(conn.getUserId())
+    governor = open_transfer_governor()
+
+    def download(task):
+        """Download a single original file and report it.
+
+        Returns
+        =======
+        (str, str) - an error message (None on success) and the method used
+        to place the file, 'existing', 'cache', 'export' or 'download'
+        """
+        item, ctx, fset_id, tgt = task
+        error, method, nbytes = transfer(item, ctx, fset_id, tgt)
+        if events is not None:
+            for owner in owners[tgt]:
+                if error is None:
+                    events.file_done(owner, tgt, nbytes, method)
+                else:
+                    events.failed(owner, error, tgt)
+        return error, method
+
+    def transfer(item, ctx, fset_id, tgt):
+        """Transfer a single file, see download().
+
+        Returns
+        =======
+        (str, str, int) - the error message (None on success), the method
+        used to place the file (e.g. 'download' or 'cache') and its size
+        """
+        if os.path.exists(tgt):
+            # only complete copies verified while claiming the target are
+            # kept, anything else must not be reported as downloaded:
+            if tgt in item.get('verified', ()):
+                return None, 'existing', os.path.getsize(tgt)
+            return ("ERROR: target file '%s' already existing!" % tgt,
+                    'existing', 0)
+        slot = []
+
+        def file_progress(done, total):
+            """Apply the bandwidth limit and report the progress."""
+            if slot:
+                slot[0].throttle(done)
+            if progress is not None:
+                progress(item, tgt, done, total)
+            if events is not None:
+                events.progress(item, tgt, done, total)
+
+        try:
+            start = time.time()
+            if fset_id is not None:
+                info = ome_hrm_transfer.get_file_info(conn, fset_id, ctx)
+            if fset_id is not None and cache is not None:
+                key = cache.key(fset_id, *info[1:])
+                method = cache.fetch(key, tgt, user_id)
+                if method is not None:
+                    file_progress(info[0], info[0])
+                    METRICS.transfer('cache', tgt, info[0],
+                                     time.time() - start, ofile=fset_id,
+                                     method=method)
+                    return None, 'cache', info[0]
+            if governor is not None:
+                slot.append(acquire_transfer_slot(governor, conn, item, tgt,
+                                                  events))
+                start = time.time()
+            if fset_id is None:
+                _, pixels_id, meta = item['exports'][tgt]
+                nbytes = ome_hrm_transfer.export_ome_tiff(
+                    conn, pixels_id, meta, tgt, EXPORT_BUFFER, file_progress,
+                    ctx)
+                METRICS.transfer('export', tgt, nbytes, time.time() - start,
+                                 pixels=pixels_id)
+                return None, 'export', nbytes
+            nbytes = ome_hrm_transfer.download_original_file(
+                conn, fset_id, tgt, chunk_size, file_progress, streams, info,
+                ctx)
+            METRICS.transfer('download', tgt, nbytes, time.time() - start,
+                             ofile=fset_id)
+            if cache is not None:
+                cache.store(key, tgt, user_id)
+        except ome_hrm_transfer.TransferError as err:
+            return "ERROR: downloading %s to '%s' failed: %s!" % (
+                fset_id, tgt, err), None, 0
+        except Exception:  # pylint: disable=broad-except
+            return "ERROR: downloading %s to '%s' failed!" % (
+                fset_id, tgt), None, 0
+        finally:
+            if slot:
+                slot[0].release()
+        return None, 'download', nbytes
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(jobs, len(tasks))))
+    try:
+        results = pool.map(download, tasks)
+    finally:
+        pool.close()
+    if cache is not None:
+        cache.prune()
+    outcome = dict(zip([task[-1] for task in tasks], results))
+    thumbs = []
+    for item in items:
+        downloads = item.pop('downloads')
+        exports = item.pop('exports', dict())
+        item.pop('verified', None)
+        for fset_id, tgt in downloads or []:
+            error, method = outcome[tgt]
+            if error is not None:
+                item['success'] = False
+                item['messages'].append(error)
+                if method == 'existing':
+                    item['retry'] = False
+            elif item['success'] and fset_id is None:
+                item['messages'].append(
+                    "ID %s %sexported as OME-TIFF '%s'" % (
+                        exports[tgt][0],
+                        '(sub-volume) ' if item.get('subvolume') else '',
+                        os.path.basename(tgt)))
+            elif item['success'] and method == 'existing':
+                item['messages'].append(
+                    "ID %s already downloaded as '%s'" %
+                    (fset_id, os.path.basename(tgt)))
+            elif item['success'] and method == 'cache':
+                item['messages'].append(
+                    "ID %s taken from the download cache as '%s'" %
+                    (fset_id, os.path.basename(tgt)))
+            elif item['success']:
+                item['messages'].append("ID %s downloaded as '%s'" %
+                                        (fset_id, os.path.basename(tgt)))
+        previews = item.pop('thumbs', [])
+        if item['success']:
+            thumbs.extend([(image_id, preview, item['messages'])
+                           for image_id, preview in previews])
+    download_thumbs(conn, thumbs, events)
+    if events is not None:
+        for item in items:
+            events.finished(item)
+    return all([item['success'] for item in items])
+
+
+def gen_download_list(conn, item, claimed):
+    """Assemble the list of original files to download for an item.
+
+    The item may refer to an image, a dataset or a project, see
+    gen_container_downloads() for the latter ones. The thumbnails to place as
+    previews are added to the item as 'thumbs', a list of (image ID, target
+    filename of the preview) pairs, see preview_target().
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    item : dict - the transfer item, see new_transfer_item()
+    claimed : dict - the target filenames already claimed by other items of
+              the same batch (mapped to the ID of their original file), gets
+              updated with the ones of this item
+
+    Returns
+    =======
+    list(tuple) - (original file ID, target filename) pairs, None in case the
+    image can't be found or a target already exists. An explanation is added
+    to the messages of the item in this case. For images without original
+    files or if the item requests a sub-volume, the pair (None, target
+    filename) is returned for exporting the image as OME-TIFF, the image ID
+    and the ID and metadata of the pixels are added to the item's 'exports'
+    (keyed by the target filename).
+    """
+    _, gid, obj_type, image_id = item['id'].split(':')
+    conn.SERVICE_OPTS.setOmeroGroup(gid)
+    # check if dest is a directory, rewrite it otherwise:
+    dest = item['dest']
+    if not os.path.isdir(dest):
+        dest = os.path.dirname(dest)
+    if obj_type in CONTAINER_QUERIES:
+        return gen_container_downloads(conn, item, dest, claimed)
+    # use image objects and getFileset() methods to determine original files,
+    # see the following OME forum thread for some more details:
+    # https://www.openmicroscopy.org/community/viewtopic.php?f=6&t=7563
+    with METRICS.phase('getObject', cls='Image'):
+        image_obj = conn.getObject("Image", image_id)
+    if not image_obj:
+        item['messages'].append(
+            "ERROR: can't find image with ID %s!" % image_id)
+        return None
+    # only the selected planes of a sub-volume are streamed from the pixels
+    # service, exported as OME-TIFF:
+    export = item.get('subvolume')
+    if not export:
+        with METRICS.phase('getFileset'):
+            fset = image_obj.getFileset()
+        # TODO (issue #438): in case the query fails, this means most likely
+        # that a file was uploaded in an older version of OMERO and therefore
+        # the original file is not available. However, it was possible to
+        # upload with the "archive" option, we should check if such archived
+        # files are retrieved with the above query.
+        # fall back to exporting the pixel data as OME-TIFF (issue #398):
+        export = not fset
+    if export:
+        downloads = gen_export_target(image_obj, item, dest, claimed)
+        if downloads is not None:
+            item['thumbs'] = [(image_id, downloads[0][1])]
+        return downloads
+    # assemble a list of items to download, check if any files already exist
+    # (unless they are complete copies from an earlier, interrupted attempt):
+    with METRICS.phase('listFiles'):
+        fset_files = fset.listFiles()
+    downloads = [(fset_file.getId(), os.path.join(dest, fset_file.getName()))
+                 for fset_file in fset_files]
+    if not claim_targets(conn, item, downloads, claimed):
+        return None
+    # NOTE: for filesets with a single file or e.g. ICS/IDS pairs it makes
+    # sense to use the target name of the first file to construct the name
+    # for the thumbnail, but it is unclear whether this is a universal
+    # approach:
+    item['thumbs'] = [(image_id, preview_target(downloads[0][1],
+                                                image_obj.getName()))]
+    return downloads
+
+
+def gen_container_downloads(conn, item, dest, claimed):
+    """Assemble the list of original files to download for a container.
+
+    All images of the dataset or project (including their filesets and
+    original files) are requested using a single (paged) query. Every
+    fileset is downloaded once, even if it contains several images (e.g. the
+    series of a LIF file), each of them getting a preview of its own. Images
+    without original files are exported as OME-TIFF.
+
+    See gen_download_list() for the parameters and the return value.
+    """
+    from omero.sys import ParametersI
+    _, gid, obj_type, oid = item['id'].split(':')
+    if item.get('subvolume'):
+        item['messages'].append("ERROR: sub-volumes can only be requested "
+                                "for single images!")
+        return None
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(gid)
+    params = ParametersI()
+    params.addId(long(oid))
+    query_service = conn.getQueryService()
+    images = []
+    files = dict()
+    offset = 0
+    while True:
+        params.page(offset, QUERY_PAGE_SIZE)
+        with METRICS.phase('query', cls=obj_type) as details:
+            rows = query_service.projection(CONTAINER_QUERIES[obj_type],
+                                            params, ctx)
+            details['nodes'] = len(rows)
+        for row in rows:
+            image_id, name, fset_id, ofile_id, fname = [
+                col.val if col is not None else None for col in row]
+            if image_id not in files:
+                images.append((image_id, name, fset_id))
+                files[image_id] = []
+            if ofile_id is not None and \
+                    (ofile_id, fname) not in files[image_id]:
+                files[image_id].append((ofile_id, fname))
+        if len(rows) < QUERY_PAGE_SIZE:
+            break
+        offset += QUERY_PAGE_SIZE
+    if not images:
+        item['messages'].append(
+            "ERROR: can't find any images in %s %s!" % (obj_type, oid))
+        return None
+    downloads = []
+    thumbs = []
+    previews = set()
+    filesets = dict()
+    for image_id, name, fset_id in images:
+        if not files[image_id]:
+            with METRICS.phase('getObject', cls='Image'):
+                image_obj = conn.getObject("Image", image_id)
+            exports = None
+            if image_obj:
+                exports = gen_export_target(image_obj, item, dest, claimed)
+            if exports is None:
+                return None
+            downloads.extend(exports)
+            thumbs.append((image_id, exports[0][1]))
+            continue
+        if fset_id not in filesets:
+            fset_files = [(ofile_id, os.path.join(dest, fname))
+                          for ofile_id, fname in files[image_id]]
+            if not claim_targets(conn, item, fset_files, claimed):
+                return None
+            downloads.extend(fset_files)
+            filesets[fset_id] = fset_files[0][1]
+        preview = preview_target(filesets[fset_id], name)
+        # images of a fileset not named after their series get no preview:
+        if preview not in previews:
+            previews.add(preview)
+            thumbs.append((image_id, preview))
+    item['thumbs'] = thumbs
+    item['messages'].append("%s %s: %d image(s) in %d fileset(s)." % (
+        obj_type, oid, len(images), len(filesets)))
+    return downloads
+
+
+def claim_targets(conn, item, downloads, claimed):
+    """Check and claim the target filenames of original files.
+
+    A target may already be claimed by another item of the same batch for
+    the same original file (it will be downloaded once only then). Otherwise
+    it must neither be claimed nor exist already, unless it is a complete copy
+    of the original file from an earlier, interrupted attempt. Such copies are
+    recorded in the 'verified' list of the item, as only those may exist when
+    the file is about to be transferred.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    item : dict - the transfer item, an explanation is added to its messages
+           in case a target already exists
+    downloads : list(tuple) - (original file ID, target filename) pairs
+    claimed : dict - the claimed targets, see gen_download_list()
+
+    Returns
+    =======
+    bool - True if all targets could be claimed, False otherwise.
+    """
+    for ofile_id, tgt in downloads:
+        if tgt in claimed:
+            if claimed[tgt] == ofile_id:
+                continue
+        elif not os.path.exists(tgt):
+            continue
+        elif ome_hrm_transfer.is_complete(conn, ofile_id, tgt):
+            item.setdefault('verified', []).append(tgt)
+            continue
+        item['messages'].append(
+            "ERROR: target file '%s' already existing!" % tgt)
+        item['retry'] = False
+        return False
+    claimed.update([(tgt, ofile_id) for (ofile_id, tgt) in downloads])
+    return True
+
+
+def preview_target(fname, image_name):
+    """Determine the name to place the preview of an image for.
+
+    Images being one of several in a file (e.g. the series of a LIF file) are
+    named "file.lif [series]" by OMERO, the HRM lists them (as sub-images) as
+    "file.lif (series)" and expects their previews to be named accordingly.
+
+    Parameters
+    ==========
+    fname : str - the (first) downloaded file of the image's fileset
+    image_name : str - the name of the image in OMERO
+
+    Returns
+    =======
+    str - the filename the preview is named after
+    """
+    match = re.match(r'^(.*) \[(.+)\]$', image_name or '')
+    if match is None or match.group(1) != os.path.basename(fname):
+        return fname
+    return '%s (%s)' % (fname, match.group(2).replace(':', '_'))
+
+
+def gen_export_target(image_obj, item, dest, claimed):
+    """Assemble the target for exporting an image as OME-TIFF.
+
+    The target is named after the image and the selected sub-volume (if any),
+    see gen_download_list() for the parameters and the return value.
+    """
+    name = re.sub(r'[^\w.\-]+', '_', image_obj.getName()).strip('_.')
+    name = name or 'image'
+    if item.get('subvolume'):
+        name += '_' + subvolume_label(item['subvolume'])
+    tgt = os.path.join(dest, name + '.ome.tif')
+    if tgt in claimed or os.path.exists(tgt):
+        item['messages'].append(
+            "ERROR: target file '%s' already existing!" % tgt)
+        item['retry'] = False
+        return None
+    try:
+        pixels_id, meta = ome_hrm_transfer.pixels_info(image_obj)
+    except Exception:  # pylint: disable=broad-except
+        item['messages'].append("ERROR: no original file(s) or pixel data "
+                                "for image %s found!" % image_obj.getId())
+        return None
+    if item.get('subvolume'):
+        try:
+            meta = ome_hrm_transfer.select_subvolume(meta, item['subvolume'])
+        except ome_hrm_transfer.TransferError as err:
+            item['messages'].append("ERROR: invalid sub-volume for image "
+                                    "%s: %s!" % (image_obj.getId(), err))
+            item['retry'] = False
+            return None
+    item.setdefault('exports', dict())[tgt] = (image_obj.getId(), pixels_id,
+                                               meta)
+    claimed[tgt] = None
+    return [(None, tgt)]
+
+
+def subvolume_label(subvolume):
+    """Assemble a label describing a sub-volume for use in a filename.
+
+    Example
+    =======
+    >>> subvolume_label({'c': [0, 2], 't': [0, 1, 2, 3],
+    ...                  'crop': [0, 8, 64, 32]})
+    'c0.2_t0-3_x0y8w64h32'
+    """
+    parts = []
+    for dim in 'czt':
+        if subvolume.get(dim) is None:
+            continue
+        ranges = []
+        for idx in sorted(set(subvolume[dim])):
+            if ranges and ranges[-1][1] == idx - 1:
+                ranges[-1][1] = idx
+            else:
+                ranges.append([idx, idx])
+        parts.append(dim + '.'.join([
+            str(first) if first == last else '%d-%d' % (first, last)
+            for first, last in ranges]))
+    if subvolume.get('crop'):
+        parts.append('x%dy%dw%dh%d' % tuple(subvolume['crop']))
+    return '_'.join(parts)
+
+
+def download_thumb(conn, image_id, dest, messages=None):
+    """Download the thumbnail of a given image from OMERO.
+
+    Download the thumbnail of a given OMERO image and place it as preview in
+    the corresponding HRM directory, see download_thumbs().
 
     Parameters
     ==========
-    conn : omero.gateway._BlitzGateway
-    id_str : str - OMERO object ID string (e.g. "G:23:Image:42")
+    conn : omero.gateway.BlitzGateway
+    image_id: str - an OMERO object ID of an image (e.g. '102')
+    dest: str - destination filename
+    messages: list - (optional) list to add the status message to instead of
+              printing it
 
     Returns
     =======
-    list - a list of the child nodes dicts, having the 'load_on_demand'
-           property set to True required by the jqTree JavaScript library
+    True in case the download was successful, False otherwise.
     """
-    if id_str == 'ROOT':
-        return gen_base_tree(conn)
-    children = []
-    _, gid, obj_type, oid = id_str.split(':')
-    conn.SERVICE_OPTS.setOmeroGroup(gid)
-    obj = conn.getObject(obj_type, oid)
-    # we need different child-wrappers, depending on the object type:
-    if obj_type == 'Experimenter':
-        children_wrapper = conn.listProjects(oid)
-    elif obj_type == 'ExperimenterGroup':
-        children_wrapper = None  # FIXME
-    else:
-        children_wrapper = obj.listChildren()
-    # now recurse into children:
-    for child in children_wrapper:
-        children.append(gen_obj_dict(child, 'G:' + gid + ':'))
-    # set the on-demand flag unless the children are the last level:
-    if not obj_type == 'Dataset':
-        for child in children:
-            child['load_on_demand'] = True
-    return children
+    if messages is None:
+        messages = MessagePrinter()
+    return download_thumbs(conn, [(image_id, dest, messages)])
 
 
-def gen_base_tree(conn):
-    """Generate all group trees with their members as the basic tree.
+def download_thumbs(conn, thumbs, events=None):
+    """Download the thumbnails of several images and place them as previews.
+
+    The thumbnails of all images are requested from OMERO at once (unless
+    they are available from the local thumbnail cache) and written to the
+    "hrm_previews" directory next to the respective destination file. As
+    OMERO provides the thumbnails as JPEG, no conversion is required usually.
 
     Parameters
     ==========
-    conn : omero.gateway._BlitzGateway
+    conn : omero.gateway.BlitzGateway
+    thumbs : list(tuple) - (image ID, destination filename, messages) for
+             every image, the status message gets added to the 'messages'
+             list of the image
+    events : ome_hrm_events.EventStream - (optional) the stream to report
+             every preview written to
 
     Returns
     =======
-    base : a list of grouptree dicts
+    True in case all downloads were successful, False otherwise.
     """
-    tree = []
-    for group in conn.getGroupsMemberOf():
-        tree.append(gen_group_tree(conn, group))
-    return tree
+    if not thumbs:
+        return True
+    cache = open_thumbnail_cache()
+    # the images may belong to different groups (e.g. from a manifest):
+    group = conn.SERVICE_OPTS.getOmeroGroup()
+    conn.SERVICE_OPTS.setOmeroGroup('-1')
+    with METRICS.phase('thumbnails', images=len(thumbs)):
+        try:
+            data = ome_hrm_thumbs.fetch_thumbnails(
+                conn, [image_id for image_id, _, _ in thumbs], cache)
+        except Exception:  # pylint: disable=broad-except
+            data = dict()
+        finally:
+            conn.SERVICE_OPTS.setOmeroGroup(group)
+    success = True
+    for image_id, dest, messages in thumbs:
+        base_dir, fname = os.path.split(dest)
+        target = "/hrm_previews/" + fname + ".preview_xy.jpg"
+        try:
+            jpeg = ome_hrm_thumbs.to_jpeg(data[long(image_id)])
+            if cache is None or not cache.place(image_id, base_dir + target):
+                with open(base_dir + target, 'wb') as outfile:
+                    outfile.write(jpeg)
+            # TODO: os.chown() to fix permissions, see #457!
+            messages.append("Thumbnail downloaded to '%s'." % target)
+            if events is not None:
+                events.thumbnail(image_id, base_dir + target)
+        except Exception:  # pylint: disable=broad-except
+            messages.append("ERROR downloading thumbnail to '%s'." % target)
+            success = False
+    return success
+
+
+def hrm_to_omero(conn, id_str, image_file, cache=None, dedup=UPLOAD_DEDUP,
+                 scope=UPLOAD_DEDUP_SCOPE):
+    """Upload an image into a specific dataset in OMERO.
 
+    In case we know from the suffix that a given file format is not supported
+    by OMERO, the upload will not be initiated at all (e.g. for SVI-HDF5,
+    having the suffix '.h5').
 
-def gen_group_tree(conn, group=None):
-    """Create the tree nodes for a group and its members.
+    The import itself is done by instantiating the CLI class, assembling the
+    required arguments, and finally running cli.invoke(). This eventually
+    triggers the importer() method defined in OMERO's Python bindings in
+    <OMERO.server/lib/python/omero/plugins/import.py>, respectively (source)
+    <openmicroscopy.git/components/tools/OmeroPy/src/omero/plugins/import.py>.
 
     Parameters
     ==========
-    conn : omero.gateway._BlitzGateway
+    id_str: str - the ID of the target dataset in OMERO (e.g. "G:7:Dataset:23")
+    image_file: str - the local image file including the full path
+    cache: ome_hrm_cache.TreeCache - (optional) the tree cache to invalidate
+           the dataset node in after a successful upload
+    dedup: str - how to deal with a file that already exists in OMERO, see
+           skip_duplicates()
+    scope: str - where to look for existing files, see skip_duplicates()
 
     Returns
     =======
-    grouptree : a nested dict of a group (the default unless explicitly
-                requested) and its members as a list of dicts in the 'children'
-                item, starting with the current user as the first entry
+    True in case of success, False otherwise.
     """
-    if group is not None:
-        conn.SERVICE_OPTS.setOmeroGroup(group.getId())
-    else:
-        group = conn.getGroupFromContext()
-    gid = str(group.getId())
-    group_dict = gen_obj_dict(group)
-    # add the user's own tree first:
-    user = conn.getUser()
-    user_dict = gen_obj_dict(user, 'G:' + gid + ':')
-    user_dict['load_on_demand'] = True
-    group_dict['children'].append(user_dict)
-    # then add the trees for other group members
-    for user in conn.listColleagues():
-        user_dict = gen_obj_dict(user, 'G:' + gid + ':')
-        user_dict['load_on_demand'] = True
-        group_dict['children'].append(user_dict)
-    return group_dict
+    item = new_transfer_item(id_str, file=image_file)
+    hrm_to_omero_batch(conn, [item], cache=cache, dedup=dedup, scope=scope)
+    for msg in item['messages']:
+        print(msg)
+    return item['success']
 
 
-def check_credentials(conn):
-    """Check if supplied credentials are valid.
+def hrm_to_omero_batch(conn, items, jobs=1, cache=None, dedup=UPLOAD_DEDUP,
+                       scope=UPLOAD_DEDUP_SCOPE, progress=None, events=None):
+    """Upload a list of images into datasets in OMERO.
+
+    Unless disabled, files whose content already exists in OMERO are not
+    imported again, see skip_duplicates(). The imports are run by a pool of
+    'jobs' parallel workers, each of them using its own CLI instance (as these
+    are not thread-safe) that is set up only once and shares the client of the
+    given connection. Every import takes a slot of the machine-wide transfer
+    governor first (see ome_hrm_governor), the bandwidth of imports can't be
+    limited though as they are run by the OMERO CLI.
 
     Parameters
     ==========
     conn : omero.gateway.BlitzGateway
+    items : list(dict) - the transfer items, see new_transfer_item(), having
+            the target dataset as 'id' and the local image file as 'file'
+    jobs : int - the number of parallel imports
+    cache : ome_hrm_cache.TreeCache - (optional) the tree cache to invalidate
+            the nodes of the target datasets in after successful uploads
+    dedup : str - how to deal with files that already exist in OMERO
+    scope : str - where to look for existing files
+    progress : callable - (optional) called as progress(item, fname, done,
+               total) with the size of every file once it has been imported
+    events : ome_hrm_events.EventStream - (optional) the stream to report the
+             start and the result of every import to
 
     Returns
     =======
-    conntected : bool
-        True if connecting was successful (i.e. credentials are correct), False
-        otherwise. In addition, a corresponding message is printed.
+    True in case all uploads were successful, False otherwise. The details
+    are recorded in the 'success' and 'messages' entries of each item, files
+    that were not imported as they already exist in OMERO are marked by the
+    'skipped' entry.
     """
-    connected = conn.connect()
-    if connected:
-        print('Success logging into OMERO with user ID %s' % conn.getUserId())
-    else:
-        print('ERROR logging into OMERO.')
-    return connected
+    tasks = []
+    for item in items:
+        import_args = gen_import_args(item['id'], item['file'],
+                                      inplace_transfer(item['file']))
+        if import_args is None:
+            item['success'] = False
+            item['messages'].append(
+                'ERROR: HDF5 files are not supported by OMERO!')
+            if events is not None:
+                events.failed(item, item['messages'][-1])
+        else:
+            tasks.append((item, import_args))
+    if dedup != 'off' and tasks:
+        tasks = skip_duplicates(conn, tasks, dedup, scope, jobs, events)
+    workers = threading.local()
+    governor = open_transfer_governor()
+
+    def upload(task):
+        """Import a single image file, return True on success."""
+        if not hasattr(workers, 'cli'):
+            with METRICS.phase('cli_setup'):
+                workers.cli = gen_import_cli(conn)
+        item, import_args = task
+        if events is not None:
+            events.started(item, [item['file']])
+        slot = None
+        if governor is not None:
+            slot = acquire_transfer_slot(governor, conn, item, item['file'],
+                                         events)
+        try:
+            success = run_import(workers.cli, item, import_args)
+        finally:
+            if slot is not None:
+                slot.release()
+        if not success:
+            item['messages'].append('ERROR: uploading "%s" to %s failed!' %
+                                    (item['file'], item['id']))
+            if events is not None:
+                events.failed(item, item['messages'][-1], item['file'])
+        return success
+
+    def run_import(cli, item, import_args):
+        """Run the import of a single image file, return True on success."""
+        start = time.time()
+        try:
+            cli.invoke(import_args, strict=True)
+        except Exception:  # pylint: disable=broad-except
+            if '--transfer' not in import_args:
+                return False
+            # fall back to a regular upload if the in-place import failed:
+            idx = import_args.index('--transfer')
+            import_args = import_args[:idx] + import_args[idx + 2:]
+            item['messages'].append("In-place import failed, uploading the "
+                                    "file instead.")
+            try:
+                cli.invoke(import_args, strict=True)
+            except Exception:  # pylint: disable=broad-except
+                return False
+        fname = item['file']
+        size = os.path.getsize(fname)
+        if METRICS.enabled:
+            transfer = 'upload'
+            if '--transfer' in import_args:
+                transfer = import_args[import_args.index('--transfer') + 1]
+            METRICS.transfer('import', fname, size, time.time() - start,
+                             transfer=transfer)
+        if progress is not None:
+            progress(item, fname, size, size)
+        if events is not None:
+            events.progress(item, fname, size, size)
+            events.file_done(item, fname, size, 'import')
+        return True
 
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(jobs, len(tasks))))
+    try:
+        results = pool.map(upload, tasks)
+    finally:
+        pool.close()
+    for (item, _), success in zip(tasks, results):
+        item['success'] = success
+    if cache is not None:
+        for dset in set([item['id'] for item in items if item['success']]):
+            cache.invalidate(dset)
+    if events is not None:
+        for item in items:
+            events.finished(item)
+    return all([item['success'] for item in items])
+
+
+def skip_duplicates(conn, tasks, dedup='skip', scope='dataset', jobs=1,
+                    events=None):
+    """Filter out the uploads of files whose content already exists in OMERO.
+
+    The SHA1 checksums of the files are calculated (using 'jobs' parallel
+    workers) and compared to the ones of the original files in OMERO, using a
+    single query per group. If an image made from an identical file exists in
+    the target dataset, the file is not imported again. If there is one in a
+    different dataset of the same group and 'scope' is 'group', the file is
+    skipped as well ('dedup' being 'skip') or the existing image is linked
+    into the target dataset ('dedup' being 'link').
+
+    The items of skipped files are marked as successful, get the 'skipped'
+    entry set to True and the ID of the existing image set as 'existing'.
+    Like imported files, they are reported as 'started' and 'file' events
+    (with 'skip' or 'link' as the method), items whose image couldn't be
+    linked as 'started' and 'failed' ones.
 
-def omero_to_hrm(conn, id_str, dest):
-    """Download the corresponding original file(s) from an image ID.
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    tasks : list(tuple) - (item, import arguments) pairs, see
+            hrm_to_omero_batch()
+    dedup : str - 'skip' or 'link'
+    scope : str - 'dataset' or 'group'
+    jobs : int - the number of files to hash in parallel
+    events : ome_hrm_events.EventStream - (optional) the stream to report the
+             skipped files to
 
-    This works only for image ID's that were created with OMERO 5.0 or later as
-    previous versions don't have an "original file" linked to an image.
+    Returns
+    =======
+    list(tuple) - the tasks of the files that still have to be imported
+    """
+    def hash_upload(task):
+        """Calculate the SHA1 checksum of a file, None if it's unreadable."""
+        try:
+            hasher = ome_hrm_transfer.HASHERS['SHA1-160']()
+            return ome_hrm_transfer.hash_file(task[0]['file'], hasher,
+                                              chunk_size=CHUNK_SIZE).hexdigest()
+        except (IOError, OSError):
+            return None
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(jobs, len(tasks))))
+    try:
+        with METRICS.phase('hash_uploads', files=len(tasks)):
+            checksums = pool.map(hash_upload, tasks)
+    finally:
+        pool.close()
+    groups = dict()
+    for (item, _), checksum in zip(tasks, checksums):
+        if checksum is not None:
+            groups.setdefault(item['id'].split(':')[1], set()).add(checksum)
+    existing = dict()
+    for gid, group_checksums in groups.items():
+        try:
+            existing[gid] = query_checksums(conn, gid, group_checksums)
+        except Exception:  # pylint: disable=broad-except
+            # deduplication is optional, so simply import the files then:
+            existing[gid] = dict()
+    remaining = []
+    for task, checksum in zip(tasks, checksums):
+        item = task[0]
+        _, gid, _, dset_id = item['id'].split(':')
+        images = existing.get(gid, dict()).get(checksum, dict())
+        in_dataset = [image_id for image_id, dsets in images.items()
+                      if long(dset_id) in dsets]
+        method = 'skip'
+        if in_dataset:
+            image_id = min(in_dataset)
+            item['messages'].append(
+                "Skipped, identical file already in the dataset as Image:%s."
+                % image_id)
+        elif images and scope == 'group':
+            image_id = min(images)
+            if dedup == 'link':
+                method = 'link'
+                if events is not None:
+                    events.started(item, [item['file']])
+                try:
+                    link_image(conn, gid, dset_id, image_id)
+                except Exception:  # pylint: disable=broad-except
+                    item['success'] = False
+                    item['messages'].append(
+                        "ERROR: linking existing Image:%s to %s failed!" %
+                        (image_id, item['id']))
+                    if events is not None:
+                        events.failed(item, item['messages'][-1],
+                                      item['file'])
+                    continue
+                item['messages'].append(
+                    "Skipped, identical file already in OMERO as Image:%s, "
+                    "linked it to the dataset." % image_id)
+            else:
+                item['messages'].append(
+                    "Skipped, identical file already in OMERO as Image:%s."
+                    % image_id)
+        else:
+            remaining.append(task)
+            continue
+        item['success'] = True
+        item['skipped'] = True
+        item['existing'] = 'G:%s:Image:%s' % (gid, image_id)
+        if events is not None:
+            if method == 'skip':
+                events.started(item, [item['file']])
+            events.file_done(item, item['file'],
+                             os.path.getsize(item['file']), method)
+    return remaining
+
+
+def query_checksums(conn, gid, checksums):
+    """Find the images made from original files with the given checksums.
 
-    Note that files will be downloaded with their original name, which is not
-    necessarily the name shown by OMERO, e.g. if an image name was changed in
-    OMERO. To keep filesets consistent, we have to preserve the original names!
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    gid : str - the ID of the group to search in
+    checksums : set(str) - the SHA1 checksums of the files
 
-    In addition to the original file(s), it also downloads a thumbnail of the
-    requested file from OMERO and puts it into the appropriate place so HRM
-    will show it as a preview until the user hits "re-generate preview".
+    Returns
+    =======
+    dict - for every checksum found, a dict having the IDs of the images as
+    keys and the sets of the IDs of the datasets containing them as values
+    """
+    from omero.sys import ParametersI
+    from omero.rtypes import rlist, rstring
+    params = ParametersI()
+    params.add('hashes', rlist([rstring(checksum) for checksum in checksums]))
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(gid)
+    with METRICS.phase('query_checksums', files=len(checksums)):
+        rows = conn.getQueryService().projection(
+            "select f.hash, i.id, l.parent.id from Fileset fs "
+            "join fs.usedFiles fe join fe.originalFile f join f.hasher h "
+            "join fs.images i left outer join i.datasetLinks l "
+            "where h.value = 'SHA1-160' and f.hash in (:hashes)", params, ctx)
+    existing = dict()
+    for row in rows:
+        checksum, image_id, dset_id = [
+            col.val if col is not None else None for col in row]
+        dsets = existing.setdefault(checksum, dict()).setdefault(
+            image_id, set())
+        if dset_id is not None:
+            dsets.add(dset_id)
+    return existing
+
+
+def link_image(conn, gid, dset_id, image_id):
+    """Link an existing image into a dataset.
 
     Parameters
     ==========
     conn : omero.gateway.BlitzGateway
-    id_str: str - the ID of the OMERO image (e.g. "G:23:Image:42")
-    dest: str - destination directory
+    gid : str - the ID of the group of the dataset
+    dset_id : str - the ID of the dataset
+    image_id : long - the ID of the image
+    """
+    from omero.model import DatasetI, DatasetImageLinkI, ImageI
+    link = DatasetImageLinkI()
+    link.setParent(DatasetI(long(dset_id), False))
+    link.setChild(ImageI(long(image_id), False))
+    ctx = conn.SERVICE_OPTS.copy()
+    ctx.setOmeroGroup(gid)
+    conn.getUpdateService().saveObject(link, ctx)
+
+
+def gen_import_cli(conn):
+    """Set up an OMERO CLI instance for importing data.
+
+    Currently there is no direct "Python way" to import data into OMERO, so we
+    have to use the CLI wrapper for this.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway - the connection whose client is used
 
     Returns
     =======
-    True in case the download was successful, False otherwise.
+    cli : omero.cli.CLI - the CLI instance with all plugins loaded
     """
-    # FIXME: group switching required!!
-    _, gid, obj_type, image_id = id_str.split(':')
-    # check if dest is a directory, rewrite it otherwise:
-    if not os.path.isdir(dest):
-        dest = os.path.dirname(dest)
-    from omero_model_OriginalFileI import OriginalFileI
-    # use image objects and getFileset() methods to determine original files,
-    # see the following OME forum thread for some more details:
-    # https://www.openmicroscopy.org/community/viewtopic.php?f=6&t=7563
-    image_obj = conn.getObject("Image", image_id)
-    if not image_obj:
-        print("ERROR: can't find image with ID %s!" % image_id)
-        return False
-    fset = image_obj.getFileset()
-    if not fset:
-        print("ERROR: no original file(s) for image %s found!" % image_id)
-        return False
-    # TODO I (issue #438): in case the query fails, this means most likely that
-    # a file was uploaded in an older version of OMERO and therefore the
-    # original file is not available. However, it was possible to upload with
-    # the "archive" option, we should check if such archived files are
-    # retrieved with the above query.
-    # TODO II (issue #398): in case no archived file is available, we could
-    # fall back to downloading the OME-TIFF instead.
-    downloads = []
-    # assemble a list of items to download, check if any files already exist:
-    for fset_file in fset.listFiles():
-        tgt = os.path.join(dest, fset_file.getName())
-        if os.path.exists(tgt):
-            print("ERROR: target file '%s' already existing!" % tgt)
-            return False
-        fset_id = fset_file.getId()
-        downloads.append((fset_id, tgt))
-    # now initiate the downloads for all original files:
-    for (fset_id, tgt) in downloads:
-        try:
-            conn.c.download(OriginalFileI(fset_id), tgt)
-        except:
-            print("ERROR: downloading %s to '%s' failed!" % (fset_id, tgt))
-            return False
-        print("ID %s downloaded as '%s'" % (fset_id, os.path.basename(tgt)))
-    # NOTE: for filesets with a single file or e.g. ICS/IDS pairs it makes
-    # sense to use the target name of the first file to construct the name for
-    # the thumbnail, but it is unclear whether this is a universal approach:
-    download_thumb(conn, image_id, downloads[0][1])
-    return True
+    from omero.cli import CLI
+    cli = CLI()
+    cli.loadplugins()
+    # NOTE: cli._client should be replaced with cli.set_client() when switching
+    # to support for OMERO 5.1 and later only:
+    cli._client = conn.c
+    return cli
 
 
-def download_thumb(conn, image_id, dest):
-    """Download the thumbnail of a given image from OMERO.
+def inplace_transfer(image_file):
+    """Determine the transfer mode for importing a file in-place.
 
-    In case PIL (Python Imaging Library) is installed, download the thumbnail
-    of a given OMERO image and place it as preview in the corresponding HRM
-    directory.
+    In-place imports are only done if enabled (OMERO_IMPORT_TRANSFER) and the
+    file is located on the same filesystem as the managed repository of OMERO
+    (OMERO_MANAGED_REPO), as the files are linked into the repository instead
+    of being copied. Otherwise (or if the repository isn't accessible) the
+    file is uploaded as usual.
 
     Parameters
     ==========
-    conn : omero.gateway.BlitzGateway
-    image_id: str - an OMERO object ID of an image (e.g. '102')
-    dest: str - destination filename
+    image_file: str - the local image file including the full path
 
     Returns
     =======
-    True in case the download was successful, False otherwise.
+    str - the transfer mode for "omero import --transfer", None for a regular
+    upload
     """
+    if IMPORT_TRANSFER is None or MANAGED_REPO is None:
+        return None
     try:
-        import Image
-        import StringIO
-    except ImportError:
-        return False
-    image_obj = conn.getObject("Image", image_id)
-    image_data = image_obj.getThumbnail()
-    thumbnail = Image.open(StringIO.StringIO(image_data))
-    base_dir, fname = os.path.split(dest)
-    target = "/hrm_previews/" + fname + ".preview_xy.jpg"
-    try:
-        thumbnail.save(base_dir + target)
-        # TODO: os.chown() to fix permissions, see #457!
-        print("Thumbnail downloaded to '%s'." % target)
-        return True
-    except:
-        print("ERROR downloading thumbnail to '%s'." % target)
-        return False
-
-
-def hrm_to_omero(conn, id_str, image_file):
-    """Upload an image into a specific dataset in OMERO.
+        if os.stat(image_file).st_dev != os.stat(MANAGED_REPO).st_dev:
+            return None
+    except OSError:
+        return None
+    return IMPORT_TRANSFER
 
-    In case we know from the suffix that a given file format is not supported
-    by OMERO, the upload will not be initiated at all (e.g. for SVI-HDF5,
-    having the suffix '.h5').
 
-    The import itself is done by instantiating the CLI class, assembling the
-    required arguments, and finally running cli.invoke(). This eventually
-    triggers the importer() method defined in OMERO's Python bindings in
-    <OMERO.server/lib/python/omero/plugins/import.py>, respectively (source)
-    <openmicroscopy.git/components/tools/OmeroPy/src/omero/plugins/import.py>.
+def gen_import_args(id_str, image_file, transfer=None):
+    """Assemble the CLI arguments for importing an image into a dataset.
 
     Parameters
     ==========
     id_str: str - the ID of the target dataset in OMERO (e.g. "G:7:Dataset:23")
     image_file: str - the local image file including the full path
+    transfer: str - (optional) the transfer mode for an in-place import, see
+              inplace_transfer()
 
     Returns
     =======
-    True in case of success, False otherwise.
+    list(str) - the arguments for cli.invoke(), None in case the file format
+    is known to be not supported by OMERO.
     """
     if image_file.lower().endswith(('.h5', '.hdf5')):
-        print 'ERROR: HDF5 files are not supported by OMERO!'
-        return False
+        return None
     # TODO I: group switching required!!
     _, gid, obj_type, dset_id = id_str.split(':')
     # we have to create the annotations *before* we actually upload the image
@@ -383,7 +2295,8 @@ def hrm_to_omero(conn, id_str, image_file):
     # extract the image basename without suffix:
     # TODO: is it [0-9a-f] or really [0-9a-z] as in the original PHP code?
     basename = re.sub(r'(_[0-9a-f]{13}_hrm)\..*', r'\1', image_file)
-    comment = gen_parameter_summary(basename + '.parameters.txt')
+    with METRICS.phase('parameter_summary'):
+        comment = gen_parameter_summary(basename + '.parameters.txt')
     #### annotations = []
     #### # TODO: the list of suffixes should not be hardcoded here!
     #### for suffix in ['.hgsb', '.log.txt', '.parameters.txt']:
@@ -392,16 +2305,10 @@ def hrm_to_omero(conn, id_str, image_file):
     ####     ann = conn.createFileAnnfromLocalFile(
     ####         basename + suffix, mimetype=mime, ns=namespace, desc=None)
     ####     annotations.append(ann.getId())
-    # currently there is no direct "Python way" to import data into OMERO, so
-    # we have to use the CLI wrapper for this:
-    from omero.cli import CLI
-    cli = CLI()
-    cli.loadplugins()
-    # NOTE: cli._client should be replaced with cli.set_client() when switching
-    # to support for OMERO 5.1 and later only:
-    cli._client = conn.c
     import_args = ["import"]
     import_args.extend(['-d', dset_id])
+    if transfer is not None:
+        import_args.extend(['--transfer', transfer])
     if comment is not None:
         import_args.extend(['--annotation_ns', namespace])
         import_args.extend(['--annotation_text', comment])
@@ -409,13 +2316,7 @@ def hrm_to_omero(conn, id_str, image_file):
     ####     import_args.extend(['--annotation_link', str(ann_id)])
     import_args.append(image_file)
     # print("import_args: " + str(import_args))
-    try:
-        cli.invoke(import_args, strict=True)
-    except:
-        print('ERROR: uploading "%s" to %s failed!' % (image_file, id_str))
-        # print(import_args)
-        return False
-    return True
+    return import_args
 
 
 def gen_parameter_summary(fname):
@@ -436,43 +2337,79 @@ def gen_parameter_summary(fname):
     | parameter | channel | (ignored) | value |
     -------------------------------------------
 
+    The summary is parsed by a streaming parser not requiring any additional
+    packages, and memoized by filename and modification time, so the summary
+    shared by all results of a job is parsed only once (see ome_hrm_summary).
+
     Parameters
     ==========
     fname : str - the filename of the HTML parameter summary
 
     Returns
     =======
-    str - the formatted string containing the parameter summary
+    str - the formatted string containing the parameter summary, None if the
+    file can't be read
     """
-    try:
-        from bs4 import BeautifulSoup
-    except ImportError:
-        try:
-            from BeautifulSoup import BeautifulSoup
-        except ImportError:
-            return """This file was imported via the HRM-OMERO connector.
-                   For a parameter summary, the 'BeautifulSoup' package for
-                   Python is required at import time on the HRM system.
-                   """
-    try:
-        soup = BeautifulSoup(open(fname, 'r'))
-    except IOError:
-        return None
-    summary = ''
-    for table in soup.findAll('table'):
-        rows = table.findAll('tr')
-        # the table header:
-        summary += "%s\n" % rows[0].findAll('td')[0].text
-        summary += "==============================\n"
-        # and the table body:
-        for row in rows[2:]:
-            cols = row.findAll('td')
-            summary += "%s [Ch: %s]: %s\n" % (
-                cols[0].text.replace('&mu;m', 'um').replace(u'\u03bc', 'u'),
-                cols[1].text,
-                cols[3].text)
-        summary += '\n'
-    return summary
+    import ome_hrm_summary
+    return ome_hrm_summary.parameter_summary(fname)
+
+
+def enqueue_transfer(args, items, options):
+    """Add a batch transfer to the queue run by the transfer worker.
+
+    The job gets an OMERO session of its own that is left open for the worker
+    (see ome_hrm_worker.py) to join, so the password doesn't need to be
+    stored. The ID of the new job is printed as JSON, e.g. {"job": 42}.
+
+    Parameters
+    ==========
+    args : argparse.Namespace - the parsed commandline arguments
+    items : list(dict) - the transfer items, see new_transfer_item()
+    options : dict - the options of the transfer action (keyword arguments of
+              omero_to_hrm_batch() respectively hrm_to_omero_batch())
+
+    Returns
+    =======
+    True in case the job was added to the queue, False otherwise.
+    """
+    queue = open_transfer_queue()
+    if queue is None:
+        print("ERROR: the transfer queue is not available.")
+        return False
+    conn = omero_login(args.user, args.password, HOST, PORT)
+    if not conn.isConnected():
+        print("ERROR logging into OMERO.")
+        return False
+    session = conn.c.getSessionId()
+    omero_logout(conn, keep_session=True)
+    job_id = queue.enqueue(args.user, session, args.action, items, options)
+    queue.close()
+    print(json.dumps({'job': job_id}))
+    return True
+
+
+def print_transfer_status(job_id, user):
+    """Print the state and progress of a queued transfer as JSON.
+
+    Parameters
+    ==========
+    job_id : int - the ID of the job, see enqueue_transfer()
+    user : str - the OMERO user name (jobs of other users are not shown)
+
+    Returns
+    =======
+    True in case the job was found, False otherwise.
+    """
+    queue = open_transfer_queue()
+    job = None
+    if queue is not None:
+        job = queue.status(job_id, user)
+        queue.close()
+    if job is None:
+        print("ERROR: no transfer job with ID %s found." % job_id)
+        return False
+    print(tree_to_json(job))
+    return True
 
 
 def bool_to_exitstatus(value):
@@ -489,8 +2426,13 @@ def bool_to_exitstatus(value):
         return value
 
 
-def parse_arguments():
-    """Parse the commandline arguments."""
+def parse_arguments(argv=None):
+    """Parse the commandline arguments.
+
+    Parameters
+    ==========
+    argv : list(str) - the arguments to parse, defaults to sys.argv[1:]
+    """
     argparser = argparse.ArgumentParser(
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter
@@ -498,6 +2440,16 @@ def parse_arguments():
     argparser.add_argument(
         '-v', '--verbose', dest='verbosity', action='count', default=0,
         help='verbose messages (repeat for more details)')
+    argparser.add_argument(
+        '--startup-timing', dest='startup_timing', action='store_true',
+        help='report the time spent in the startup phases on stderr')
+    argparser.add_argument(
+        '--metrics', type=str, default=METRICS_FILE,
+        help='file to append the performance metrics (JSON records) to '
+        '(default: %(default)s)')
+    argparser.add_argument(
+        '--profile', type=str,
+        help='file to write cProfile statistics of the whole run to')
 
     # required arguments group
     req_args = argparser.add_argument_group(
@@ -515,6 +2467,26 @@ def parse_arguments():
     subparsers.add_parser(
         'checkCredentials', help='check if login credentials are valid')
 
+    # transferStatus parser
+    parser_status = subparsers.add_parser(
+        'transferStatus',
+        help='get the state and progress of a queued transfer (JSON)')
+    parser_status.add_argument(
+        '--job', type=int, required=True,
+        help='the ID of the transfer job, as returned when queueing it')
+
+    # search parser
+    parser_search = subparsers.add_parser(
+        'search',
+        help='find projects, datasets and images by their names (JSON)')
+    parser_search.add_argument(
+        '-q', '--query', type=str, required=True,
+        help='the words to search for, matching any part of the names, '
+        'ignoring the case (e.g. "img 42" finds "img_00042.tif")')
+    parser_search.add_argument(
+        '--limit', type=int, default=100,
+        help='maximum number of results (default: %(default)s)')
+
     # retrieveChildren parser
     parser_subtree = subparsers.add_parser(
         'retrieveChildren',
@@ -522,25 +2494,63 @@ def parse_arguments():
     parser_subtree.add_argument(
         '--id', type=str, required=True,
         help='ID string of the object to get the children for, e.g. "User:23"')
+    parser_subtree.add_argument(
+        '--offset', type=int, default=0,
+        help='number of children to skip (default: %(default)s)')
+    parser_subtree.add_argument(
+        '--limit', type=int, default=TREE_PAGE_SIZE,
+        help='maximum number of children to return, 0 for all of them '
+        '(default: %(default)s)')
+    parser_subtree.add_argument(
+        '--refresh', action='store_true',
+        help='request the children from OMERO even if they are cached (e.g. '
+        'after the tree has been reloaded in the HRM)')
 
     # OMEROtoHRM parser
     parser_o2h = subparsers.add_parser(
         'OMEROtoHRM', help='download an image from the OMERO server')
     parser_o2h.add_argument(
-        '-i', '--imageid', required=True,
-        help='the OMERO ID of the image to download, e.g. "Image:42"')
+        '-i', '--imageid',
+        help='the OMERO ID of the image to download, e.g. "G:23:Image:42", '
+        'or of a dataset or project to download all of its images')
     parser_o2h.add_argument(
-        '-d', '--dest', type=str, required=True,
+        '-d', '--dest', type=str,
         help='the destination directory where to put the downloaded file')
+    parser_o2h.add_argument(
+        '-c', '--chunk-size', type=int, dest='chunk_size', default=CHUNK_SIZE,
+        help='number of bytes to request from OMERO at once '
+        '(default: %(default)s)')
+    parser_o2h.add_argument(
+        '-s', '--streams', type=int, default=DOWNLOAD_STREAMS,
+        help='number of parallel streams for downloading files larger than '
+        'a single chunk (default: %(default)s)')
+    subvol_args = parser_o2h.add_argument_group(
+        'sub-volume selection',
+        'download only a part of the image(s), exported as OME-TIFF; indices '
+        'are zero-based, given as a list of numbers and ranges, e.g. "0,2-4"')
+    subvol_args.add_argument(
+        '--channels', type=parse_indices,
+        help='the channels to download')
+    subvol_args.add_argument(
+        '--zslices', type=parse_indices,
+        help='the Z slices to download')
+    subvol_args.add_argument(
+        '--timepoints', type=parse_indices,
+        help='the timepoints to download')
+    subvol_args.add_argument(
+        '--crop', type=parse_crop, metavar='X,Y,W,H',
+        help='the region of the XY plane to download')
+    add_batch_arguments(
+        parser_o2h, 'images ("id") to download and their destination ("dest")')
 
     # HRMtoOMERO parser
     parser_h2o = subparsers.add_parser(
         'HRMtoOMERO', help='upload an image to the OMERO server')
     parser_h2o.add_argument(
-        '-d', '--dset', required=True, dest='dset',
+        '-d', '--dset', dest='dset',
         help='the ID of the target dataset in OMERO, e.g. "Dataset:23"')
     parser_h2o.add_argument(
-        '-f', '--file', type=str, required=True,
+        '-f', '--file', type=str,
         help='the image file to upload, including the full path')
     parser_h2o.add_argument(
         '-n', '--name', type=str, required=False,
@@ -548,32 +2558,242 @@ def parse_arguments():
     parser_h2o.add_argument(
         '-a', '--ann', type=str, required=False,
         help='annotation text to be added to the image in OMERO')
+    parser_h2o.add_argument(
+        '--dedup', choices=['off', 'skip', 'link'], default=UPLOAD_DEDUP,
+        help='how to deal with files already existing in OMERO: import them '
+        'anyway, skip them or link the existing image into the dataset '
+        '(default: %(default)s)')
+    parser_h2o.add_argument(
+        '--dedup-scope', choices=['dataset', 'group'], dest='dedup_scope',
+        default=UPLOAD_DEDUP_SCOPE,
+        help='where to look for existing files: in the target dataset only or '
+        'in its whole group (default: %(default)s)')
+    add_batch_arguments(
+        parser_h2o, 'target datasets ("id") and the files ("file") to upload')
 
     try:
-        return argparser.parse_args()
+        args = argparser.parse_args(argv)
     except IOError as err:
         argparser.error(str(err))
+    if args.action == 'OMEROtoHRM' and args.manifest is None:
+        if args.imageid is None or args.dest is None:
+            argparser.error('either --manifest or --imageid and --dest '
+                            'are required for OMEROtoHRM')
+    if args.action == 'HRMtoOMERO' and args.manifest is None:
+        if args.dset is None or args.file is None:
+            argparser.error('either --manifest or --dset and --file '
+                            'are required for HRMtoOMERO')
+    if getattr(args, 'queue', False) and args.manifest is None:
+        argparser.error('--queue requires --manifest')
+    if getattr(args, 'queue', False) and args.events:
+        argparser.error('--events can not be combined with --queue')
+    return args
+
+
+def parse_indices(value):
+    """Parse a list of zero-based indices and ranges, e.g. "0,2-4"."""
+    indices = []
+    try:
+        for part in value.split(','):
+            first, _, last = part.partition('-')
+            indices.extend(range(int(first), int(last or first) + 1))
+    except ValueError:
+        indices = []
+    if not indices:
+        raise argparse.ArgumentTypeError("invalid list of indices: %s" % value)
+    return sorted(set(indices))
+
+
+def parse_crop(value):
+    """Parse a region of the XY plane given as "X,Y,W,H"."""
+    try:
+        crop = [int(num) for num in value.split(',')]
+    except ValueError:
+        crop = []
+    if len(crop) != 4 or min(crop) < 0 or min(crop[2:]) < 1:
+        raise argparse.ArgumentTypeError("invalid crop region: %s" % value)
+    return crop
 
 
-def main():
-    """Parse commandline arguments and initiate the requested tasks."""
-    args = parse_arguments()
+def subvolume_from_args(args):
+    """Assemble the sub-volume selected by the commandline arguments.
 
-    conn = omero_login(args.user, args.password, HOST, PORT)
+    Returns
+    =======
+    dict - the selection (see ome_hrm_transfer.select_subvolume()), None if
+    the whole image is requested
+    """
+    subvolume = dict()
+    for key, arg in (('c', 'channels'), ('z', 'zslices'),
+                     ('t', 'timepoints'), ('crop', 'crop')):
+        if getattr(args, arg) is not None:
+            subvolume[key] = getattr(args, arg)
+    return subvolume or None
+
+
+def add_batch_arguments(parser, manifest_help):
+    """Add the arguments for running a transfer action in batch mode."""
+    parser.add_argument(
+        '-m', '--manifest', type=str,
+        help='JSON file with a list of objects describing the ' +
+        manifest_help + ' (batch mode)')
+    parser.add_argument(
+        '-r', '--report', type=str,
+        help='file to write the JSON report with the per-item results to '
+        '(batch mode)')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=TRANSFER_JOBS,
+        help='number of parallel transfers (batch mode, default: %(default)s)')
+    parser.add_argument(
+        '-q', '--queue', action='store_true',
+        help='add the transfer to the queue of the transfer worker and return '
+        'immediately, printing the ID of the job (batch mode)')
+    parser.add_argument(
+        '-e', '--events', action='store_true',
+        help='report the progress as newline-delimited JSON events on stdout '
+        'while transferring, the messages are printed to stderr then')
+
+
+def run_action(conn, args):
+    """Run the action requested in the parsed arguments.
 
-    # TODO: implement requesting groups via cmdline option
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    args : argparse.Namespace - the parsed commandline arguments
 
+    Returns
+    =======
+    The result of the requested action, usually a bool.
+    """
+    # TODO: implement requesting groups via cmdline option
     if args.action == 'checkCredentials':
         return check_credentials(conn)
+    elif args.action == 'search':
+        return search_objects(conn, args.query, args.user, args.limit)
+    elif args.action == 'transferStatus':
+        # the queue is kept locally, but the user still has to authenticate:
+        if not conn.isConnected():
+            print("ERROR logging into OMERO.")
+            return False
+        return print_transfer_status(args.job, args.user)
     elif args.action == 'retrieveChildren':
-        return print_children_json(conn, args.id)
+        id_str = args.id
+        if args.offset:
+            id_str = '%s:%s' % (id_str, args.offset)
+        cache = open_tree_cache()
+        try:
+            return print_children_json(conn, id_str, cache, args.user,
+                                       args.limit, args.refresh)
+        finally:
+            if cache is not None:
+                cache.close()
     elif args.action == 'OMEROtoHRM':
-        return omero_to_hrm(conn, args.imageid, args.dest)
+        subvolume = subvolume_from_args(args)
+        if args.manifest is not None:
+            items = read_manifest(args.manifest, 'dest')
+        elif args.events:
+            items = [new_transfer_item(args.imageid, dest=args.dest)]
+        else:
+            return omero_to_hrm(conn, args.imageid, args.dest,
+                                args.chunk_size, args.streams, subvolume)
+        if subvolume is not None:
+            # the selection applies to all items not having their own one:
+            for item in items:
+                item.setdefault('subvolume', subvolume)
+        if args.queue:
+            return enqueue_transfer(args, items, {
+                'jobs': args.jobs, 'chunk_size': args.chunk_size,
+                'streams': args.streams})
+        success = omero_to_hrm_batch(conn, items, args.jobs, args.chunk_size,
+                                     args.streams, events=open_events(args))
+        print_report(items, args.report)
+        return success
     elif args.action == 'HRMtoOMERO':
-        return hrm_to_omero(conn, args.dset, args.file)
+        if args.manifest is not None:
+            items = read_manifest(args.manifest, 'file')
+        elif args.events:
+            items = [new_transfer_item(args.dset, file=args.file)]
+        else:
+            items = None
+        if items is not None and args.queue:
+            return enqueue_transfer(args, items, {
+                'jobs': args.jobs, 'dedup': args.dedup,
+                'scope': args.dedup_scope})
+        # closed again right away, the daemon runs many actions per process:
+        cache = open_tree_cache()
+        try:
+            if items is None:
+                return hrm_to_omero(conn, args.dset, args.file, cache,
+                                    args.dedup, args.dedup_scope)
+            success = hrm_to_omero_batch(conn, items, args.jobs, cache,
+                                         args.dedup, args.dedup_scope,
+                                         events=open_events(args))
+        finally:
+            if cache is not None:
+                cache.close()
+        print_report(items, args.report)
+        return success
     else:
         raise Exception('Huh, how could this happen?!')
 
 
+def main():
+    """Parse commandline arguments and initiate the requested tasks."""
+    args = parse_arguments()
+    STARTUP_TIMES.append(('arguments', time.time()))
+    METRICS.fname = args.metrics
+    METRICS.context.update(user=args.user, action=args.action)
+    if args.profile is None:
+        return connect_and_run(args)
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(connect_and_run, args)
+    finally:
+        profiler.dump_stats(args.profile)
+
+
+def connect_and_run(args):
+    """Connect to OMERO and run the requested action.
+
+    Parameters
+    ==========
+    args : argparse.Namespace - the parsed commandline arguments
+
+    Returns
+    =======
+    The result of the requested action, see run_action().
+    """
+    sessions = None
+    if SESSION_IDLE > 0:
+        sessions = SessionStore(os.path.join(CONNECTOR_DIR, 'sessions'),
+                                '%s:%s' % (HOST, PORT), SESSION_IDLE)
+    # checking the credentials always requires a real login:
+    reuse = args.action != 'checkCredentials'
+    conn = omero_login(args.user, args.password, HOST, PORT, sessions, reuse)
+    connected = conn.isConnected()
+    STARTUP_TIMES.append(('login', time.time()))
+    success = False
+    try:
+        result = run_action(conn, args)
+        success = result is True
+        return result
+    finally:
+        # a failed login must not extend the record of an earlier one:
+        keep_session = connected and sessions is not None and sessions.usable
+        if keep_session:
+            sessions.touch(args.user)
+        omero_logout(conn, keep_session)
+        STARTUP_TIMES.append(('action', time.time()))
+        if METRICS.enabled:
+            for phase, seconds in startup_phases():
+                METRICS.record('phase', phase, seconds=seconds)
+            METRICS.record('request', args.action, success=success,
+                           seconds=time.time() - STARTUP_TIMES[0][1])
+        if args.startup_timing:
+            print_startup_timing()
+
+
 if __name__ == "__main__":
     sys.exit(bool_to_exitstatus(main()))
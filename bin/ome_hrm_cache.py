@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""Helper module providing a shared cache for the OMERO tree nodes.
+
+The child nodes generated for the tree in the HRM web interface are stored in
+an SQLite database, so they can be shared by all connector processes (and HRM
+sessions) instead of being re-requested from the OMERO server over and over.
+
+Entries are keyed by the node ID (e.g. "G:23:Dataset:42", respectively
+"G:23:Dataset:42:1000" for further pages of its children) and the OMERO user
+they were generated for, as the visible children depend on the permissions of
+the user. They expire after a configurable time, and the least recently used
+entries are evicted once the cache exceeds its maximum size. Nodes whose
+children are known to have changed (e.g. a dataset after uploading an image)
+can be invalidated explicitly for all users.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import json
+import sqlite3
+import time
+
+
+class TreeCache(object):
+
+    """An SQLite based cache for lists of child nodes with TTL and LRU.
+
+    Parameters
+    ==========
+    path : str - the database file
+    ttl : int - seconds after which an entry expires
+    max_entries : int - the maximum number of entries to keep
+    """
+
+    def __init__(self, path, ttl=300, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS nodes ("
+            "  user TEXT NOT NULL,"
+            "  node TEXT NOT NULL,"
+            "  children TEXT NOT NULL,"
+            "  created REAL NOT NULL,"
+            "  accessed REAL NOT NULL,"
+            "  PRIMARY KEY (user, node))")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS nodes_node ON nodes (node)")
+        self._db.commit()
+
+    def get(self, user, node):
+        """Get the cached children of a node.
+
+        Returns
+        =======
+        list - the child node dicts, None if not cached or expired
+        """
+        now = time.time()
+        with self._db:
+            row = self._db.execute(
+                "SELECT children FROM nodes WHERE user = ? AND node = ? "
+                "AND created > ?", (user, node, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE nodes SET accessed = ? WHERE user = ? AND node = ?",
+                (now, user, node))
+        return json.loads(row[0])
+
+    def put(self, user, node, children):
+        """Store the children of a node, evicting old entries if necessary."""
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?)",
+                (user, node, json.dumps(children), now, now))
+            self._db.execute(
+                "DELETE FROM nodes WHERE created <= ?", (now - self.ttl,))
+            self._db.execute(
+                "DELETE FROM nodes WHERE rowid IN (SELECT rowid FROM nodes "
+                "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+
+    def invalidate(self, node):
+        """Remove the entries of a node (including all pages) for all users."""
+        with self._db:
+            self._db.execute("DELETE FROM nodes WHERE node = ? OR node LIKE ?",
+                             (node, node + ':%'))
+
+    def close(self):
+        """Close the database connection."""
+        self._db.close()
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
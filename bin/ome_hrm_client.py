@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""Thin client for the OMERO connector daemon of the HRM.
+
+Accepts exactly the same arguments as the OMERO connector (ome_hrm.py) and
+forwards them to the connector daemon (ome_hrm_daemon.py) listening on the
+Unix socket configured as OMERO_CONNECTOR_SOCKET in the HRM config file. The
+output and the exit status of the request are passed on unchanged, so callers
+can't tell the difference.
+
+In case no socket is configured, the daemon can't be reached or the arguments
+can't be passed on to it (not being valid UTF-8), the connector itself is run
+instead.
+"""
+
+import sys
+import os
+import json
+import socket
+
+import hrm_config
+
+
+CONNECTOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'ome_hrm.py')
+
+
+def run_connector(argv):
+    """Replace the current process by the connector itself."""
+    os.execv(sys.executable, [sys.executable, CONNECTOR] + argv)
+
+
+def connect_daemon(path):
+    """Connect to the daemon socket, return None if it's not available."""
+    if not path:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def encode_request(argv):
+    """Encode the arguments as a request line for the daemon.
+
+    Returns
+    =======
+    str - the JSON encoded request, None if the arguments can't be sent to
+    the daemon (as they aren't valid UTF-8, e.g. filenames in a different
+    encoding)
+    """
+    try:
+        return json.dumps({'argv': argv}) + '\n'
+    except UnicodeDecodeError:
+        return None
+
+
+def forward_request(sock, request):
+    """Send a request to the daemon and relay its replies.
+
+    Parameters
+    ==========
+    sock : socket - the connection to the daemon
+    request : str - the request line, see encode_request()
+
+    Returns
+    =======
+    int - the exit status reported by the daemon
+    """
+    sock.sendall(request)
+    replies = sock.makefile('r')
+    for line in replies:
+        reply = json.loads(line)
+        if 'out' in reply:
+            sys.stdout.write(reply['out'].encode('utf-8'))
+            sys.stdout.flush()
+        elif 'err' in reply:
+            sys.stderr.write(reply['err'].encode('utf-8'))
+        elif 'exit' in reply:
+            return reply['exit']
+    sys.stderr.write('ERROR: connection to the OMERO connector daemon lost.\n')
+    return 1
+
+
+def main():
+    """Forward the request to the daemon or fall back to the connector."""
+    argv = sys.argv[1:]
+    request = encode_request(argv)
+    if request is None:
+        run_connector(argv)
+    sock = connect_daemon(hrm_config.CONFIG.get('OMERO_CONNECTOR_SOCKET'))
+    if sock is None:
+        run_connector(argv)
+    try:
+        return forward_request(sock, request)
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+
+"""OMERO connector daemon for the Huygens Remote Manager (HRM).
+
+Running the connector (ome_hrm.py) as a separate process for every request
+means paying for parsing the config, importing the OMERO Python bindings and
+establishing a new (TLS) session with the OMERO server each and every time.
+This daemon does all of that once and then serves the connector actions
+(checkCredentials, retrieveChildren, OMEROtoHRM, HRMtoOMERO) on a local Unix
+socket, keeping a pool of authenticated BlitzGateway connections (a few per
+OMERO user, so a long transfer doesn't hold up the other requests of the
+user) that are closed again after being idle for a while. Only
+checkCredentials always does a login of its own, so the credentials are
+really checked by the OMERO server.
+
+The daemon is meant to be used through the thin client (ome_hrm_client.py)
+which accepts exactly the same arguments as the connector itself, so the HRM
+web interface can keep calling it via exec().
+
+The socket path is taken from the OMERO_CONNECTOR_SOCKET setting in the HRM
+config file unless given on the commandline.
+"""
+
+# pylint: disable=superfluous-parens
+
+import sys
+import os
+import argparse
+import hashlib
+import hmac
+import json
+import signal
+import socket
+import SocketServer
+import threading
+import time
+
+import ome_hrm
+import hrm_config
+
+
+def password_digest(key, passwd):
+    """Calculate a keyed digest of a password for comparing it later.
+
+    Parameters
+    ==========
+    key : str - the (process specific, random) key to use for the HMAC
+    passwd : str - the password
+
+    Returns
+    =======
+    str - the hex digest of the password
+    """
+    return hmac.new(key, passwd, hashlib.sha256).hexdigest()
+
+
+class PoolEntry(object):
+
+    """A pooled connection together with its bookkeeping data."""
+
+    def __init__(self, conn, digest):
+        self.conn = conn
+        self.digest = digest
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        # set if the connection has to be closed once it isn't used anymore:
+        self.stale = False
+
+
+class SessionPool(object):
+
+    """A pool of authenticated BlitzGateway connections keyed by user name.
+
+    Every user gets up to 'per_user' connections, so a long running request
+    (e.g. a transfer of several GB) occupies one of them only, while further
+    requests of the same user (browsing the tree, thumbnails) are served on
+    another one. Connections are checked to be still alive before being
+    handed out and closed once they have been idle for longer than 'max_idle'
+    seconds. If the pool reaches 'max_size' connections, the least recently
+    used (idle) ones get evicted. The password supplied with a request always
+    has to match the one used to establish the pooled connection, otherwise a
+    new login is performed (and the connections of the old password are
+    dropped on success).
+    """
+
+    def __init__(self, host, port, max_idle=600, max_size=100, per_user=4):
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.max_size = max_size
+        self.per_user = per_user
+        self._key = os.urandom(32)
+        self._entries = dict()
+        self._lock = threading.Lock()
+
+    def acquire(self, user, passwd):
+        """Get a connection for the given user, locked for exclusive use.
+
+        A free connection of the user is handed out if there is one, a new one
+        is established otherwise, unless the user has 'per_user' connections
+        already (then the least recently used one is waited for).
+
+        Returns
+        =======
+        entry : PoolEntry - the (locked) pool entry, None if the login failed.
+        The caller is required to hand it back using release().
+        """
+        digest = password_digest(self._key, passwd)
+        with self._lock:
+            entries = [entry for entry in self._entries.get(user, [])
+                       if hmac.compare_digest(entry.digest, digest)]
+        for entry in entries:
+            if entry.lock.acquire(False):
+                if self._usable(user, entry):
+                    return entry
+        if len(entries) >= self.per_user:
+            entry = min(entries, key=lambda entry: entry.last_used)
+            entry.lock.acquire()
+            if self._usable(user, entry):
+                return entry
+        conn = ome_hrm.omero_login(user, passwd, self.host, self.port)
+        if not conn.isConnected():
+            return None
+        entry = PoolEntry(conn, digest)
+        entry.lock.acquire()
+        with self._lock:
+            entries = self._entries.get(user, [])
+            old = [other for other in entries if other.digest != digest]
+            self._entries[user] = [other for other in entries
+                                   if other.digest == digest] + [entry]
+        for other in old:
+            self._retire(other)
+        self.evict()
+        return entry
+
+    def _usable(self, user, entry):
+        """Check a locked entry, dropping it from the pool if it is dead."""
+        if not entry.stale and self._is_alive(entry.conn):
+            entry.last_used = time.time()
+            return True
+        self._remove(user, entry)
+        self._close(entry, locked=True)
+        return False
+
+    def _remove(self, user, entry):
+        """Remove an entry from the pool (without closing it)."""
+        with self._lock:
+            entries = self._entries.get(user, [])
+            if entry in entries:
+                entries.remove(entry)
+            if not entries:
+                self._entries.pop(user, None)
+
+    def discard(self, user):
+        """Close the pooled connections of a user (if any)."""
+        with self._lock:
+            entries = self._entries.pop(user, [])
+        for entry in entries:
+            self._retire(entry)
+
+    def release(self, entry):
+        """Hand back a connection that was obtained from acquire()."""
+        entry.last_used = time.time()
+        if entry.stale:
+            self._close(entry, locked=True)
+        else:
+            entry.lock.release()
+
+    def evict(self):
+        """Close connections being idle for too long or exceeding max_size."""
+        now = time.time()
+        with self._lock:
+            pooled = sorted([(entry.last_used, user, entry)
+                             for user, entries in self._entries.items()
+                             for entry in entries], key=lambda x: x[0])
+            total = len(pooled)
+            expired = []
+            for last_used, user, entry in pooled:
+                if now - last_used > self.max_idle or total > self.max_size:
+                    # never close a connection that is in use right now:
+                    if entry.lock.acquire(False):
+                        expired.append(entry)
+                        self._entries[user].remove(entry)
+                        if not self._entries[user]:
+                            del self._entries[user]
+                        total -= 1
+        for entry in expired:
+            self._close(entry, locked=True)
+        return len(expired)
+
+    def close_all(self):
+        """Close all pooled connections."""
+        with self._lock:
+            entries = [entry for user_entries in self._entries.values()
+                       for entry in user_entries]
+            self._entries = dict()
+        for entry in entries:
+            self._close(entry)
+
+    @staticmethod
+    def _is_alive(conn):
+        """Check if a pooled connection can still be used."""
+        try:
+            return conn.keepAlive()
+        except Exception:  # pylint: disable=broad-except
+            return False
+
+    @classmethod
+    def _retire(cls, entry):
+        """Close a connection removed from the pool once it is unused."""
+        entry.stale = True
+        if entry.lock.acquire(False):
+            cls._close(entry, locked=True)
+
+    @staticmethod
+    def _close(entry, locked=False):
+        """Close the connection of a pool entry, waiting for it to be unused."""
+        if not locked:
+            entry.lock.acquire()
+        try:
+            entry.conn.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
+        finally:
+            entry.lock.release()
+
+
+class SinkFile(object):
+
+    """A file-like object handing everything written to a sink callable."""
+
+    def __init__(self, sink):
+        self._sink = sink
+
+    def write(self, text):
+        """Hand text to the sink."""
+        self._sink(text)
+
+    def flush(self):
+        """Nothing to flush, the sink sends every text right away."""
+        pass
+
+
+class ThreadLocalStream(object):
+
+    """A file-like object dispatching writes to a per-thread sink.
+
+    Threads that registered a sink callable get their output handed to it,
+    all others write to the original stream (e.g. sys.stdout).
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def set_sink(self, sink):
+        """Register the sink for the current thread (None to unregister)."""
+        self._local.sink = sink
+
+    def reserve(self, other):
+        """Reserve the sink of the current thread for a single writer.
+
+        Any other output of the thread goes to its sink of 'other' (e.g. the
+        stream of stderr) instead. This is the per-thread equivalent of
+        ome_hrm_events.redirect_stdout(), which would affect all threads.
+
+        Returns
+        =======
+        file - writing to the reserved sink (from any thread), the original
+        stream if the current thread hasn't registered a sink
+        """
+        sink = getattr(self._local, 'sink', None)
+        if sink is None:
+            return self._stream
+        self._local.sink = getattr(other._local, 'sink', None) or other.write
+        return SinkFile(sink)
+
+    def write(self, text):
+        """Write text to the sink of the current thread or the stream."""
+        sink = getattr(self._local, 'sink', None)
+        if sink is None:
+            self._stream.write(text)
+        else:
+            sink(text)
+
+    def flush(self):
+        """Flush the underlying stream."""
+        if getattr(self._local, 'sink', None) is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class ConnectorRequestHandler(SocketServer.StreamRequestHandler):
+
+    """Run a single connector request received on the socket.
+
+    The client sends one JSON encoded line of the form {"argv": [...]}, where
+    the list contains the very same arguments as given to ome_hrm.py. The
+    output of the action is sent back as a sequence of JSON lines of the form
+    {"out": "..."} (stdout) or {"err": "..."} (stderr), terminated by a line
+    {"exit": <int>} containing the exit status.
+    """
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        # transfer events are sent from the threads of the transfers:
+        self._lock = threading.Lock()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            argv = [arg.encode('utf-8') for arg in request['argv']]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.send({'err': 'ERROR: invalid request received.\n'})
+            self.send({'exit': 2})
+            return
+        sys.stdout.set_sink(lambda text: self.send({'out': text}))
+        sys.stderr.set_sink(lambda text: self.send({'err': text}))
+        try:
+            status = self.server.run_request(argv)
+        finally:
+            sys.stdout.set_sink(None)
+            sys.stderr.set_sink(None)
+        self.send({'exit': status})
+
+    def send(self, message):
+        """Send a single JSON line to the client."""
+        line = json.dumps(message) + '\n'
+        with self._lock:
+            try:
+                self.wfile.write(line)
+                self.wfile.flush()
+            except socket.error:
+                pass
+
+
+class ConnectorServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+
+    """Unix socket server running connector actions on pooled connections."""
+
+    daemon_threads = True
+
+    def __init__(self, path, pool):
+        self.pool = pool
+        SocketServer.UnixStreamServer.__init__(
+            self, path, ConnectorRequestHandler)
+
+    def run_request(self, argv):
+        """Parse and run a connector request, return the exit status."""
+        try:
+            args = ome_hrm.parse_arguments(argv)
+        except SystemExit as err:
+            return err.code
+        start = time.time()
+        status = 1
+        try:
+            if args.action == 'checkCredentials':
+                status = self.check_credentials(args)
+            else:
+                status = self.run_pooled(args)
+        except SystemExit as err:
+            # the connector exits e.g. if the OMERO bindings can't be imported:
+            if isinstance(err.code, int):
+                status = err.code
+        finally:
+            ome_hrm.METRICS.record('request', args.action, user=args.user,
+                                   success=not status,
+                                   seconds=time.time() - start)
+        return status
+
+    def check_credentials(self, args):
+        """Check the credentials of a request using a new login.
+
+        A pooled connection only proves that the password matches the one
+        used for an earlier login, so the credentials are always checked with
+        the server itself. The pooled connection of the user is dropped if
+        they turn out to be invalid (e.g. as the password has been changed).
+        """
+        conn = ome_hrm.omero_login(args.user, args.password,
+                                   self.pool.host, self.pool.port)
+        try:
+            valid = ome_hrm.check_credentials(conn)
+        except Exception as err:  # pylint: disable=broad-except
+            print('ERROR running "%s": %s' % (args.action, err))
+            valid = False
+        finally:
+            ome_hrm.omero_logout(conn)
+        if not valid:
+            self.pool.discard(args.user)
+        return ome_hrm.bool_to_exitstatus(valid)
+
+    def run_pooled(self, args):
+        """Run a connector request on a pooled connection."""
+        entry = self.pool.acquire(args.user, args.password)
+        if entry is None:
+            print('ERROR logging into OMERO.')
+            return 1
+        try:
+            return ome_hrm.bool_to_exitstatus(
+                ome_hrm.run_action(entry.conn, args))
+        except Exception as err:  # pylint: disable=broad-except
+            print('ERROR running "%s": %s' % (args.action, err))
+            return 1
+        finally:
+            self.pool.release(entry)
+
+
+def evict_periodically(pool, interval):
+    """Run the eviction of idle connections in an endless loop."""
+    while True:
+        time.sleep(interval)
+        pool.evict()
+
+
+def parse_arguments():
+    """Parse the commandline arguments."""
+    argparser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument(
+        '-s', '--socket', type=str,
+        default=hrm_config.CONFIG.get('OMERO_CONNECTOR_SOCKET'),
+        help='path of the Unix socket to listen on')
+    argparser.add_argument(
+        '-i', '--idle-timeout', type=int, dest='idle', default=int(
+            hrm_config.CONFIG.get('OMERO_CONNECTOR_IDLE', 600)),
+        help='seconds after which an unused connection gets closed')
+    argparser.add_argument(
+        '-m', '--max-sessions', type=int, dest='max_sessions', default=100,
+        help='maximum number of pooled connections')
+    argparser.add_argument(
+        '-u', '--user-sessions', type=int, dest='user_sessions', default=4,
+        help='maximum number of pooled connections per user, i.e. requests '
+        'of a user served at the same time (default: %(default)s)')
+    args = argparser.parse_args()
+    if not args.socket:
+        argparser.error('no socket given and OMERO_CONNECTOR_SOCKET is not '
+                        'set in the HRM config file')
+    return args
+
+
+def main():
+    """Set up the connection pool and serve requests until terminated."""
+    args = parse_arguments()
+    # unlike the connector, the daemon needs the OMERO bindings in any case:
+    ome_hrm.import_omero()
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    sys.stdout = ThreadLocalStream(sys.stdout)
+    sys.stderr = ThreadLocalStream(sys.stderr)
+    pool = SessionPool(ome_hrm.HOST, ome_hrm.PORT,
+                       max_idle=args.idle, max_size=args.max_sessions,
+                       per_user=max(1, args.user_sessions))
+    # the socket carries passwords, so restrict it to our own user:
+    old_umask = os.umask(0o177)
+    try:
+        server = ConnectorServer(args.socket, pool)
+    finally:
+        os.umask(old_umask)
+    evictor = threading.Thread(target=evict_periodically,
+                               args=(pool, min(60, args.idle)))
+    evictor.daemon = True
+    evictor.start()
+    # make sure the cleanup below also happens when being stopped by systemd:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        pool.close_all()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
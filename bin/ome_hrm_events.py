@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""Helper module reporting the progress of transfers as a stream of events.
+
+Normally, the transfer actions of the connector only print a few lines once
+the whole batch is finished. With the "--events" option, newline-delimited
+JSON (NDJSON) events are written to stdout while the transfers are running
+instead, one line per event, flushed right away. This way a caller reading
+the output of the connector (e.g. through popen() in PHP) can react to every
+event immediately, e.g. start processing a file as soon as it has been
+downloaded instead of waiting for the whole batch to finish.
+
+Every event is a JSON object with the type of the event as 'event', the time
+it was emitted (seconds since the epoch) as 'time' and the OMERO ID of the
+transfer item it refers to as 'item' (the local file of uploads is given as
+'source' in addition, as all of them may have the same target dataset):
+
+- started:   the transfer of an item begins, 'files' being the local files
+             it will create (downloads) or read (uploads)
+- waiting:   the transfer of 'file' has to wait for a free transfer slot,
+             'active' of 'slots' being in use (see ome_hrm_governor)
+- progress:  'done' of 'total' bytes of 'file' have been transferred (emitted
+             at most every PROGRESS_INTERVAL seconds per file, and once the
+             file is complete)
+- file:      'file' has been transferred completely ('bytes' in total), by
+             the 'method' given (e.g. 'download', 'cache' or 'import', or
+             'skip' respectively 'link' for uploads not imported as the file
+             exists in OMERO already)
+- thumbnail: the preview 'file' of the OMERO image 'image' has been written
+             (having no 'item', as previews may be shared by several items)
+- failed:    the transfer of an item (or only of 'file') failed, explained by
+             'message'
+- finished:  the transfer of an item is done, with its overall 'success' and
+             all of its 'messages'
+
+The stdout of the process (including the one of subprocesses, like the OMERO
+importer) is redirected to stderr for the event stream not to be disturbed by
+any other output, so the human readable messages end up on stderr. The
+connector daemon (ome_hrm_daemon.py) does the same for the output of a single
+request instead, leaving the stdout of the daemon process untouched.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import os
+import json
+import threading
+import time
+
+
+# the minimum interval (in seconds) between progress events of a file:
+PROGRESS_INTERVAL = 0.5
+
+
+def redirect_stdout():
+    """Redirect stdout to stderr, keeping the original stdout for events.
+
+    Returns
+    =======
+    file - the original stdout
+    """
+    sys.stdout.flush()
+    outfile = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    return outfile
+
+
+class EventStream(object):
+
+    """Write transfer events as newline-delimited JSON.
+
+    The methods may be called from several threads, every event is written
+    (and flushed) as a whole.
+
+    Parameters
+    ==========
+    outfile : file - the file to write the events to
+    interval : float - the minimum interval (in seconds) between progress
+               events of a file
+    """
+
+    def __init__(self, outfile, interval=PROGRESS_INTERVAL):
+        self.outfile = outfile
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._reported = dict()
+
+    def emit(self, event, item=None, **fields):
+        """Write a single event.
+
+        Parameters
+        ==========
+        event : str - the type of the event, e.g. 'started'
+        item : dict - (optional) the transfer item the event refers to
+        fields : the details of the event
+        """
+        fields['event'] = event
+        fields['time'] = round(time.time(), 3)
+        if item is not None:
+            fields['item'] = item['id']
+            if 'file' in item:
+                fields['source'] = item['file']
+        line = json.dumps(fields, sort_keys=True, separators=(',', ':'))
+        with self._lock:
+            self.outfile.write(line + '\n')
+            self.outfile.flush()
+
+    def started(self, item, files):
+        """Report the start of the transfer of an item."""
+        self.emit('started', item, files=files)
+
+    def waiting(self, item, fname, active, slots):
+        """Report a file waiting for a free transfer slot."""
+        self.emit('waiting', item, file=fname, active=active, slots=slots)
+
+    def progress(self, item, fname, done, total):
+        """Report the progress of a file (at most every 'interval' seconds).
+
+        The parameters are the ones of the progress callbacks of the batch
+        transfers, e.g. ome_hrm.omero_to_hrm_batch().
+        """
+        now = time.time()
+        with self._lock:
+            if done < total and \
+                    now - self._reported.get(fname, 0) < self.interval:
+                return
+            self._reported[fname] = now
+        self.emit('progress', item, file=fname, done=done, total=total)
+
+    def file_done(self, item, fname, nbytes, method):
+        """Report a file that has been transferred completely."""
+        self.emit('file', item, file=fname, bytes=nbytes, method=method)
+
+    def thumbnail(self, image_id, fname):
+        """Report a preview that has been written."""
+        self.emit('thumbnail', image=long(image_id), file=fname)
+
+    def failed(self, item, message, fname=None):
+        """Report the failure of the transfer of an item or of a file."""
+        if fname is None:
+            self.emit('failed', item, message=message)
+        else:
+            self.emit('failed', item, message=message, file=fname)
+
+    def finished(self, item):
+        """Report the end of the transfer of an item."""
+        self.emit('finished', item, success=bool(item['success']),
+                  messages=item['messages'])
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
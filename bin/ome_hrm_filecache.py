@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+
+"""Helper module for a content-addressed cache of downloaded original files.
+
+Original files downloaded from OMERO are kept in a cache directory shared by
+all HRM users, keyed by their checksum (or by the ID of the OriginalFile if
+OMERO doesn't know the checksum). Requesting the same file again (e.g. when
+several members of a group deconvolve the same acquisition) doesn't transfer
+it from OMERO another time, instead the cached copy is placed at the target
+location as a hardlink, as a reflink (copy-on-write clone, on filesystems
+supporting it) or, if neither is possible, as a regular copy. For the links
+to work, the cache directory has to be located on the same filesystem as the
+HRM data directory.
+
+The mode of the files is left alone, so hardlinked files may be modified in
+place through any of their links (changing the cached file as well). The size
+and the modification time of every cached file are therefore recorded in a
+".stamp" file alongside, and a cached file that doesn't match them anymore is
+dropped from the cache instead of being used. The stamp also records the user
+who added the file: only this user gets hardlinks of it, all other users get
+a reflink or a copy, so the files of different users never share an inode.
+
+The cache is bounded in size, the least recently used files are removed once
+the limit is exceeded (the access time of a cached file is updated whenever
+it is used, leaving its modification time untouched). Files that are still
+linked to a user directory don't use any additional space, the cache just
+drops its reference to them. Note that the cache doesn't check any
+permissions, the key of a file must only be determined using a connection of
+the requesting user (see ome_hrm_transfer.get_file_info()).
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import os
+import errno
+import fcntl
+import shutil
+import threading
+import time
+
+
+# the ioctl request to clone a file on Linux (FICLONE, e.g. btrfs, XFS):
+FICLONE = 0x40049409
+
+# the suffix of the files recording size and modification time of a file:
+STAMP_SUFFIX = '.stamp'
+
+
+def reflink(src, dst):
+    """Create a copy-on-write clone of a file.
+
+    Raises
+    ======
+    IOError - if the filesystem doesn't support cloning files
+    """
+    try:
+        with open(src, 'rb') as infile:
+            with open(dst, 'wb') as outfile:
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+    except (IOError, OSError):
+        if os.path.exists(dst):
+            os.unlink(dst)
+        raise
+
+
+def link_file(src, dst, hardlink=True):
+    """Place a file at a new location using the cheapest possible method.
+
+    A hardlink is tried first (unless disabled), then a reflink and finally
+    the file is copied. The target must not exist yet.
+
+    Parameters
+    ==========
+    src : str - the existing file
+    dst : str - the new file
+    hardlink : bool - False if the new file must not share its content with
+               the existing one, e.g. because it may be modified in place
+
+    Returns
+    =======
+    str - the method used, 'hardlink', 'reflink' or 'copy'
+    """
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError as err:
+            if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK,
+                                 errno.ENOTSUP):
+                raise
+    try:
+        reflink(src, dst)
+        return 'reflink'
+    except (IOError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+class FileCache(object):
+
+    """A size-bounded, content-addressed directory of files with LRU eviction.
+
+    Parameters
+    ==========
+    path : str - the cache directory (has to exist)
+    max_bytes : int - the maximum total size of the cached files
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(ofile_id, checksum=None, algorithm=None):
+        """Assemble the cache key of an original file.
+
+        Parameters
+        ==========
+        ofile_id : int - the ID of the OriginalFile
+        checksum : str - the checksum stored in OMERO (if any)
+        algorithm : str - the checksum algorithm, e.g. 'SHA1-160'
+
+        Returns
+        =======
+        str - the key, the checksum if known, the ID of the file otherwise
+        """
+        if checksum and algorithm:
+            return '%s/%s' % (algorithm, checksum.lower())
+        return 'OriginalFile/%s' % ofile_id
+
+    def _filename(self, key):
+        """Assemble the name of the cache file for a key."""
+        group, name = key.split('/')
+        return os.path.join(self.path, group, name[-2:], name)
+
+    @staticmethod
+    def _stamp(fname):
+        """Read the stamp of a cached file.
+
+        Returns
+        =======
+        (int, float, str) - the recorded size and modification time of the
+        file and the user who added it (None if unknown), None if the stamp is
+        missing or invalid
+        """
+        try:
+            with open(fname + STAMP_SUFFIX, 'r') as infile:
+                fields = infile.read().split()
+            return int(fields[0]), float(fields[1]), (fields[2:] or [None])[0]
+        except (IOError, IndexError, ValueError):
+            return None
+
+    @staticmethod
+    def _unchanged(fname, stamp):
+        """Check if a cached file still matches its recorded stamp."""
+        try:
+            fstat = os.stat(fname)
+        except OSError:
+            return False
+        # utime() may round the modification time to microseconds:
+        return (stamp is not None and fstat.st_size == stamp[0] and
+                abs(fstat.st_mtime - stamp[1]) < 5e-6)
+
+    @staticmethod
+    def _remove(fname):
+        """Remove a cached file together with its stamp."""
+        for name in (fname, fname + STAMP_SUFFIX):
+            try:
+                os.unlink(name)
+            except OSError:
+                pass
+
+    def fetch(self, key, target, user=None):
+        """Place a cached file at the target location.
+
+        Parameters
+        ==========
+        key : str - the key of the file, see key()
+        target : str - the new file
+        user : str - (optional) the user the target belongs to (e.g. the
+               OMERO user ID), the file is hardlinked only if it was added by
+               the same user
+
+        Returns
+        =======
+        str - the method used (see link_file()), None if the file is not in
+        the cache (or has been modified since being added)
+        """
+        fname = self._filename(key)
+        if not os.path.exists(fname):
+            return None
+        stamp = self._stamp(fname)
+        if not self._unchanged(fname, stamp):
+            self._remove(fname)
+            return None
+        try:
+            method = link_file(fname, target,
+                               user is not None and user == stamp[2])
+            # the access time serves as the time of last usage:
+            os.utime(fname, (time.time(), os.stat(fname).st_mtime))
+        except (IOError, OSError):
+            return None
+        return method
+
+    def store(self, key, fname, user=None):
+        """Add a (just downloaded) file to the cache.
+
+        The file is linked into the cache if possible, so it doesn't use any
+        additional space. Its size and modification time are recorded, so
+        modifying it later on invalidates the cached file, as well as the user
+        it belongs to (see fetch()).
+        """
+        cached = self._filename(key)
+        if os.path.exists(cached):
+            return
+        tmpname = '%s.%s.%s.tmp' % (cached, os.getpid(),
+                                    threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(cached)):
+                os.makedirs(os.path.dirname(cached), 0o700)
+        except OSError:
+            pass
+        try:
+            link_file(fname, tmpname)
+            fstat = os.stat(tmpname)
+            with open(tmpname + STAMP_SUFFIX, 'w') as outfile:
+                outfile.write('%d %.6f %s\n' % (fstat.st_size, fstat.st_mtime,
+                                                 user or ''))
+            os.rename(tmpname + STAMP_SUFFIX, cached + STAMP_SUFFIX)
+            os.rename(tmpname, cached)
+        except (IOError, OSError):
+            for name in (tmpname, tmpname + STAMP_SUFFIX):
+                if os.path.exists(name):
+                    os.unlink(name)
+
+    def prune(self):
+        """Remove the least recently used files exceeding the limit."""
+        entries = []
+        total = 0
+        for dirpath, _, fnames in os.walk(self.path):
+            for name in fnames:
+                if name.endswith('.tmp') or name.endswith(STAMP_SUFFIX):
+                    continue
+                fname = os.path.join(dirpath, name)
+                try:
+                    fstat = os.stat(fname)
+                except OSError:
+                    continue
+                entries.append((fstat.st_atime, fstat.st_size, fname))
+                total += fstat.st_size
+        entries.sort()
+        while entries and total > self.max_bytes:
+            _, size, fname = entries.pop(0)
+            self._remove(fname)
+            total -= size
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
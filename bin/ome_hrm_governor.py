@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""Helper module limiting the OMERO transfers running at the same time.
+
+Every request of the HRM web interface runs a connector process of its own,
+so without coordination an arbitrary number of transfers may be hitting the
+OMERO server (and the HRM storage) at the same time. The governor limits the
+number of concurrent transfers on the machine to a fixed number of slots,
+shared by all connector processes (and their threads) through lock files in a
+common directory. The locks are taken using flock(), so they are released by
+the operating system if a process dies, no stale state has to be cleaned up.
+
+To keep the slots shared fairly, a user holding at least an equal share of the
+slots (the number of slots divided by the number of users transferring or
+waiting) can only take another one if no other user is waiting. Users and
+waiting users are tracked by lock files as well: a lock file per slot held by
+a user ("user.<ID>.<n>") and a shared lock file per user with transfers
+waiting ("wait.<ID>"). Checking whether a file is locked takes a (shared)
+lock for a moment as well, taking a slot therefore retries briefly if it is
+only held by such checks.
+
+Optionally, the total bandwidth of all transfers is limited, too. It is split
+evenly between the slots currently in use, every transfer pausing as required
+after each chunk to stay within its part.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import os
+import errno
+import fcntl
+import threading
+import time
+
+
+# the interval (in seconds) to re-evaluate the bandwidth of a transfer:
+RATE_INTERVAL = 1.0
+
+# the number of attempts to take an exclusive lock held by is_locked() only:
+PROBE_RETRIES = 10
+
+
+def _flock(fdesc, mode):
+    """Lock a file descriptor without blocking, return False if locked."""
+    try:
+        fcntl.flock(fdesc, mode | fcntl.LOCK_NB)
+    except IOError as err:
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+    return True
+
+
+def try_lock(fname, mode=fcntl.LOCK_EX):
+    """Try to lock a file without blocking.
+
+    An exclusive lock is retried for a moment if the file is only locked in
+    shared mode, as the checks of is_locked() do.
+
+    Returns
+    =======
+    int - the file descriptor holding the lock, None if the file is locked
+    already (the descriptor has to be closed to release the lock)
+    """
+    fdesc = os.open(fname, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        for _ in range(PROBE_RETRIES):
+            if _flock(fdesc, mode):
+                return fdesc
+            if mode != fcntl.LOCK_EX or not _flock(fdesc, fcntl.LOCK_SH):
+                break
+            time.sleep(0.001)
+    except IOError:
+        os.close(fdesc)
+        raise
+    os.close(fdesc)
+    return None
+
+
+def is_locked(fname, mode=fcntl.LOCK_SH):
+    """Check if a lock file is currently locked by anybody.
+
+    The check itself takes a shared lock for a moment, so concurrent checks
+    don't see each other. Files locked in shared mode (like the ones of the
+    waiting users) have to be checked using an exclusive lock instead.
+    """
+    try:
+        fdesc = os.open(fname, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError:
+        return False
+    try:
+        return not _flock(fdesc, mode)
+    except IOError:
+        return False
+    finally:
+        os.close(fdesc)
+
+
+class TransferSlot(object):
+
+    """A slot for running a single transfer, see TransferGovernor.acquire().
+
+    Attributes
+    ==========
+    waited : float - the number of seconds spent waiting for the slot
+    """
+
+    def __init__(self, governor, locks, waited):
+        self.governor = governor
+        self.waited = waited
+        self._locks = locks
+        self._lock = threading.Lock()
+        self._rate = None
+        self._start = None
+        self._bytes = 0
+        self._last = None
+
+    def throttle(self, done, total=None):
+        """Pause the transfer as required by the bandwidth limit.
+
+        The first call only sets the starting point of the transfer (e.g. the
+        size of a partial download being continued), the bytes up to there
+        don't count against the bandwidth.
+
+        Parameters
+        ==========
+        done : int - the number of bytes transferred so far (may be called
+               from several threads, e.g. for parallel streams)
+        total : int - the total size of the transfer (ignored, for using the
+                method as a progress callback)
+        """
+        if not self.governor.bandwidth:
+            return
+        with self._lock:
+            if self._last is None:
+                self._last = done
+                return
+            now = time.time()
+            if self._start is None or now - self._start > RATE_INTERVAL:
+                # start a new interval with the rate of the current share:
+                self._rate = float(self.governor.bandwidth) / max(
+                    1, self.governor.active())
+                self._start = now
+                self._bytes = 0
+            self._bytes += max(0, done - self._last)
+            self._last = max(self._last, done)
+            delay = self._start + self._bytes / self._rate - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def release(self):
+        """Give the slot back."""
+        for fdesc in self._locks:
+            os.close(fdesc)
+        self._locks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class TransferGovernor(object):
+
+    """Machine-wide limits for the number and bandwidth of transfers.
+
+    Parameters
+    ==========
+    path : str - the directory for the lock files (has to exist and to be
+           shared by all connector processes)
+    slots : int - the maximum number of concurrent transfers
+    bandwidth : int - the maximum total bandwidth in bytes per second, 0 for
+                no limit
+    poll : float - the interval (in seconds) to check for a free slot
+    """
+
+    def __init__(self, path, slots, bandwidth=0, poll=0.5):
+        self.path = path
+        self.slots = slots
+        self.bandwidth = bandwidth
+        self.poll = poll
+
+    def _slot_file(self, idx):
+        """Assemble the name of the lock file of a slot."""
+        return os.path.join(self.path, 'slot.%d' % idx)
+
+    def _user_file(self, user, idx):
+        """Assemble the name of the lock file of a slot held by a user."""
+        return os.path.join(self.path, 'user.%s.%d' % (user, idx))
+
+    def _wait_file(self, user):
+        """Assemble the name of the lock file of a waiting user."""
+        return os.path.join(self.path, 'wait.%s' % user)
+
+    def active(self):
+        """Get the number of slots currently in use."""
+        return len([idx for idx in range(self.slots)
+                    if is_locked(self._slot_file(idx))])
+
+    def usage(self):
+        """Get the number of slots held by every user and the waiting users.
+
+        Returns
+        =======
+        (dict, set) - the number of slots held per user ID and the IDs of the
+        users waiting for a slot
+        """
+        held = dict()
+        waiting = set()
+        for name in os.listdir(self.path):
+            kind, _, rest = name.partition('.')
+            if kind == 'user' and is_locked(os.path.join(self.path, name)):
+                user = rest.rpartition('.')[0]
+                held[user] = held.get(user, 0) + 1
+            elif kind == 'wait' and is_locked(os.path.join(self.path, name),
+                                              fcntl.LOCK_EX):
+                waiting.add(rest)
+        return held, waiting
+
+    def _may_take(self, user):
+        """Check if a user may take another slot according to fairness."""
+        held, waiting = self.usage()
+        users = set(held) | waiting | set([user])
+        if held.get(user, 0) < max(1, self.slots // len(users)):
+            return True
+        return not waiting - set([user])
+
+    def _try_take(self, user):
+        """Try to lock a free slot for a user.
+
+        Returns
+        =======
+        list(int) - the file descriptors holding the slot, None if no slot is
+        free
+        """
+        for idx in range(self.slots):
+            slot = try_lock(self._slot_file(idx))
+            if slot is None:
+                continue
+            for uidx in range(self.slots):
+                owner = try_lock(self._user_file(user, uidx))
+                if owner is not None:
+                    return [slot, owner]
+            os.close(slot)
+        return None
+
+    def acquire(self, user, waiting=None):
+        """Wait for a free transfer slot and take it.
+
+        Parameters
+        ==========
+        user : str - the ID of the user running the transfer
+        waiting : callable - (optional) called as waiting(active, slots) once
+                  if the transfer has to wait, e.g. for reporting it
+
+        Returns
+        =======
+        TransferSlot - the slot, to be released once the transfer is done
+        (also usable as a context manager)
+        """
+        user = str(user)
+        start = time.time()
+        wait_lock = None
+        try:
+            while True:
+                if self._may_take(user):
+                    locks = self._try_take(user)
+                    if locks is not None:
+                        return TransferSlot(self, locks, time.time() - start)
+                if wait_lock is None:
+                    # let other processes know that this user is waiting:
+                    wait_lock = try_lock(self._wait_file(user), fcntl.LOCK_SH)
+                if waiting is not None:
+                    waiting(self.active(), self.slots)
+                    waiting = None
+                time.sleep(self.poll)
+        finally:
+            if wait_lock is not None:
+                os.close(wait_lock)
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""Helper module to record performance metrics of the OMERO connector.
+
+The duration of the individual phases of a request (logging in, querying the
+tree nodes, encoding them, looking up images, importing files, etc.) as well
+as the size, duration and throughput of every file transfer are written as
+structured records to a metrics file, one JSON object per line, e.g.
+
+{"kind": "phase", "name": "login", "pid": 4711, "seconds": 0.53, ...}
+{"kind": "transfer", "name": "download", "bytes": 1048576, ...}
+
+Each record is appended to the file as soon as the corresponding phase is
+finished, using an exclusive lock, so several connector processes (and
+threads) can share the same file. Recording the metrics must never interfere
+with the actual work of the connector, so problems writing the file are
+silently ignored.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import os
+import contextlib
+import fcntl
+import json
+import threading
+import time
+
+
+class Metrics(object):
+
+    """Writer for the metrics records of the connector.
+
+    Parameters
+    ==========
+    fname : str - the file to append the records to, None disables recording
+    context : the entries to add to every record (e.g. user and action)
+    """
+
+    def __init__(self, fname=None, **context):
+        self.fname = fname
+        self.context = context
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """True if the records are written, False otherwise."""
+        return self.fname is not None
+
+    def record(self, kind, name, **details):
+        """Write a single record to the metrics file.
+
+        Parameters
+        ==========
+        kind : str - the type of the record, e.g. 'phase' or 'transfer'
+        name : str - the name of the phase or transfer
+        details : the entries to add to the record
+        """
+        if self.fname is None:
+            return
+        rec = {'time': time.time(), 'pid': os.getpid(), 'kind': kind,
+               'name': name}
+        rec.update(self.context)
+        rec.update(details)
+        line = json.dumps(rec, sort_keys=True) + '\n'
+        try:
+            with self._lock:
+                with open(self.fname, 'a') as outfile:
+                    fcntl.flock(outfile, fcntl.LOCK_EX)
+                    outfile.write(line)
+        except (IOError, OSError):
+            pass
+
+    @contextlib.contextmanager
+    def phase(self, name, **details):
+        """Record the duration of the code run in a 'with' block.
+
+        The dict yielded by the context manager can be used to add further
+        details to the record, e.g. the number of items processed.
+        """
+        start = time.time()
+        try:
+            yield details
+        finally:
+            self.record('phase', name, seconds=time.time() - start,
+                        **details)
+
+    def transfer(self, name, fname, nbytes, seconds, **details):
+        """Record a file transfer.
+
+        Parameters
+        ==========
+        name : str - the type of the transfer, e.g. 'download' or 'import'
+        fname : str - the local file
+        nbytes : int - the number of bytes transferred
+        seconds : float - the duration of the transfer
+        details : the entries to add to the record
+        """
+        throughput = None
+        if seconds > 0:
+            throughput = nbytes / seconds
+        self.record('transfer', name, file=fname, bytes=nbytes,
+                    seconds=seconds, throughput=throughput, **details)
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
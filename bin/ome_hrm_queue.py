@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+
+"""Helper module providing a persistent queue for OMERO transfers.
+
+Instead of running a (possibly long) transfer while the HRM web interface is
+waiting for it, the connector can add it as a job to a queue kept in an SQLite
+database and return right away. The jobs are then picked up and run in the
+background by the transfer worker (ome_hrm_worker.py), which records the
+progress of every single item in the database, so it can be requested by the
+web interface at any time.
+
+A job consists of the items of a batch transfer (see ome_hrm.py) together
+with the transfer options, the name of the OMERO user and the UUID of an OMERO
+session created for the job. The password of the user is never stored, so the
+worker relies on the session still being alive when picking up the job.
+
+Failed items are retried with an exponentially increasing delay, up to a
+maximum number of attempts, unless retrying them can't help (e.g. if the
+target file exists already). Jobs whose worker process died are put back into
+the queue.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import os
+import errno
+import json
+import sqlite3
+import threading
+import time
+
+
+# the states of jobs and items:
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def process_alive(pid):
+    """Check if a process with the given PID exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+class TransferQueue(object):
+
+    """An SQLite based queue of transfer jobs with per-item state.
+
+    Parameters
+    ==========
+    path : str - the database file
+    max_attempts : int - the number of attempts after which failed items are
+                   given up
+    backoff : float - the delay (in seconds) before the first retry, doubled
+              for every further attempt
+
+    The queue may be used by several threads (e.g. reporting the progress of
+    parallel transfers), the database accesses are serialized.
+    """
+
+    def __init__(self, path, max_attempts=5, backoff=30):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "  id INTEGER PRIMARY KEY,"
+            "  user TEXT NOT NULL,"
+            "  action TEXT NOT NULL,"
+            "  options TEXT NOT NULL,"
+            "  session TEXT NOT NULL,"
+            "  state TEXT NOT NULL,"
+            "  attempts INTEGER NOT NULL DEFAULT 0,"
+            "  next_try REAL NOT NULL,"
+            "  worker INTEGER,"
+            "  created REAL NOT NULL,"
+            "  updated REAL NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS items ("
+            "  job INTEGER NOT NULL,"
+            "  idx INTEGER NOT NULL,"
+            "  item TEXT NOT NULL,"
+            "  state TEXT NOT NULL,"
+            "  done INTEGER NOT NULL DEFAULT 0,"
+            "  total INTEGER,"
+            "  messages TEXT NOT NULL DEFAULT '[]',"
+            "  PRIMARY KEY (job, idx))")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, next_try)")
+        self._db.commit()
+
+    def enqueue(self, user, session, action, items, options=None):
+        """Add a new job to the queue.
+
+        Parameters
+        ==========
+        user : str - the OMERO user name
+        session : str - the UUID of the OMERO session to run the job in
+        action : str - the transfer action, 'OMEROtoHRM' or 'HRMtoOMERO'
+        items : list(dict) - the transfer items, see ome_hrm.read_manifest()
+        options : dict - the options of the action, e.g. the number of jobs
+
+        Returns
+        =======
+        int - the ID of the new job
+        """
+        now = time.time()
+        with self._lock, self._db:
+            cur = self._db.execute(
+                "INSERT INTO jobs (user, action, options, session, state, "
+                "next_try, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (user, action, json.dumps(options or dict()), session, QUEUED,
+                 now, now, now))
+            job_id = cur.lastrowid
+            self._db.executemany(
+                "INSERT INTO items (job, idx, item, state) VALUES (?, ?, ?, ?)",
+                [(job_id, idx, json.dumps(item), QUEUED)
+                 for idx, item in enumerate(items)])
+        return job_id
+
+    def claim(self, worker=None):
+        """Take the next job that is due from the queue.
+
+        The job is marked as running by the given worker process, so no other
+        worker will pick it up. Jobs still marked as running by a worker that
+        doesn't exist anymore are put back into the queue first.
+
+        Returns
+        =======
+        dict - the job (see status()) with the additional keys 'session' and
+        'options', restricted to the items still to be transferred, None if no
+        job is due
+        """
+        if worker is None:
+            worker = os.getpid()
+        self.recover()
+        while True:
+            now = time.time()
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT id FROM jobs WHERE state = ? AND next_try <= ? "
+                    "ORDER BY next_try, id LIMIT 1", (QUEUED, now)).fetchone()
+            if row is None:
+                return None
+            with self._lock, self._db:
+                # only one worker can succeed in changing the state:
+                claimed = self._db.execute(
+                    "UPDATE jobs SET state = ?, worker = ?, attempts = "
+                    "attempts + 1, updated = ? WHERE id = ? AND state = ?",
+                    (RUNNING, worker, now, row[0], QUEUED)).rowcount
+                if claimed:
+                    self._db.execute(
+                        "UPDATE items SET state = ? WHERE job = ? AND "
+                        "state = ?", (RUNNING, row[0], QUEUED))
+            if claimed:
+                break
+        job = self.status(row[0])
+        job['items'] = [item for item in job['items']
+                        if item['state'] == RUNNING]
+        job.update(self._job_details(row[0]))
+        return job
+
+    def _job_details(self, job_id):
+        """Get the session and the options of a job."""
+        with self._lock:
+            session, options = self._db.execute(
+                "SELECT session, options FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()
+        return {'session': session, 'options': json.loads(options)}
+
+    def recover(self):
+        """Put jobs of workers that died back into the queue."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, worker FROM jobs WHERE state = ?",
+                (RUNNING,)).fetchall()
+        for job_id, worker in rows:
+            if worker is not None and process_alive(worker):
+                continue
+            with self._lock, self._db:
+                self._db.execute(
+                    "UPDATE jobs SET state = ?, worker = NULL, updated = ? "
+                    "WHERE id = ? AND state = ?",
+                    (QUEUED, time.time(), job_id, RUNNING))
+                self._db.execute(
+                    "UPDATE items SET state = ? WHERE job = ? AND state = ?",
+                    (QUEUED, job_id, RUNNING))
+
+    def progress(self, job_id, idx, done, total=None):
+        """Record the number of bytes transferred for an item."""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE items SET done = ?, total = COALESCE(?, total) "
+                "WHERE job = ? AND idx = ?", (done, total, job_id, idx))
+
+    def finish_item(self, job_id, idx, success, messages, retry=True):
+        """Record the result of an item.
+
+        Failed items are put back into the queue unless the job has reached
+        the maximum number of attempts or 'retry' is False.
+        """
+        with self._lock, self._db:
+            attempts = self._db.execute(
+                "SELECT attempts FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()[0]
+            if success:
+                state = DONE
+            elif retry and attempts < self.max_attempts:
+                state = QUEUED
+            else:
+                state = FAILED
+            self._db.execute(
+                "UPDATE items SET state = ?, messages = ? "
+                "WHERE job = ? AND idx = ?",
+                (state, json.dumps(messages), job_id, idx))
+
+    def finish(self, job_id):
+        """Finish a run of a job, scheduling a retry for failed items.
+
+        Returns
+        =======
+        str - the new state of the job
+        """
+        now = time.time()
+        with self._lock, self._db:
+            attempts = self._db.execute(
+                "SELECT attempts FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()[0]
+            if attempts >= self.max_attempts:
+                # items interrupted during the last attempt are given up:
+                self._db.execute(
+                    "UPDATE items SET state = ? WHERE job = ? AND state = ?",
+                    (FAILED, job_id, RUNNING))
+            states = set([row[0] for row in self._db.execute(
+                "SELECT state FROM items WHERE job = ?", (job_id,))])
+            if QUEUED in states or RUNNING in states:
+                # items interrupted for other reasons are retried as well:
+                self._db.execute(
+                    "UPDATE items SET state = ? WHERE job = ? AND state = ?",
+                    (QUEUED, job_id, RUNNING))
+                state = QUEUED
+            elif FAILED in states:
+                state = FAILED
+            else:
+                state = DONE
+            self._db.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, next_try = ?, "
+                "updated = ? WHERE id = ?",
+                (state, now + self.backoff * 2 ** (attempts - 1), now, job_id))
+        return state
+
+    def fail(self, job_id, message):
+        """Give up a job (e.g. if its session has expired)."""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE items SET state = ?, messages = ? "
+                "WHERE job = ? AND state != ?",
+                (FAILED, json.dumps([message]), job_id, DONE))
+            self._db.execute(
+                "UPDATE jobs SET state = ?, worker = NULL, updated = ? "
+                "WHERE id = ?", (FAILED, time.time(), job_id))
+
+    def waiting(self):
+        """Get the jobs waiting in the queue.
+
+        Returns
+        =======
+        list(tuple) - (job ID, session UUID) of every queued job
+        """
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, session FROM jobs WHERE state = ?",
+                (QUEUED,)).fetchall()
+
+    def status(self, job_id, user=None):
+        """Get the state and progress of a job.
+
+        Parameters
+        ==========
+        job_id : int - the ID of the job
+        user : str - (optional) only return the job if it belongs to this user
+
+        Returns
+        =======
+        dict - the job with the keys 'id', 'user', 'action', 'state',
+        'attempts', 'next_try', 'created', 'updated' and 'items', the latter
+        being a list of the transfer items with their 'state', 'done' and
+        'total' bytes, 'messages' and (once finished) 'success', None if there
+        is no such job
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, user, action, state, attempts, next_try, "
+                "created, updated FROM jobs WHERE id = ?",
+                (job_id,)).fetchone()
+            items = self._db.execute(
+                "SELECT idx, item, state, done, total, messages FROM items "
+                "WHERE job = ? ORDER BY idx", (job_id,)).fetchall()
+        if row is None or (user is not None and row[1] != user):
+            return None
+        keys = ['id', 'user', 'action', 'state', 'attempts', 'next_try',
+                'created', 'updated']
+        job = dict(zip(keys, row))
+        job['items'] = []
+        for idx, item, state, done, total, messages in items:
+            item = json.loads(item)
+            item.update(index=idx, state=state, done=done, total=total,
+                        messages=json.loads(messages))
+            if state in (DONE, FAILED):
+                item['success'] = state == DONE
+            job['items'].append(item)
+        return job
+
+    def purge(self, max_age):
+        """Remove finished jobs older than 'max_age' seconds."""
+        with self._lock, self._db:
+            jobs = "SELECT id FROM jobs WHERE state IN (?, ?) AND updated < ?"
+            args = (DONE, FAILED, time.time() - max_age)
+            self._db.execute("DELETE FROM items WHERE job IN (%s)" % jobs,
+                             args)
+            self._db.execute("DELETE FROM jobs WHERE id IN (%s)" % jobs, args)
+
+    def close(self):
+        """Close the database connection."""
+        self._db.close()
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""Helper module providing a local full-text index of the OMERO objects.
+
+Finding an image in the tree of the HRM web interface means expanding it node
+by node, each step requesting the children from OMERO. Instead, the names of
+all projects, datasets and images visible to a user can be kept in a local
+SQLite database with a trigram index (FTS5, SQLite 3.34 or newer), so objects
+can be found by any parts of their names within milliseconds, even for groups
+with hundreds of thousands of images. With older SQLite versions, the names
+of the user are scanned instead (still fast enough for most installations).
+
+The index is shared by all connector processes, its entries are kept per OMERO
+user (as the visible objects depend on the permissions of the user). It is
+refreshed incrementally: for every class, the position of the last change
+seen (the ID of the update event and of the object) is stored, so only objects
+created or modified since then have to be requested from OMERO. Deleted
+objects (or objects that aren't visible anymore) are detected by comparing
+the number of objects, only then the complete lists of IDs are compared.
+
+The queries themselves are run by the connector (see ome_hrm.py), this module
+only stores the objects and searches them.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import re
+import sqlite3
+import time
+
+
+# the indexed OMERO classes, in the order search results are returned:
+CLASSES = ('Project', 'Dataset', 'Image')
+
+
+def search_words(text):
+    """Split a search text into the words to be found in the names.
+
+    Every word is matched anywhere in a name (ignoring the case), e.g.
+    "img 42" finds "img_00042.tif".
+
+    Returns
+    =======
+    list(unicode) - the words, empty if the text doesn't contain any
+    """
+    return re.findall(r'[^\W_]+', text, re.UNICODE)
+
+
+class SearchIndex(object):
+
+    """An SQLite full-text index of the names of OMERO objects per user.
+
+    Parameters
+    ==========
+    path : str - the database file
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS objects ("
+            "  user TEXT NOT NULL,"
+            "  class TEXT NOT NULL,"
+            "  oid INTEGER NOT NULL,"
+            "  gid INTEGER NOT NULL,"
+            "  name TEXT NOT NULL,"
+            "  owner TEXT,"
+            "  UNIQUE (user, class, oid))")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sync ("
+            "  user TEXT NOT NULL,"
+            "  class TEXT NOT NULL,"
+            "  event INTEGER NOT NULL,"
+            "  oid INTEGER NOT NULL,"
+            "  PRIMARY KEY (user, class))")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS synced ("
+            "  user TEXT PRIMARY KEY,"
+            "  time REAL NOT NULL)")
+        existing = self._db.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name = 'trigrams'"
+        ).fetchone()[0]
+        self._trigrams = True
+        try:
+            self._db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS trigrams USING "
+                "fts5(name, tokenize='trigram')")
+        except sqlite3.OperationalError:
+            # no trigram tokenizer (SQLite < 3.34), the names get scanned:
+            self._trigrams = False
+        else:
+            if not existing:
+                # the word index of older versions couldn't find parts of
+                # words, replace it by the trigrams of the objects indexed:
+                self._db.execute("DROP TABLE IF EXISTS names")
+                self._db.execute(
+                    "INSERT INTO trigrams (rowid, name) "
+                    "SELECT rowid, name FROM objects")
+        self._db.commit()
+
+    def last_sync(self, user):
+        """Get the time of the last synchronization for a user (0 if none)."""
+        row = self._db.execute(
+            "SELECT time FROM synced WHERE user = ?", (user,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def position(self, user, cls):
+        """Get the position of the last change seen for a class.
+
+        Returns
+        =======
+        (int, int) - the ID of the update event and of the object
+        """
+        row = self._db.execute(
+            "SELECT event, oid FROM sync WHERE user = ? AND class = ?",
+            (user, cls)).fetchone()
+        return tuple(row) if row is not None else (-1, -1)
+
+    def update(self, user, cls, rows, position=None):
+        """Add or update objects in the index.
+
+        Parameters
+        ==========
+        user : str - the OMERO user name
+        cls : str - the OMERO class of the objects, e.g. 'Image'
+        rows : list(tuple) - (object ID, group ID, name, owner name) for every
+               object
+        position : (int, int) - (optional) the new position of the last change
+                   seen for the class, see position()
+        """
+        with self._db:
+            for oid, gid, name, owner in rows:
+                row = self._db.execute(
+                    "SELECT rowid FROM objects WHERE user = ? AND class = ? "
+                    "AND oid = ?", (user, cls, oid)).fetchone()
+                if row is None:
+                    rowid = self._db.execute(
+                        "INSERT INTO objects (user, class, oid, gid, name, "
+                        "owner) VALUES (?, ?, ?, ?, ?, ?)",
+                        (user, cls, oid, gid, name, owner)).lastrowid
+                else:
+                    rowid = row[0]
+                    self._db.execute(
+                        "UPDATE objects SET gid = ?, name = ?, owner = ? "
+                        "WHERE rowid = ?", (gid, name, owner, rowid))
+                    if self._trigrams:
+                        self._db.execute(
+                            "DELETE FROM trigrams WHERE rowid = ?", (rowid,))
+                if self._trigrams:
+                    self._db.execute(
+                        "INSERT INTO trigrams (rowid, name) VALUES (?, ?)",
+                        (rowid, name))
+            if position is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO sync VALUES (?, ?, ?, ?)",
+                    (user, cls) + tuple(position))
+
+    def count(self, user, cls):
+        """Get the number of indexed objects of a class."""
+        return self._db.execute(
+            "SELECT COUNT(*) FROM objects WHERE user = ? AND class = ?",
+            (user, cls)).fetchone()[0]
+
+    def ids(self, user, cls):
+        """Get the IDs of all indexed objects of a class."""
+        return set([row[0] for row in self._db.execute(
+            "SELECT oid FROM objects WHERE user = ? AND class = ?",
+            (user, cls))])
+
+    def remove(self, user, cls, ids):
+        """Remove objects from the index."""
+        with self._db:
+            for oid in ids:
+                row = self._db.execute(
+                    "SELECT rowid FROM objects WHERE user = ? AND class = ? "
+                    "AND oid = ?", (user, cls, oid)).fetchone()
+                if row is None:
+                    continue
+                if self._trigrams:
+                    self._db.execute("DELETE FROM trigrams WHERE rowid = ?",
+                                     row)
+                self._db.execute("DELETE FROM objects WHERE rowid = ?", row)
+
+    def set_synced(self, user, when=None):
+        """Record the time of a completed synchronization for a user."""
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO synced VALUES (?, ?)",
+                             (user, time.time() if when is None else when))
+
+    def search(self, user, text, limit=100):
+        """Find the objects whose names contain all words of a text.
+
+        Words of at least three characters are looked up in the trigram
+        index, shorter ones (or all of them, if there is no such index) are
+        matched by scanning the names found (or the ones of the user).
+
+        Parameters
+        ==========
+        user : str - the OMERO user name
+        text : str - the words to search for (anywhere in the names)
+        limit : int - the maximum number of results
+
+        Returns
+        =======
+        list(tuple) - (class, object ID, group ID, name, owner name) of every
+        matching object, ordered by class (see CLASSES) and name
+        """
+        words = search_words(text)
+        if not words:
+            return []
+        tables = 'objects o'
+        conditions = []
+        for word in words:
+            column = 'o.name'
+            if self._trigrams and len(word) >= 3:
+                tables = ('trigrams JOIN objects o '
+                          'ON o.rowid = trigrams.rowid')
+                column = 'trigrams.name'
+            conditions.append('%s LIKE ?' % column)
+        order = ' '.join(["WHEN '%s' THEN %d" % (cls, idx)
+                          for idx, cls in enumerate(CLASSES)])
+        return self._db.execute(
+            "SELECT o.class, o.oid, o.gid, o.name, o.owner FROM %s "
+            "WHERE %s AND o.user = ? "
+            "ORDER BY CASE o.class %s END, o.name, o.oid LIMIT ?" %
+            (tables, ' AND '.join(conditions), order),
+            [u'%%%s%%' % word for word in words] + [user, limit]).fetchall()
+
+    def close(self):
+        """Close the database connection."""
+        self._db.close()
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
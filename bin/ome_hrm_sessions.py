@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""Helper module to keep track of OMERO sessions between connector calls.
+
+Instead of creating a new OMERO session for every single call of the connector
+(which is expensive and leaves lots of orphaned sessions on the server), the
+session UUID is remembered after a successful login and subsequent calls of
+the same user simply join the existing session.
+
+The records are stored in a directory only accessible by the user running the
+connector, one file per OMERO user. As knowing the session UUID is equivalent
+to knowing the password, a record is only handed out if the password supplied
+with the request matches the (salted and hashed) one stored with the record.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import os
+import binascii
+import hashlib
+import hmac
+import json
+import tempfile
+import time
+
+
+# number of iterations for the PBKDF2 password hashing:
+HASH_ITERATIONS = 20000
+
+
+def secure_dir(path):
+    """Make sure a directory exists and is accessible by our own user only.
+
+    Parameters
+    ==========
+    path : str - the directory to check (and create if necessary)
+
+    Returns
+    =======
+    bool - True if the directory is usable, False otherwise (e.g. if it belongs
+    to a different user or is accessible by others).
+    """
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        pass
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        return False
+    return (os.path.isdir(path) and not os.path.islink(path) and
+            stat.st_uid == os.getuid() and not stat.st_mode & 0o077)
+
+
+def hash_password(passwd, salt):
+    """Calculate the PBKDF2 hash of a password using the given salt."""
+    return binascii.hexlify(hashlib.pbkdf2_hmac(
+        'sha256', passwd, salt, HASH_ITERATIONS))
+
+
+class SessionStore(object):
+
+    """Per-user records of OMERO sessions in a private directory.
+
+    Parameters
+    ==========
+    path : str - the directory to store the session records in
+    host : str - the OMERO server the sessions belong to
+    max_idle : int - seconds after which a record is considered to be expired
+               (should not exceed the session timeout of the OMERO server)
+    """
+
+    def __init__(self, path, host, max_idle=600):
+        self.path = path
+        self.host = host
+        self.max_idle = max_idle
+        self.usable = secure_dir(path)
+
+    def _record_file(self, user):
+        """Assemble the filename of the record for a given user."""
+        key = hashlib.sha256('%s@%s' % (user, self.host)).hexdigest()
+        return os.path.join(self.path, key + '.json')
+
+    def _read(self, user):
+        """Read the record of a user, return None if there is no valid one."""
+        try:
+            with open(self._record_file(user), 'r') as infile:
+                record = json.load(infile)
+        except (IOError, ValueError):
+            return None
+        if record.get('user') != user:
+            return None
+        return record
+
+    def _write(self, user, record):
+        """Atomically (over)write the record of a user, readable by us only."""
+        fd, tmpname = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                json.dump(record, outfile)
+            os.rename(tmpname, self._record_file(user))
+        except (IOError, OSError):
+            os.unlink(tmpname)
+
+    def lookup(self, user, passwd):
+        """Get the session UUID for a user if there is a valid record.
+
+        Returns
+        =======
+        str - the session UUID, None if no (unexpired) record exists or the
+        password doesn't match the one used to create the session.
+        """
+        if not self.usable:
+            return None
+        record = self._read(user)
+        if record is None:
+            return None
+        if time.time() - record['last_used'] > self.max_idle:
+            self.remove(user)
+            return None
+        pwhash = hash_password(passwd, binascii.unhexlify(record['salt']))
+        if not hmac.compare_digest(pwhash, record['pwhash'].encode('ascii')):
+            return None
+        return record['uuid'].encode('ascii')
+
+    def recorded(self, user):
+        """Get the session UUID of a user's record, regardless of its age.
+
+        Returns
+        =======
+        str - the session UUID, None if there is no record
+        """
+        if not self.usable:
+            return None
+        record = self._read(user)
+        if record is None:
+            return None
+        return record['uuid'].encode('ascii')
+
+    def save(self, user, passwd, uuid):
+        """Store the session UUID of a user together with the password hash."""
+        if not self.usable:
+            return
+        salt = os.urandom(16)
+        record = {
+            'user': user,
+            'uuid': uuid,
+            'salt': binascii.hexlify(salt),
+            'pwhash': hash_password(passwd, salt),
+            'last_used': time.time(),
+        }
+        self._write(user, record)
+
+    def touch(self, user):
+        """Update the time of last usage of a user's record."""
+        record = self._read(user)
+        if record is None:
+            return
+        record['last_used'] = time.time()
+        self._write(user, record)
+
+    def remove(self, user):
+        """Remove the record of a user (if existing)."""
+        try:
+            os.unlink(self._record_file(user))
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
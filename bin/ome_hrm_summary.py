@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""Helper module to turn the HRM parameter summary into plain text.
+
+The HTML parameter summary written by the HRM for every job is parsed in a
+streaming fashion using the HTMLParser of the Python standard library, so no
+additional packages are required and no document tree has to be built. As
+all results of a job share the same parameter summary, the generated text is
+memoized by filename, modification time and size of the summary.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import os
+import codecs
+import htmlentitydefs
+import HTMLParser
+
+
+# the number of summaries to remember at most:
+MEMO_SIZE = 128
+
+# the summaries generated so far, keyed by (filename, mtime, size):
+_MEMO = dict()
+
+
+class SummaryParser(HTMLParser.HTMLParser):
+
+    """Collect the text of the cells of all tables as lists of rows.
+
+    After feeding the document, 'tables' contains a list for every <table>
+    holding a list of cell texts for every <tr>.
+    """
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.tables = []
+        self._row = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            self.tables.append([])
+        elif tag == 'tr' and self.tables:
+            self._row = []
+            self.tables[-1].append(self._row)
+        elif tag == 'td' and self._row is not None:
+            self._cell = []
+            self._row.append(self._cell)
+
+    def handle_endtag(self, tag):
+        if tag == 'td':
+            self._cell = None
+        elif tag in ('tr', 'table'):
+            self._row = None
+            self._cell = None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+    def handle_entityref(self, name):
+        if name in htmlentitydefs.name2codepoint:
+            self.handle_data(unichr(htmlentitydefs.name2codepoint[name]))
+        else:
+            self.handle_data(u'&%s;' % name)
+
+    def handle_charref(self, name):
+        try:
+            if name.lower().startswith('x'):
+                self.handle_data(unichr(int(name[1:], 16)))
+            else:
+                self.handle_data(unichr(int(name)))
+        except ValueError:
+            self.handle_data(u'&#%s;' % name)
+
+
+def parse_tables(fname, block_size=65536):
+    """Parse the tables of an HTML file.
+
+    Returns
+    =======
+    list - the tables, each one a list of rows, each row a list of the texts
+    of its cells
+    """
+    parser = SummaryParser()
+    # characters may span the boundaries of the blocks:
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    with open(fname, 'r') as infile:
+        while True:
+            block = infile.read(block_size)
+            if not block:
+                break
+            parser.feed(decoder.decode(block))
+    parser.feed(decoder.decode('', final=True))
+    parser.close()
+    return [[[u''.join(cell) for cell in row] for row in table]
+            for table in parser.tables]
+
+
+def format_summary(tables):
+    """Format the parsed tables of the parameter summary as plain text.
+
+    The first row of each table holds its title, the second one (the column
+    legend) is ignored, all further ones contain the parameter name, the
+    channel, the source and the value.
+    """
+    summary = u''
+    for table in tables:
+        if not table or not table[0]:
+            continue
+        # the table header:
+        summary += u"%s\n" % table[0][0]
+        summary += u"==============================\n"
+        # and the table body:
+        for cols in table[2:]:
+            if len(cols) < 4:
+                continue
+            summary += u"%s [Ch: %s]: %s\n" % (
+                cols[0].replace(u'\u03bc', u'u'), cols[1], cols[3])
+        summary += u'\n'
+    return summary
+
+
+def parameter_summary(fname):
+    """Get the plain text version of an HRM parameter summary (memoized).
+
+    Parameters
+    ==========
+    fname : str - the filename of the HTML parameter summary
+
+    Returns
+    =======
+    unicode - the summary, None if the file can't be read
+    """
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    key = (os.path.abspath(fname), stat.st_mtime, stat.st_size)
+    if key not in _MEMO:
+        try:
+            tables = parse_tables(fname)
+        except IOError:
+            return None
+        if len(_MEMO) >= MEMO_SIZE:
+            _MEMO.clear()
+        _MEMO[key] = format_summary(tables)
+    return _MEMO[key]
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
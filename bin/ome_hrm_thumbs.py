@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""Helper module for fetching and caching OMERO thumbnails.
+
+The thumbnails of several images are requested from OMERO in a single call
+instead of loading each image and asking for its thumbnail separately. As
+OMERO delivers them as JPEG data, they can be written as HRM previews
+directly.
+
+Fetched thumbnails are kept in a local cache directory (one file per image and
+size), so the preview of an image is never requested twice. The cache is
+bounded in size, the least recently used thumbnails are removed once the
+limit is exceeded. Cached JPEG thumbnails are placed as previews as
+reflinks (on filesystems supporting it) or copies of the cache files, see
+ome_hrm_filecache.link_file(). Note that the cache doesn't check any permissions, so it
+must only be consulted for images the requesting user is known to have access
+to.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import os
+
+from ome_hrm_filecache import link_file
+
+
+# the default (longest side) size of the thumbnails:
+THUMB_SIZE = 64
+
+
+class ThumbnailCache(object):
+
+    """A size-bounded directory of thumbnails with LRU eviction.
+
+    Parameters
+    ==========
+    path : str - the cache directory (has to exist)
+    max_bytes : int - the maximum total size of the cached thumbnails
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def _filename(self, image_id, size):
+        """Assemble the name of the cache file for a thumbnail."""
+        return os.path.join(self.path, '%s_%s.jpg' % (image_id, size))
+
+    def get(self, image_id, size=THUMB_SIZE):
+        """Get a cached thumbnail.
+
+        Returns
+        =======
+        str - the thumbnail data, None if it's not in the cache
+        """
+        fname = self._filename(image_id, size)
+        try:
+            with open(fname, 'rb') as infile:
+                data = infile.read()
+            # the modification time serves as the time of last usage:
+            os.utime(fname, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, image_id, data, size=THUMB_SIZE):
+        """Store a thumbnail, evicting old ones if necessary."""
+        fname = self._filename(image_id, size)
+        tmpname = '%s.%s.tmp' % (fname, os.getpid())
+        try:
+            with open(tmpname, 'wb') as outfile:
+                outfile.write(data)
+            os.rename(tmpname, fname)
+        except (IOError, OSError):
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            return
+        self.prune()
+
+    def place(self, image_id, target, size=THUMB_SIZE):
+        """Place a cached JPEG thumbnail at the target location.
+
+        The preview is never hardlinked to the cache file, as the HRM may
+        overwrite it in place when generating its own previews.
+
+        Returns
+        =======
+        bool - True if the thumbnail was placed, False if it's not in the
+        cache or not in JPEG format
+        """
+        fname = self._filename(image_id, size)
+        try:
+            with open(fname, 'rb') as infile:
+                if infile.read(2) != '\xff\xd8':
+                    return False
+            if os.path.exists(target):
+                os.unlink(target)
+            link_file(fname, target, hardlink=False)
+            os.utime(fname, None)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def prune(self):
+        """Remove the least recently used thumbnails exceeding the limit."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.jpg'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        entries.sort()
+        while entries and total > self.max_bytes:
+            _, size, name = entries.pop(0)
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+
+def fetch_thumbnails(conn, image_ids, cache=None, size=THUMB_SIZE):
+    """Get the thumbnails of several images, using as few calls as possible.
+
+    Thumbnails present in the cache are taken from there, all others are
+    requested from OMERO at once (falling back to one request per image if
+    the gateway doesn't support fetching sets of thumbnails).
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    image_ids : list - the IDs of the images
+    cache : ThumbnailCache - (optional) the cache to use
+    size : int - the size of the longest side of the thumbnails
+
+    Returns
+    =======
+    dict - the thumbnail data (usually JPEG) keyed by image ID (long), images
+    without a thumbnail are missing
+    """
+    thumbs = dict()
+    missing = []
+    for image_id in set([long(image_id) for image_id in image_ids]):
+        data = None
+        if cache is not None:
+            data = cache.get(image_id, size)
+        if data is None:
+            missing.append(image_id)
+        else:
+            thumbs[image_id] = data
+    if not missing:
+        return thumbs
+    if hasattr(conn, 'getThumbnailSet'):
+        fetched = conn.getThumbnailSet(missing, size)
+    else:
+        fetched = dict()
+        for image_id in missing:
+            image_obj = conn.getObject("Image", image_id)
+            if image_obj:
+                fetched[image_id] = image_obj.getThumbnail((size, size))
+    for image_id, data in fetched.items():
+        if not data:
+            continue
+        thumbs[long(image_id)] = data
+        if cache is not None:
+            cache.put(image_id, data, size)
+    return thumbs
+
+
+def to_jpeg(data):
+    """Make sure thumbnail data is in JPEG format.
+
+    JPEG data is returned unchanged, anything else is converted (requires PIL,
+    the Python Imaging Library).
+
+    Raises
+    ======
+    ImportError - if the data has to be converted but PIL is not available
+    """
+    if data.startswith('\xff\xd8'):
+        return data
+    import Image
+    import StringIO
+    converted = StringIO.StringIO()
+    Image.open(StringIO.StringIO(data)).convert('RGB').save(converted, 'JPEG')
+    return converted.getvalue()
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
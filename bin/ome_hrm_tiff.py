@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+
+"""Helper module for writing OME-TIFF files in a streaming fashion.
+
+The pixel data of an image is written as uncompressed strips (a number of
+complete rows each) while it is being received, so no more than a single
+strip has to be held in memory at any time. As the size of every strip is
+known beforehand, the complete TIFF structure (the header, the OME-XML
+metadata and the image file directories of all planes) is written first,
+followed by the pixel data of all planes, strip by strip, in the order given
+by the OME-XML (dimension order XYZCT).
+
+Files that would exceed the 4 GB limit of classic TIFF are written as BigTIFF
+(using 64 bit offsets). All data is written in big-endian byte order, which is
+also the order OMERO delivers the raw pixel data in, so the data doesn't have
+to be converted.
+
+No packages besides the Python standard library are required.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import struct
+from xml.sax.saxutils import quoteattr
+
+
+# the OMERO pixel types: (bits per sample, TIFF sample format):
+PIXEL_TYPES = {
+    'int8': (8, 2),
+    'uint8': (8, 1),
+    'int16': (16, 2),
+    'uint16': (16, 1),
+    'int32': (32, 2),
+    'uint32': (32, 1),
+    'float': (32, 3),
+    'double': (64, 3),
+}
+
+# the TIFF field types used:
+ASCII = 2
+SHORT = 3
+LONG = 4
+LONG8 = 16
+
+# the largest file that can be written as classic TIFF:
+CLASSIC_LIMIT = 2 ** 32 - 1
+
+OME_NS = 'http://www.openmicroscopy.org/Schemas/OME/2016-06'
+
+
+class TiffError(Exception):
+
+    """Raised when an image can't be written as OME-TIFF."""
+
+    pass
+
+
+def bytes_per_pixel(pixel_type):
+    """Get the number of bytes per pixel of an OMERO pixel type."""
+    if pixel_type not in PIXEL_TYPES:
+        raise TiffError("unsupported pixel type: %s" % pixel_type)
+    return PIXEL_TYPES[pixel_type][0] // 8
+
+
+def rows_per_strip(size_x, pixel_type, buffer_size):
+    """Determine the number of rows per strip fitting into a buffer size."""
+    return max(1, buffer_size // (size_x * bytes_per_pixel(pixel_type)))
+
+
+def gen_ome_xml(meta):
+    """Assemble the OME-XML metadata for an image.
+
+    Parameters
+    ==========
+    meta : dict - the image metadata, see write_ome_tiff()
+
+    Returns
+    =======
+    str - the OME-XML document (UTF-8 encoded)
+    """
+    pixels = {
+        'ID': 'Pixels:0',
+        'DimensionOrder': 'XYZCT',
+        'Type': meta['type'],
+        'BigEndian': 'true',
+    }
+    for dim in 'XYZCT':
+        pixels['Size' + dim] = str(meta['size' + dim])
+    for dim in 'XYZ':
+        value = meta.get('physicalSize' + dim)
+        if value:
+            pixels['PhysicalSize' + dim] = repr(float(value))
+    attrs = ' '.join(['%s=%s' % (key, quoteattr(pixels[key]))
+                      for key in sorted(pixels)])
+    channels = ''.join(['<Channel ID="Channel:0:%d" SamplesPerPixel="1"/>'
+                        % chan for chan in range(meta['sizeC'])])
+    planes = meta['sizeZ'] * meta['sizeC'] * meta['sizeT']
+    xml = ('<?xml version="1.0" encoding="UTF-8"?>'
+           '<OME xmlns="%s">'
+           '<Image ID="Image:0" Name=%s>'
+           '<Pixels %s>%s<TiffData IFD="0" PlaneCount="%d"/></Pixels>'
+           '</Image></OME>' % (OME_NS, quoteattr(meta.get('name', '')),
+                               attrs, channels, planes))
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    return xml
+
+
+class TiffLayout(object):
+
+    """The structure of an uncompressed (Big)TIFF file with identical planes.
+
+    Parameters
+    ==========
+    size_x, size_y : int - the size of the planes in pixels
+    planes : int - the number of planes
+    pixel_type : str - the OMERO pixel type, e.g. 'uint16'
+    rows : int - the number of rows per strip
+    description : str - the content of the ImageDescription tag of the first
+                  plane
+    bigtiff : bool - write BigTIFF, None to decide based on the file size
+    """
+
+    def __init__(self, size_x, size_y, planes, pixel_type, rows, description,
+                 bigtiff=None):
+        self.size_x = size_x
+        self.size_y = size_y
+        self.planes = planes
+        self.bits, self.sample_format = PIXEL_TYPES[pixel_type]
+        self.row_bytes = size_x * self.bits // 8
+        self.rows = min(rows, size_y)
+        self.strips = (size_y + self.rows - 1) // self.rows
+        self.plane_bytes = self.row_bytes * size_y
+        self.description = description + '\0'
+        if bigtiff is None:
+            bigtiff = self._data_offset(False) + self.data_bytes > \
+                CLASSIC_LIMIT
+        self.bigtiff = bigtiff
+        self.data_offset = self._data_offset(bigtiff)
+
+    @property
+    def data_bytes(self):
+        """The total size of the pixel data."""
+        return self.plane_bytes * self.planes
+
+    @property
+    def file_size(self):
+        """The total size of the file."""
+        return self.data_offset + self.data_bytes
+
+    def strip_sizes(self):
+        """The number of bytes of each strip of a plane."""
+        sizes = [self.rows * self.row_bytes] * self.strips
+        sizes[-1] = self.plane_bytes - (self.strips - 1) * sizes[0]
+        return sizes
+
+    def _sizes(self, bigtiff):
+        """Get the sizes of the structures of a (Big)TIFF file.
+
+        Returns
+        =======
+        (int, int, int, int) - the size of the header, of the fixed part of an
+        IFD (the number of entries and the offset of the next IFD), of an IFD
+        entry and of an offset (being the size of an entry's value field)
+        """
+        if bigtiff:
+            return 16, 8 + 8, 20, 8
+        return 8, 2 + 4, 12, 4
+
+    def _ifd_size(self, bigtiff, first):
+        """Get the size of a plane's IFD including its out-of-line values."""
+        _, ifd_base, entry_size, offset_size = self._sizes(bigtiff)
+        entries = 12 if first else 11
+        size = ifd_base + entries * entry_size
+        if self.strips * offset_size > offset_size:
+            # the strip offsets and byte counts don't fit into the entries:
+            size += 2 * self.strips * offset_size
+        return size
+
+    def _data_offset(self, bigtiff):
+        """Get the offset of the pixel data, following all IFDs."""
+        header = self._sizes(bigtiff)[0]
+        desc = len(self.description) + len(self.description) % 2
+        return (header + desc + self._ifd_size(bigtiff, True) +
+                (self.planes - 1) * self._ifd_size(bigtiff, False))
+
+    def write_header(self, outfile):
+        """Write the header, the description and the IFDs of all planes."""
+        header, _, _, _ = self._sizes(self.bigtiff)
+        desc_offset = header
+        desc = self.description + '\0' * (len(self.description) % 2)
+        ifd_offset = desc_offset + len(desc)
+        if self.bigtiff:
+            outfile.write(struct.pack('>2sHHHQ', 'MM', 43, 8, 0, ifd_offset))
+        else:
+            outfile.write(struct.pack('>2sHI', 'MM', 42, ifd_offset))
+        outfile.write(desc)
+        data_offset = self.data_offset
+        for plane in range(self.planes):
+            size = self._ifd_size(self.bigtiff, plane == 0)
+            next_ifd = ifd_offset + size if plane < self.planes - 1 else 0
+            outfile.write(self._gen_ifd(ifd_offset, next_ifd, data_offset,
+                                        desc_offset if plane == 0 else None))
+            ifd_offset += size
+            data_offset += self.plane_bytes
+
+    def _gen_ifd(self, ifd_offset, next_ifd, data_offset, desc_offset):
+        """Assemble the IFD of a plane, followed by its out-of-line values."""
+        _, ifd_base, entry_size, offset_size = self._sizes(self.bigtiff)
+        offset_type = LONG8 if self.bigtiff else LONG
+        offset_fmt = 'Q' if self.bigtiff else 'I'
+        sizes = self.strip_sizes()
+        offsets = [data_offset + sum(sizes[:idx]) for idx in range(len(sizes))]
+        entries = [
+            (256, LONG, 1, self.size_x),
+            (257, LONG, 1, self.size_y),
+            (258, SHORT, 1, self.bits),
+            (259, SHORT, 1, 1),
+            (262, SHORT, 1, 1),
+        ]
+        if desc_offset is not None:
+            entries.append((270, ASCII, len(self.description), desc_offset))
+        entries.extend([
+            (273, offset_type, self.strips, offsets),
+            (277, SHORT, 1, 1),
+            (278, LONG, 1, self.rows),
+            (279, offset_type, self.strips, sizes),
+            (284, SHORT, 1, 1),
+            (339, SHORT, 1, self.sample_format),
+        ])
+        extra_offset = ifd_offset + ifd_base + len(entries) * entry_size
+        extra = []
+        if self.bigtiff:
+            ifd = [struct.pack('>Q', len(entries))]
+        else:
+            ifd = [struct.pack('>H', len(entries))]
+        for tag, ftype, count, value in entries:
+            if isinstance(value, list):
+                if count > 1:
+                    extra.append(struct.pack('>%d%s' % (count, offset_fmt),
+                                             *value))
+                    value = extra_offset
+                    extra_offset += count * offset_size
+                else:
+                    value = value[0]
+            if ftype == SHORT:
+                # values are left-justified in the value field:
+                value = value << (8 * (offset_size - 2))
+            elif ftype == LONG and self.bigtiff:
+                value = value << 32
+            if self.bigtiff:
+                ifd.append(struct.pack('>HHQQ', tag, ftype, count, value))
+            else:
+                ifd.append(struct.pack('>HHII', tag, ftype, count, value))
+        ifd.append(struct.pack('>' + offset_fmt, next_ifd))
+        return ''.join(ifd + extra)
+
+
+def write_ome_tiff(outfile, meta, strips, buffer_size=16 * 1024 * 1024,
+                   progress=None, bigtiff=None):
+    """Write an image as OME-TIFF, streaming the pixel data strip by strip.
+
+    Parameters
+    ==========
+    outfile : file - the file to write to (opened in binary mode)
+    meta : dict - the image metadata with the keys 'sizeX', 'sizeY', 'sizeZ',
+           'sizeC', 'sizeT' (the dimensions of the image to write), 'type'
+           (the OMERO pixel type, e.g. 'uint16') and optionally 'name' and
+           'physicalSizeX', 'physicalSizeY', 'physicalSizeZ' (in microns)
+    strips : callable - called as strips(rows) with the number of rows per
+             strip, returning an iterable of the (big-endian) pixel data of
+             all strips of all planes in XYZCT order
+    buffer_size : int - the maximum number of bytes per strip (unless a
+                  single row is larger than that)
+    progress : callable - (optional) called as progress(done, total) with the
+               number of bytes written after the header and every strip
+    bigtiff : bool - write BigTIFF (True) or classic TIFF (False), None to
+              use BigTIFF only if required by the size of the file
+
+    Returns
+    =======
+    int - the number of bytes written
+
+    Raises
+    ======
+    TiffError - if the pixel type is not supported or the data received
+    doesn't match the expected size
+    """
+    rows = rows_per_strip(meta['sizeX'], meta['type'], buffer_size)
+    layout = TiffLayout(meta['sizeX'], meta['sizeY'],
+                        meta['sizeZ'] * meta['sizeC'] * meta['sizeT'],
+                        meta['type'], rows, gen_ome_xml(meta), bigtiff)
+    layout.write_header(outfile)
+    done = outfile.tell()
+    total = layout.file_size
+    sizes = layout.strip_sizes()
+    expected = (size for _ in range(layout.planes) for size in sizes)
+    if progress is not None:
+        progress(done, total)
+    for data in strips(layout.rows):
+        if len(data) != next(expected, None):
+            raise TiffError("unexpected amount of pixel data received")
+        outfile.write(data)
+        done += len(data)
+        if progress is not None:
+            progress(done, total)
+    if done != total:
+        raise TiffError("incomplete pixel data received")
+    return done
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
@@ -0,0 +1,594 @@
+#!/usr/bin/env python
+
+"""Helper module for transferring original files from OMERO.
+
+Files are streamed through a RawFileStore in chunks of a configurable size
+into a temporary ".part" file next to the target. An interrupted transfer
+leaves the ".part" file behind, so the next attempt can continue from where
+the previous one stopped. Only once the checksum of the complete file matches
+the one stored in OMERO, the ".part" file is (atomically) moved to the
+actual target name, which never replaces a file that has been created there
+in the meantime (see move_into_place()).
+
+Optionally, large files can be fetched using several streams (i.e. several
+RawFileStore proxies) in parallel, each of them requesting different chunks
+of the file and writing them to their position in the (preallocated) ".part"
+file. In this case the completed chunks are recorded in a ".chunks" file
+alongside, so interrupted transfers can be resumed as well.
+
+Images without original files (e.g. imported before OMERO 5) can be exported
+as OME-TIFF instead, streaming the pixel data from a RawPixelsStore in strips
+of a bounded size (see ome_hrm_tiff). The next strip is requested from the
+server while the previous one is being written. The export can be restricted
+to a sub-volume of the image (selected channels, Z slices and timepoints and
+a rectangular region of the XY plane), so only the pixel data actually needed
+is transferred.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import os
+import errno
+import hashlib
+import threading
+import zlib
+import Queue
+
+import ome_hrm_tiff
+
+
+# the suffix for files that are being transferred:
+PART_SUFFIX = '.part'
+
+# the suffix for the list of completed chunks of a multi-stream transfer:
+CHUNKS_SUFFIX = '.chunks'
+
+# the default number of bytes to request from the server at once:
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# the default maximum number of bytes per strip of an OME-TIFF export:
+EXPORT_BUFFER = 16 * 1024 * 1024
+
+
+class TransferError(Exception):
+
+    """Raised when a transfer fails or the transferred data is corrupt."""
+
+    pass
+
+
+class ZlibChecksum(object):
+
+    """A hashlib-like wrapper for the zlib checksum functions."""
+
+    def __init__(self, func):
+        self._func = func
+        self._value = func('')
+
+    def update(self, data):
+        """Add data to the checksum."""
+        self._value = self._func(data, self._value)
+
+    def hexdigest(self):
+        """Return the checksum as a hex string."""
+        return '%08x' % (self._value & 0xffffffff)
+
+
+# the checksum algorithms used by OMERO that we can verify locally:
+HASHERS = {
+    'SHA1-160': hashlib.sha1,
+    'MD5-128': hashlib.md5,
+    'Adler-32': lambda: ZlibChecksum(zlib.adler32),
+    'CRC-32': lambda: ZlibChecksum(zlib.crc32),
+}
+
+
+def get_file_info(conn, ofile_id, ctx=None):
+    """Get size and checksum of an original file from OMERO.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    ofile_id : int - the ID of the OriginalFile
+    ctx : omero.gateway.ServiceOptsDict - (optional) the call context (e.g.
+          for the group of the file), conn.SERVICE_OPTS by default
+
+    Returns
+    =======
+    (size, hash, hasher) : (long, str, str) - the file size, the checksum and
+    the name of the checksum algorithm (e.g. 'SHA1-160'), the latter two being
+    None if OMERO doesn't know the checksum of the file.
+    """
+    from omero.sys import ParametersI
+    params = ParametersI()
+    params.addId(ofile_id)
+    rows = conn.getQueryService().projection(
+        "select f.size, f.hash, h.value from OriginalFile f "
+        "left outer join f.hasher h where f.id = :id",
+        params, ctx if ctx is not None else conn.SERVICE_OPTS)
+    if not rows:
+        raise TransferError("original file %s not found" % ofile_id)
+    return tuple([col.val if col is not None else None for col in rows[0]])
+
+
+def hash_file(fname, hasher, limit=None, chunk_size=CHUNK_SIZE):
+    """Feed the (first 'limit' bytes of the) content of a file into a hasher."""
+    with open(fname, 'rb') as infile:
+        remaining = limit
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size,
+                                                            remaining)
+            data = infile.read(size)
+            if not data:
+                break
+            hasher.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return hasher
+
+
+def is_complete(conn, ofile_id, target):
+    """Check if a local file is a complete copy of an original file.
+
+    This is the case if size and checksum of the local file match the ones
+    stored in OMERO. Files of unknown checksum are never considered complete.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    ofile_id : int - the ID of the OriginalFile
+    target : str - the local file
+
+    Returns
+    =======
+    bool
+    """
+    size, checksum, algorithm = get_file_info(conn, ofile_id)
+    if checksum is None or algorithm not in HASHERS:
+        return False
+    if os.path.getsize(target) != size:
+        return False
+    hasher = hash_file(target, HASHERS[algorithm]())
+    return hasher.hexdigest() == checksum.lower()
+
+
+def download_original_file(conn, ofile_id, target, chunk_size=CHUNK_SIZE,
+                           progress=None, streams=1, info=None, ctx=None):
+    """Download an original file in chunks, resuming partial transfers.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    ofile_id : int - the ID of the OriginalFile to download
+    target : str - the local filename to store the file as
+    chunk_size : int - the number of bytes to request from the server at once
+    progress : callable - (optional) called as progress(done, total) with the
+               number of bytes after every chunk
+    streams : int - the number of parallel streams to use for files larger
+              than a single chunk, see download_chunks_parallel()
+    info : tuple - (optional) the result of get_file_info() for the file, if
+           it is known already
+    ctx : omero.gateway.ServiceOptsDict - (optional) the call context (e.g.
+          for the group of the file), conn.SERVICE_OPTS by default
+
+    Returns
+    =======
+    int - the number of bytes that actually had to be transferred
+
+    Raises
+    ======
+    TransferError - if the checksum of the downloaded data doesn't match
+    """
+    if ctx is None:
+        ctx = conn.SERVICE_OPTS
+    if info is None:
+        info = get_file_info(conn, ofile_id, ctx)
+    size, checksum, algorithm = info
+    hasher = None
+    if checksum is not None and algorithm in HASHERS:
+        hasher = HASHERS[algorithm]()
+    part = target + PART_SUFFIX
+    # partial multi-stream transfers have to be continued chunk-wise:
+    if ((streams > 1 and size > chunk_size) or
+            os.path.exists(part + CHUNKS_SUFFIX)):
+        transferred = download_chunks_parallel(
+            conn, ofile_id, size, part, chunk_size, progress, streams, ctx)
+        if hasher is not None:
+            hash_file(part, hasher, chunk_size=chunk_size)
+        verify_and_rename(ofile_id, part, target, hasher, checksum)
+        return transferred
+    offset = 0
+    if os.path.exists(part):
+        offset = os.path.getsize(part)
+        if offset > size:
+            os.unlink(part)
+            offset = 0
+        elif hasher is not None:
+            hash_file(part, hasher, offset, chunk_size)
+    rfs = conn.c.sf.createRawFileStore()
+    try:
+        rfs.setFileId(ofile_id, ctx)
+        with open(part, 'ab') as outfile:
+            done = offset
+            if progress is not None:
+                progress(done, size)
+            while done < size:
+                data = rfs.read(done, min(chunk_size, size - done))
+                if not data:
+                    raise TransferError("unexpected end of file %s at byte %s"
+                                        % (ofile_id, done))
+                outfile.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+                done += len(data)
+                if progress is not None:
+                    progress(done, size)
+    finally:
+        rfs.close()
+    verify_and_rename(ofile_id, part, target, hasher, checksum)
+    return size - offset
+
+
+def verify_and_rename(ofile_id, part, target, hasher, checksum):
+    """Check the checksum of a completed transfer and move it into place.
+
+    Parameters
+    ==========
+    ofile_id : int - the ID of the OriginalFile (for the error message)
+    part : str - the file containing the transferred data
+    target : str - the final filename
+    hasher : hashlib-like object - the hasher fed with the transferred data or
+             None if the checksum can't be verified
+    checksum : str - the checksum expected by OMERO
+
+    Raises
+    ======
+    TransferError - if the checksum doesn't match
+    """
+    chunks = part + CHUNKS_SUFFIX
+    if hasher is not None and hasher.hexdigest() != checksum.lower():
+        # don't try to resume corrupted data next time:
+        os.unlink(part)
+        if os.path.exists(chunks):
+            os.unlink(chunks)
+        raise TransferError("checksum mismatch for original file %s" %
+                            ofile_id)
+    move_into_place(part, target)
+    if os.path.exists(chunks):
+        os.unlink(chunks)
+
+
+def move_into_place(part, target):
+    """Atomically move a completed transfer to its target, never replacing it.
+
+    The ".part" file is hard-linked to the target (failing if the target
+    exists) and removed afterwards. On file systems not supporting hard links
+    it is renamed instead (after checking that the target doesn't exist).
+
+    Raises
+    ======
+    TransferError - if the target exists already, the ".part" file is kept
+    """
+    try:
+        os.link(part, target)
+    except OSError as err:
+        if err.errno == errno.EEXIST:
+            raise TransferError("target file '%s' already existing" % target)
+        if os.path.exists(target):
+            raise TransferError("target file '%s' already existing" % target)
+        os.rename(part, target)
+        return
+    os.unlink(part)
+
+
+def read_completed_chunks(part, chunk_size):
+    """Determine the chunks already present in a partial transfer.
+
+    For multi-stream transfers the completed chunks are listed (one index per
+    line) in the ".chunks" file, for sequential ones everything up to the end
+    of the ".part" file has been transferred.
+
+    Returns
+    =======
+    set(int) - the indices of the completed chunks
+    """
+    chunks = part + CHUNKS_SUFFIX
+    if os.path.exists(chunks):
+        with open(chunks, 'r') as infile:
+            return set([int(line) for line in infile if line.strip()])
+    if os.path.exists(part):
+        return set(range(os.path.getsize(part) // chunk_size))
+    return set()
+
+
+def download_chunks_parallel(conn, ofile_id, size, part, chunk_size,
+                             progress, streams, ctx=None):
+    """Download the chunks of an original file using parallel streams.
+
+    Each stream uses its own RawFileStore proxy and file handle, picking the
+    next missing chunk from a common queue and writing it to its position in
+    the preallocated ".part" file. Completed chunks get recorded in the
+    ".chunks" file, so a later attempt only requests the missing ones.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    ofile_id : int - the ID of the OriginalFile to download
+    size : long - the size of the file
+    part : str - the file to write the data to
+    chunk_size : int - the number of bytes per chunk
+    progress : callable - (optional) called as progress(done, total)
+    streams : int - the number of parallel streams
+    ctx : omero.gateway.ServiceOptsDict - (optional) the call context,
+          conn.SERVICE_OPTS by default
+
+    Returns
+    =======
+    int - the number of bytes that actually had to be transferred
+
+    Raises
+    ======
+    TransferError - if any of the streams failed
+    """
+    if ctx is None:
+        ctx = conn.SERVICE_OPTS
+    nchunks = (size + chunk_size - 1) // chunk_size
+    completed = read_completed_chunks(part, chunk_size)
+    missing = Queue.Queue()
+    for index in range(nchunks):
+        if index not in completed:
+            missing.put(index)
+    transferred = [0]
+    done = [len(completed) * chunk_size]
+    errors = []
+    lock = threading.Lock()
+    # record the chunks of a sequential transfer we're continuing:
+    if not os.path.exists(part + CHUNKS_SUFFIX):
+        with open(part + CHUNKS_SUFFIX, 'w') as outfile:
+            outfile.writelines(['%d\n' % index for index in sorted(completed)])
+    # preallocate the target (sparse, if supported by the filesystem):
+    with open(part, 'ab') as outfile:
+        outfile.truncate(size)
+    record = open(part + CHUNKS_SUFFIX, 'a')
+
+    def fetch():
+        """Transfer chunks from the queue until it's empty or a stream fails."""
+        rfs = conn.c.sf.createRawFileStore()
+        try:
+            rfs.setFileId(ofile_id, ctx)
+            with open(part, 'r+b') as outfile:
+                while not errors:
+                    try:
+                        index = missing.get_nowait()
+                    except Queue.Empty:
+                        return
+                    offset = index * chunk_size
+                    length = min(chunk_size, size - offset)
+                    data = rfs.read(offset, length)
+                    if len(data) != length:
+                        raise TransferError("short read of file %s at byte %s"
+                                            % (ofile_id, offset))
+                    outfile.seek(offset)
+                    outfile.write(data)
+                    outfile.flush()
+                    with lock:
+                        record.write('%d\n' % index)
+                        record.flush()
+                        transferred[0] += length
+                        done[0] += length
+                        if progress is not None:
+                            progress(min(done[0], size), size)
+        except Exception as err:  # pylint: disable=broad-except
+            errors.append(err)
+        finally:
+            rfs.close()
+
+    workers = [threading.Thread(target=fetch)
+               for _ in range(max(1, min(streams, missing.qsize())))]
+    if progress is not None:
+        progress(min(done[0], size), size)
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        record.close()
+    if errors:
+        raise TransferError("downloading file %s failed: %s" %
+                            (ofile_id, errors[0]))
+    return transferred[0]
+
+
+def prefetch(iterable):
+    """Iterate over an iterable, fetching the next element in the background.
+
+    Exceptions raised while fetching are re-raised when the element would
+    have been returned. At most two elements are held at a time (besides the
+    one currently used by the caller).
+    """
+    items = Queue.Queue(maxsize=1)
+    stop = threading.Event()
+    end = object()
+
+    def fetch():
+        """Put the elements into the queue until done or stopped."""
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except Queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put((end, None))
+        except Exception as err:  # pylint: disable=broad-except
+            items.put((None, err))
+
+    fetcher = threading.Thread(target=fetch)
+    fetcher.daemon = True
+    fetcher.start()
+    try:
+        while True:
+            item, err = items.get()
+            if err is not None:
+                raise err
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def pixels_info(image_obj):
+    """Get the metadata of the pixels of an image required for exporting it.
+
+    Parameters
+    ==========
+    image_obj : omero.gateway.ImageWrapper
+
+    Returns
+    =======
+    (long, dict) - the ID of the pixels and the metadata of the image, see
+    ome_hrm_tiff.write_ome_tiff()
+    """
+    meta = {
+        'name': image_obj.getName(),
+        'sizeX': image_obj.getSizeX(),
+        'sizeY': image_obj.getSizeY(),
+        'sizeZ': image_obj.getSizeZ(),
+        'sizeC': image_obj.getSizeC(),
+        'sizeT': image_obj.getSizeT(),
+        'type': image_obj.getPixelsType(),
+        'physicalSizeX': image_obj.getPixelSizeX(),
+        'physicalSizeY': image_obj.getPixelSizeY(),
+        'physicalSizeZ': image_obj.getPixelSizeZ(),
+    }
+    return image_obj.getPrimaryPixels().getId(), meta
+
+
+def select_subvolume(meta, subvolume):
+    """Restrict the metadata of an image to a sub-volume.
+
+    Parameters
+    ==========
+    meta : dict - the metadata of the image, see pixels_info()
+    subvolume : dict - the selection, with the (optional) keys 'c', 'z' and
+                't' holding lists of the (zero-based) indices of the channels,
+                Z slices and timepoints to export and 'crop' holding the
+                region of the XY plane as [x, y, width, height]
+
+    Returns
+    =======
+    dict - the metadata of the sub-volume, with the sizes reduced to the
+    selection and the additional keys 'planes' (a dict with the lists of the
+    selected indices for 'z', 'c' and 't') and 'region' (x, y, width, height)
+
+    Raises
+    ======
+    TransferError - if the selection exceeds the dimensions of the image
+    """
+    selected = dict(meta)
+    selected['planes'] = dict()
+    for dim in 'ZCT':
+        size = meta['size' + dim]
+        indices = subvolume.get(dim.lower())
+        if indices is None:
+            indices = range(size)
+        indices = sorted(set(indices))
+        if not indices or indices[0] < 0 or indices[-1] >= size:
+            raise TransferError("the selected %s indices exceed the image "
+                                "size (%d)" % (dim, size))
+        selected['planes'][dim.lower()] = indices
+        selected['size' + dim] = len(indices)
+    xpos, ypos, width, height = subvolume.get(
+        'crop', (0, 0, meta['sizeX'], meta['sizeY']))
+    if (xpos < 0 or ypos < 0 or width < 1 or height < 1 or
+            xpos + width > meta['sizeX'] or ypos + height > meta['sizeY']):
+        raise TransferError("the crop region exceeds the image size "
+                            "(%dx%d)" % (meta['sizeX'], meta['sizeY']))
+    selected['region'] = (xpos, ypos, width, height)
+    selected['sizeX'] = width
+    selected['sizeY'] = height
+    return selected
+
+
+def export_ome_tiff(conn, pixels_id, meta, target, buffer_size=EXPORT_BUFFER,
+                    progress=None, ctx=None):
+    """Export the pixel data of an image as OME-TIFF.
+
+    The pixel data is requested plane by plane in strips of complete rows,
+    each one holding at most 'buffer_size' bytes, and written to a ".part"
+    file that is renamed to the target once complete. Interrupted exports
+    are not resumed but started over. If the metadata was restricted to a
+    sub-volume (see select_subvolume()), only the selected planes and region
+    are requested and written.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    pixels_id : long - the ID of the pixels of the image
+    meta : dict - the metadata of the image, see pixels_info() and
+           select_subvolume()
+    target : str - the local filename to store the OME-TIFF as
+    buffer_size : int - the maximum number of bytes to request at once
+    progress : callable - (optional) called as progress(done, total) with the
+               number of bytes after every strip
+    ctx : omero.gateway.ServiceOptsDict - (optional) the call context (e.g.
+          for the group of the image), conn.SERVICE_OPTS by default
+
+    Returns
+    =======
+    int - the number of bytes written
+
+    Raises
+    ======
+    TransferError - if the pixel type is not supported or the export failed
+    """
+    if ctx is None:
+        ctx = conn.SERVICE_OPTS
+    part = target + PART_SUFFIX
+    rps = conn.c.sf.createRawPixelsStore()
+
+    planes = meta.get('planes', dict())
+    xpos, ypos, width, height = meta.get(
+        'region', (0, 0, meta['sizeX'], meta['sizeY']))
+
+    def strips(rows):
+        """Request the strips of all (selected) planes in XYZCT order."""
+        for tidx in planes.get('t', range(meta['sizeT'])):
+            for cidx in planes.get('c', range(meta['sizeC'])):
+                for zidx in planes.get('z', range(meta['sizeZ'])):
+                    for row in range(ypos, ypos + height, rows):
+                        yield rps.getTile(zidx, cidx, tidx, xpos, row, width,
+                                          min(rows, ypos + height - row),
+                                          ctx)
+
+    try:
+        rps.setPixelsId(pixels_id, True, ctx)
+        with open(part, 'wb') as outfile:
+            nbytes = ome_hrm_tiff.write_ome_tiff(
+                outfile, meta, lambda rows: prefetch(strips(rows)),
+                buffer_size, progress)
+    except ome_hrm_tiff.TiffError as err:
+        if os.path.exists(part):
+            os.unlink(part)
+        raise TransferError("exporting pixels %s failed: %s" %
+                            (pixels_id, err))
+    except Exception:
+        if os.path.exists(part):
+            os.unlink(part)
+        raise
+    finally:
+        rps.close()
+    move_into_place(part, target)
+    return nbytes
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+"""OMERO transfer worker for the Huygens Remote Manager (HRM).
+
+Runs the transfers that were added to the queue of the OMERO connector (see
+the --queue option of the OMEROtoHRM and HRMtoOMERO actions of ome_hrm.py) in
+the background, the same way the queue manager runs the deconvolution jobs.
+Several jobs are processed in parallel, each of them in the OMERO session
+that was created for it when being queued. The progress of every item is
+recorded in the queue, where it can be requested using the "transferStatus"
+action of the connector. Failed items are retried with an exponentially
+increasing delay (see OMERO_QUEUE_ATTEMPTS and OMERO_QUEUE_BACKOFF in the HRM
+config file).
+
+As OMERO closes sessions that are idle for too long, the sessions of jobs
+waiting in the queue are kept alive by the worker.
+"""
+
+# pylint: disable=superfluous-parens
+
+import sys
+import argparse
+import signal
+import threading
+import time
+
+import ome_hrm
+from ome_hrm_queue import DONE, FAILED
+
+
+# the minimum interval (in seconds) between updates of the progress of an item:
+PROGRESS_INTERVAL = 1.0
+
+
+def join_session(session):
+    """Connect to OMERO using an existing session.
+
+    Returns
+    =======
+    conn : omero.gateway.BlitzGateway - the connection, None if the session
+    doesn't exist (anymore)
+    """
+    conn = ome_hrm.BlitzGateway(host=ome_hrm.HOST, port=ome_hrm.PORT,
+                                secure=True, useragent="HRM-OMERO.connector")
+    try:
+        if conn.connect(sUuid=session) and conn.keepAlive():
+            return conn
+    except Exception:  # pylint: disable=broad-except
+        pass
+    return None
+
+
+class ProgressRecorder(object):
+
+    """Record the progress of the items of a job in the queue.
+
+    The number of bytes transferred for every file is summed up per item, the
+    queue is updated at most every PROGRESS_INTERVAL seconds per item.
+    """
+
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+        self._files = dict()
+        self._updated = dict()
+        self._lock = threading.Lock()
+
+    def __call__(self, item, fname, done, total):
+        idx = item['index']
+        with self._lock:
+            self._files.setdefault(idx, dict())[fname] = (done, total)
+            now = time.time()
+            if (done < total and
+                    now - self._updated.get(idx, 0) < PROGRESS_INTERVAL):
+                return
+            self._updated[idx] = now
+            files = self._files[idx].values()
+        self.queue.progress(self.job_id, idx, sum([f[0] for f in files]),
+                            sum([f[1] for f in files]))
+
+
+def run_job(queue, job):
+    """Run the items of a queued job that still have to be transferred.
+
+    The job is always finished (see ome_hrm_queue.TransferQueue.finish()),
+    even if running it raises an exception, so it never stays marked as
+    running.
+
+    Returns
+    =======
+    str - the state of the job afterwards
+    """
+    conn = None
+    state = None
+    try:
+        conn = join_session(job['session'])
+        if conn is None:
+            queue.fail(job['id'], 'ERROR: the OMERO session of the transfer '
+                       'has expired, please request it again!')
+            state = FAILED
+            return state
+        items = []
+        for queued in job['items']:
+            item = ome_hrm.new_transfer_item(queued['id'])
+            for key in ('dest', 'file', 'subvolume'):
+                if key in queued:
+                    item[key] = queued[key]
+            item['index'] = queued['index']
+            items.append(item)
+        options = job['options']
+        progress = ProgressRecorder(queue, job['id'])
+        if job['action'] == 'OMEROtoHRM':
+            ome_hrm.omero_to_hrm_batch(conn, items, progress=progress,
+                                       **options)
+        else:
+            cache = ome_hrm.open_tree_cache()
+            try:
+                ome_hrm.hrm_to_omero_batch(conn, items, cache=cache,
+                                           progress=progress, **options)
+            finally:
+                if cache is not None:
+                    cache.close()
+        for item in items:
+            queue.finish_item(job['id'], item['index'], item['success'],
+                              item['messages'], item.get('retry', True))
+    finally:
+        if state is None:
+            state = queue.finish(job['id'])
+        if conn is not None:
+            # the session is not needed anymore once the job is finished:
+            ome_hrm.omero_logout(conn,
+                                 keep_session=state not in (DONE, FAILED))
+    return state
+
+
+def keep_sessions_alive(queue):
+    """Keep the sessions of the jobs waiting in the queue alive."""
+    for job_id, session in queue.waiting():
+        conn = join_session(session)
+        if conn is None:
+            queue.fail(job_id, 'ERROR: the OMERO session of the transfer has '
+                       'expired, please request it again!')
+        else:
+            ome_hrm.omero_logout(conn, keep_session=True)
+
+
+def work(queue, poll, once=False):
+    """Run the jobs from the queue in an endless loop.
+
+    Parameters
+    ==========
+    queue : ome_hrm_queue.TransferQueue
+    poll : float - the number of seconds to wait if no job is due
+    once : bool - if True, return as soon as no job is due
+    """
+    while True:
+        job = queue.claim()
+        if job is None:
+            if once:
+                return
+            time.sleep(poll)
+            continue
+        start = time.time()
+        try:
+            state = run_job(queue, job)
+        except Exception as err:  # pylint: disable=broad-except
+            state = 'error: %s' % err
+        print("transfer job %s (%s, %s, %d items): %s after %.1f s" % (
+            job['id'], job['action'], job['user'], len(job['items']), state,
+            time.time() - start))
+        sys.stdout.flush()
+
+
+def parse_arguments():
+    """Parse the commandline arguments."""
+    argparser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument(
+        '-w', '--workers', type=int, default=ome_hrm.QUEUE_WORKERS,
+        help='number of jobs to run in parallel (default: %(default)s)')
+    argparser.add_argument(
+        '-p', '--poll', type=float, default=5,
+        help='seconds to wait for new jobs if the queue is empty '
+        '(default: %(default)s)')
+    argparser.add_argument(
+        '-k', '--keepalive', type=float, default=60,
+        help='interval (in seconds) for keeping the sessions of waiting jobs '
+        'alive (default: %(default)s)')
+    argparser.add_argument(
+        '--once', action='store_true',
+        help='exit as soon as there are no more jobs due in the queue')
+    argparser.add_argument(
+        '--purge', type=float, default=7,
+        help='days after which finished jobs are removed from the queue '
+        '(default: %(default)s)')
+    return argparser.parse_args()
+
+
+def main():
+    """Start the workers and run queued transfers until terminated."""
+    args = parse_arguments()
+    ome_hrm.import_omero()
+    queue = ome_hrm.open_transfer_queue()
+    if queue is None:
+        print("ERROR: the transfer queue in '%s' is not usable." %
+              ome_hrm.CONNECTOR_DIR)
+        return 2
+    workers = []
+    for _ in range(max(1, args.workers)):
+        worker = threading.Thread(target=work,
+                                  args=(queue, args.poll, args.once))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while any([worker.is_alive() for worker in workers]):
+            queue.purge(args.purge * 24 * 3600)
+            keep_sessions_alive(queue)
+            for worker in workers:
+                worker.join(args.keepalive / len(workers))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
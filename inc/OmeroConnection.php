@@ -38,9 +38,13 @@ class OmeroConnection
 
     /**
      * OMERO connector executable.
+     *
+     * This is the thin client forwarding requests to the connector daemon
+     * (if running), which falls back to running "bin/ome_hrm.py" otherwise.
+     *
      * @var string
      */
-    private $omeroWrapper = "bin/ome_hrm.py";
+    private $omeroWrapper = "bin/ome_hrm_client.py";
 
     /**
      * Array map to hold children in JSON format.
@@ -53,6 +57,18 @@ class OmeroConnection
      */
     private $nodeChildren = array();
 
+    /**
+     * Array map of the nodes to request from OMERO itself.
+     *
+     * The IDs of the nodes that had been loaded before the tree was reset.
+     * The connector shares the children it retrieved between all HRM sessions
+     * for a while, so these are requested bypassing that cache once (see the
+     * "--refresh" option of retrieveChildren) to get up-to-date information.
+     *
+     * @var array
+     */
+    private $staleNodes = array();
+
 
     /**
      * OmeroConnection constructor.
@@ -115,31 +131,43 @@ class OmeroConnection
      * Retrieve selected images from the OMERO server.
      * @param string $images JSON object with IDs and names of selected images.
      * @param Fileserver $fileServer Instance of the Fileserver class.
+     * @param callable $onEvent (optional) Called with every progress event
+     * of the transfer (as an array) as soon as it occurs, see runBatch().
      * @return string A human readable string reporting success and failed images.
      */
-    public function downloadFromOMERO($images, Fileserver $fileServer)
+    public function downloadFromOMERO($images, Fileserver $fileServer,
+                                      $onEvent = NULL)
     {
         $selected = json_decode($images, true);
         $fail = "";
         $done = "";
+        // all images are requested in a single call of the connector, the
+        // list of images is passed on as a JSON manifest file:
+        $manifest = array();
         foreach ($selected as $img) {
             $fileAndPath = $fileServer->sourceFolder() . "/" . $img['name'];
-            $param = array("--imageid", $img{'id'}, "--dest", $fileAndPath);
-            $cmd = $this->buildCmd("OMEROtoHRM", $param);
-
             $this->omelog('requesting ' . $img['id'] . ' to ' . $fileAndPath);
-            // somehow exec() seems to append to $out instead of overwriting
-            // it, so we create an empty array for it explicitly:
-            $out = array();
-            exec($cmd, $out, $retval);
+            $entry = array("id" => $img['id'], "dest" => $fileAndPath);
+            // optionally only a sub-volume of the image is requested:
+            if (isset($img['subvolume'])) {
+                $entry['subvolume'] = $img['subvolume'];
+            }
+            array_push($manifest, $entry);
+        }
+        if ($this->useTransferQueue()) {
+            return $this->enqueueBatch("OMEROtoHRM", $manifest);
+        }
+        $results = $this->runBatch("OMEROtoHRM", $manifest, $onEvent);
+        foreach ($results as $result) {
+            $out = $result['messages'];
             $this->omelog(implode(' ', $out));
-            if ($retval != 0) {
-                $this->omelog("failed retrieving " . $img['id'], 1);
+            if (!$result['success']) {
+                $this->omelog("failed retrieving " . $result['id'], 1);
                 $this->omelog("ERROR: downloadFromOMERO(): " . implode(' ', $out), 2);
-                $fail .= "<br/>" . $img['id'] . "&nbsp;&nbsp;&nbsp;&nbsp;";
+                $fail .= "<br/>" . $result['id'] . "&nbsp;&nbsp;&nbsp;&nbsp;";
                 $fail .= "[" . implode(' ', $out) . "]<br/>";
             } else {
-                $this->omelog("successfully retrieved " . $img['id'], 1);
+                $this->omelog("successfully retrieved " . $result['id'], 1);
                 $done .= "<br/>" . implode('<br/>', $out) . "<br/>";
             }
         }
@@ -163,9 +191,12 @@ class OmeroConnection
      * Attach a deconvolved image to an OMERO dataset.
      * @param array $postedParams An alias of $_POST with names of selected files.
      * @param Fileserver $fileServer An instance of the Fileserver class.
+     * @param callable $onEvent (optional) Called with every progress event
+     * of the transfer (as an array) as soon as it occurs, see runBatch().
      * @return string A human readable string reporting success and failed images.
      */
-    public function uploadToOMERO(array $postedParams, Fileserver $fileServer)
+    public function uploadToOMERO(array $postedParams, Fileserver $fileServer,
+                                  $onEvent = NULL)
     {
         $selectedFiles = json_decode($postedParams['selectedFiles']);
 
@@ -183,25 +214,34 @@ class OmeroConnection
 
         $datasetId = $postedParams['OmeDatasetId'];
 
-        /* Export all the selected files. */
+        /* Export all the selected files (in a single call of the connector). */
         $fail = "";
         $done = "";
+        $skipped = "";
+        $manifest = array();
         foreach ($selectedFiles as $file) {
             // TODO: check if $file may contain relative paths!
             $fileAndPath = $fileServer->destinationFolder() . "/" . $file;
-            $param = array("--file", $fileAndPath, "--dset", $datasetId);
-            $cmd = $this->buildCmd("HRMtoOMERO", $param);
-
             $this->omelog('uploading "' . $fileAndPath . '" to dataset ' . $datasetId);
-            // somehow exec() seems to append to $out instead of overwriting
-            // it, so we create an empty array for it explicitly:
-            $out = array();
-            exec($cmd, $out, $retval);
-            if ($retval != 0) {
+            array_push($manifest,
+                array("id" => $datasetId, "file" => $fileAndPath));
+        }
+        if ($this->useTransferQueue()) {
+            return $this->enqueueBatch("HRMtoOMERO", $manifest);
+        }
+        $results = $this->runBatch("HRMtoOMERO", $manifest, $onEvent);
+        foreach ($results as $index => $result) {
+            $file = $selectedFiles[$index];
+            $out = $result['messages'];
+            if (!$result['success']) {
                 $this->omelog("failed uploading file to OMERO: " . $file, 1);
                 $this->omelog("ERROR: uploadToOMERO(): " . implode(' ', $out), 2);
                 $fail .= "<br/>" . $file . "&nbsp;&nbsp;&nbsp;&nbsp;";
                 $fail .= "[" . implode(' ', $out) . "]<br/>";
+            } elseif (!empty($result['skipped'])) {
+                $this->omelog("file already in OMERO, skipped: " . $file, 2);
+                $skipped .= "<br/>" . $file . "&nbsp;&nbsp;&nbsp;&nbsp;";
+                $skipped .= "[" . implode(' ', $out) . "]";
             } else {
                 $this->omelog("success uploading file to OMERO: " . $file, 2);
                 $done .= "<br/>" . $file;
@@ -216,6 +256,9 @@ class OmeroConnection
             $msg .= "Successfully uploaded to OMERO:<br/>" . $done . "<br/>";
             $msg .= "</font>";
         }
+        if ($skipped != "") {
+            $msg .= "<br/>Already in OMERO (skipped):<br/>" . $skipped . "<br/>";
+        }
         if ($fail != "") {
             $msg .= "<font color='red'>";
             $msg .= "<br/><br/>FAILED uploading to OMERO:<br/>" . $fail;
@@ -267,6 +310,154 @@ class OmeroConnection
     }
 
 
+    /**
+     * Run a transfer action of the connector in batch mode.
+     *
+     * The items are written to a JSON manifest file that is passed on to the
+     * connector, which in turn writes a JSON report with the results for every
+     * single item.
+     *
+     * @param string $command The transfer command, e.g. "OMEROtoHRM".
+     * @param array $items Array of items, each one being an array with the
+     * key 'id' (the OMERO ID) and either 'dest' (the local destination for
+     * downloads) or 'file' (the local file for uploads).
+     * @param callable $onEvent (optional) Called with every event reported
+     * by the connector while transferring (e.g. 'file' once a file has been
+     * transferred completely, having its name as 'file'), see the "--events"
+     * option of the connector.
+     * @return array The results in the same order as the items, each one
+     * being the item array with the additional keys 'success' and 'messages'.
+     */
+    private function runBatch($command, array $items, $onEvent = NULL)
+    {
+        $manifest = tempnam(sys_get_temp_dir(), "hrm_omero_");
+        $report = tempnam(sys_get_temp_dir(), "hrm_omero_");
+        file_put_contents($manifest, json_encode($items));
+        $param = array("--manifest", $manifest, "--report", $report);
+        if ($onEvent !== NULL) {
+            array_push($param, "--events");
+        }
+        $cmd = $this->buildCmd($command, $param);
+        // somehow exec() seems to append to $out instead of overwriting
+        // it, so we create an empty array for it explicitly:
+        $out = array();
+        if ($onEvent === NULL) {
+            exec($cmd, $out, $retval);
+        } else {
+            $out = $this->runWithEvents($cmd, $onEvent);
+        }
+        $results = json_decode(file_get_contents($report), true);
+        unlink($manifest);
+        unlink($report);
+        if (!is_array($results)) {
+            // the connector failed before writing the report:
+            $this->omelog("ERROR: runBatch(): " . implode(' ', $out), 1);
+            $results = array();
+            foreach ($items as $item) {
+                $item['success'] = FALSE;
+                $item['messages'] = $out;
+                array_push($results, $item);
+            }
+        }
+        return $results;
+    }
+
+
+    /**
+     * Run a connector command reporting events, passing them on right away.
+     *
+     * The events are read line by line from the output of the connector
+     * while it is running, its messages (written to stderr in this mode) are
+     * collected in a temporary file.
+     *
+     * @param string $cmd The complete command, see buildCmd().
+     * @param callable $onEvent Called with every event (as an array).
+     * @return array The lines of the messages of the connector.
+     */
+    private function runWithEvents($cmd, $onEvent)
+    {
+        $errors = tempnam(sys_get_temp_dir(), "hrm_omero_");
+        $spec = array(1 => array("pipe", "w"), 2 => array("file", $errors, "w"));
+        $proc = proc_open($cmd, $spec, $pipes);
+        if (is_resource($proc)) {
+            while (($line = fgets($pipes[1])) !== FALSE) {
+                $event = json_decode($line, true);
+                if (is_array($event)) {
+                    call_user_func($onEvent, $event);
+                }
+            }
+            fclose($pipes[1]);
+            proc_close($proc);
+        }
+        $out = file($errors, FILE_IGNORE_NEW_LINES);
+        unlink($errors);
+        return $out === FALSE ? array() : $out;
+    }
+
+    /**
+     * Check if transfers should be run in the background.
+     * @return bool True if the transfer queue is enabled in the configuration.
+     */
+    private function useTransferQueue()
+    {
+        global $omero_transfer_queue;
+        return isset($omero_transfer_queue) && $omero_transfer_queue;
+    }
+
+    /**
+     * Add a batch transfer to the queue of the OMERO transfer worker.
+     *
+     * The connector returns right away, the transfer is run in the background
+     * by the worker (bin/ome_hrm_worker.py).
+     *
+     * @param string $command The transfer command, e.g. "OMEROtoHRM".
+     * @param array $items Array of items, see runBatch().
+     * @return string A human readable string reporting the queued transfer.
+     */
+    private function enqueueBatch($command, array $items)
+    {
+        $manifest = tempnam(sys_get_temp_dir(), "hrm_omero_");
+        file_put_contents($manifest, json_encode($items));
+        $param = array("--manifest", $manifest, "--queue");
+        $cmd = $this->buildCmd($command, $param);
+        $out = array();
+        exec($cmd, $out, $retval);
+        unlink($manifest);
+        $job = json_decode(end($out), true);
+        if ($retval != 0 || !is_array($job)) {
+            $this->omelog("ERROR: enqueueBatch(): " . implode(' ', $out), 1);
+            $msg = "<font color='red'>";
+            $msg .= "FAILED queueing the transfer:<br/>" . implode('<br/>', $out);
+            $msg .= "</font>";
+            return $msg;
+        }
+        $this->omelog("queued transfer job " . $job['job'] . " with " .
+            sizeof($items) . " items", 2);
+        return "The transfer of " . sizeof($items) . " file(s) has been " .
+            "queued (job " . $job['job'] . ") and is running in the " .
+            "background. Please refresh the file list later.";
+    }
+
+    /**
+     * Get the state and progress of a queued transfer.
+     * @param int $jobId The ID of the transfer job.
+     * @return array|bool The job as returned by the connector (with the per
+     * item 'state', 'done' and 'total' bytes and 'messages'), FALSE if the
+     * job can't be found.
+     */
+    public function getTransferStatus($jobId)
+    {
+        $cmd = $this->buildCmd("transferStatus", array("--job", $jobId));
+        $out = array();
+        exec($cmd, $out, $retval);
+        if ($retval != 0) {
+            $this->omelog("ERROR: getTransferStatus(): " . implode(' ', $out), 1);
+            return FALSE;
+        }
+        return json_decode(implode("\n", $out), true);
+    }
+
+
     /* ---------------------- OMERO Tree Assemblers ------------------- */
 
     /**
@@ -278,6 +469,9 @@ class OmeroConnection
     {
         if (!isset($this->nodeChildren[$id])) {
             $param = array('--id', $id);
+            if (isset($this->staleNodes[$id])) {
+                array_push($param, '--refresh');
+            }
             $cmd = $this->buildCmd("retrieveChildren", $param);
             exec($cmd, $out, $retval);
             if ($retval != 0) {
@@ -285,11 +479,29 @@ class OmeroConnection
                 return FALSE;
             } else {
                 $this->nodeChildren[$id] = implode(' ', $out);
+                unset($this->staleNodes[$id]);
             }
         }
         return $this->nodeChildren[$id];
     }
 
+    /**
+     * Find projects, datasets and images by their names.
+     * @param string $query The words to search for.
+     * @return string JSON string with the matching nodes (having the same
+     * IDs as the nodes of the tree), FALSE in case of an error.
+     */
+    public function searchNodes($query)
+    {
+        $cmd = $this->buildCmd("search", array("--query", $query));
+        exec($cmd, $out, $retval);
+        if ($retval != 0) {
+            $this->omelog("ERROR: searchNodes(): " . implode(' ', $out), 1);
+            return FALSE;
+        }
+        return implode(' ', $out);
+    }
+
     /**
      * Reset the array keeping the node data.
      *
@@ -298,6 +510,9 @@ class OmeroConnection
      */
     public function resetNodes()
     {
+        foreach (array_keys($this->nodeChildren) as $id) {
+            $this->staleNodes[$id] = TRUE;
+        }
         $this->nodeChildren = array();
     }
 
@@ -69,7 +69,12 @@ function getSelectedDataset() {
     // dataset in case an image is selected
     var node = $("#omeroTree").tree('getSelectedNode');
     if (node.class == 'Image') {
-        return node.parent.id;
+        // images of large datasets may be on further pages ("More" nodes):
+        var parent = node.parent;
+        while (parent.class == 'More') {
+            parent = parent.parent;
+        }
+        return parent.id;
     } else if (node.class = 'Dataset') {
         return node.id;
     } else {
@@ -91,7 +96,8 @@ function processNodeHTML(node, li) {
         'Experimenter' : 'images/omero_user.png',
         'Project' : 'images/omero_project.png',
         'Dataset' : 'images/omero_dataset.png',
-        'Image' : 'images/omero_image.png'
+        'Image' : 'images/omero_image.png',
+        'More' : 'images/next.png'
     };
     // matching patterns for node types:
     var pat = {
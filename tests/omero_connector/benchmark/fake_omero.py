@@ -0,0 +1,1010 @@
+#!/usr/bin/env python
+
+"""In-process stand-in for the OMERO Python bindings used by the connector.
+
+This module provides a synthetic OMERO "server" (FakeServer) holding a tree of
+groups, users, projects, datasets and images of configurable size, together
+with fake versions of the parts of the OMERO API the HRM connector uses:
+BlitzGateway and its object wrappers, the query service (answering the
+projection queries of the connector), RawFileStore for downloading the fake
+original files and the CLI for importing files.
+
+Like a real server, the queries and object lookups only see the objects of
+the group given by the call context (omero.group, see ServiceOpts), -1 meaning
+all groups of the user and no group at all the default group of the user (the
+first one the user is a member of). The raw file and pixels stores refuse
+files and pixels of other groups (raising SecurityViolation).
+
+Every call that would mean a round trip to a real server is counted (see
+FakeServer.calls) and can optionally be delayed by a fixed latency, which
+makes it possible to judge optimizations by the number of server calls as
+well as by the time they take.
+
+The fake modules have to be registered using install() *before* importing the
+connector (ome_hrm), as this imports the OMERO bindings on its own.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import sys
+import os
+import hashlib
+import re
+import struct
+import threading
+import time
+import types
+import uuid
+
+
+class RType(object):
+
+    """Minimal replacement for the OMERO rtypes wrapping values."""
+
+    def __init__(self, val):
+        self.val = val
+
+    def getValue(self):
+        """Return the wrapped value."""
+        return self.val
+
+
+def rtype(val):
+    """Wrap a value (stand-in for omero.rtypes.rlong, rstring, etc.)."""
+    return RType(val)
+
+
+def unwrap(val):
+    """Unwrap an RType, leave other values untouched."""
+    if isinstance(val, RType):
+        return val.val
+    return val
+
+
+def rlist(vals):
+    """Wrap a list of RTypes (stand-in for omero.rtypes.rlist)."""
+    return RType(list(vals))
+
+
+class ParametersI(object):
+
+    """Replacement for omero.sys.ParametersI (named parameters and paging)."""
+
+    def __init__(self):
+        self.map = dict()
+        self.offset = None
+        self.limit = None
+
+    def addId(self, oid):
+        """Set the 'id' parameter."""
+        self.map['id'] = rtype(oid)
+        return self
+
+    def addIds(self, ids):
+        """Set the 'ids' parameter."""
+        self.map['ids'] = rtype([rtype(oid) for oid in ids])
+        return self
+
+    def addLong(self, name, val):
+        """Set a numeric parameter."""
+        self.map[name] = rtype(val)
+        return self
+
+    def addString(self, name, val):
+        """Set a string parameter."""
+        self.map[name] = rtype(val)
+        return self
+
+    def add(self, name, val):
+        """Set an (already wrapped) parameter."""
+        self.map[name] = val
+        return self
+
+    def page(self, offset, limit):
+        """Restrict the results to a page."""
+        self.offset = offset
+        self.limit = limit
+        return self
+
+
+class FakeServer(object):
+
+    """A synthetic OMERO server with a regular tree of objects.
+
+    Every user is a member of every group and owns 'projects' projects in
+    each of them, each project containing 'datasets' datasets with 'images'
+    images. Each image has a fileset consisting of a single original file of
+    'file_size' bytes (with a SHA1 checksum).
+
+    Parameters
+    ==========
+    groups, users, projects, datasets, images : int - the size of the tree
+    file_size : int - the size of the original files in bytes
+    latency : float - seconds to wait for every (simulated) server call
+    passwd : str - the password accepted for all users
+    """
+
+    def __init__(self, groups=2, users=3, projects=2, datasets=2, images=3,
+                 file_size=20000, latency=0.0, passwd='secret'):
+        self.latency = latency
+        self.passwd = passwd
+        self.lock = threading.Lock()
+        self.groups = dict()
+        self.users = dict()
+        self.projects = dict()
+        self.datasets = dict()
+        self.images = dict()
+        self.ofiles = dict()
+        self.sessions = dict()
+        self.calls = dict()
+        # the IDs of the children of every project and dataset:
+        self.children = dict()
+        self._last_id = 0
+        uids = []
+        for unum in range(users):
+            uid = self.new_id()
+            uids.append(uid)
+            self.users[uid] = {
+                'id': uid, 'omeName': 'user%02d' % unum,
+                'firstName': 'First%d' % unum, 'lastName': 'Last%d' % unum}
+        for gnum in range(groups):
+            gid = self.new_id()
+            self.groups[gid] = {'id': gid, 'name': 'group%02d' % gnum,
+                                'members': list(uids), 'leaders': [],
+                                'permissions': 'rwra--'}
+            for uid in uids:
+                for pnum in range(projects):
+                    pid = self.new_id()
+                    self.projects[pid] = {'id': pid, 'name': 'proj_%d' % pnum,
+                                          'owner': uid, 'group': gid}
+                    for dnum in range(datasets):
+                        did = self.new_id()
+                        self.add_dataset(pid, 'ds_%d' % dnum, did)
+                        for inum in range(images):
+                            self.add_image(did, 'img_%05d.tif' % inum,
+                                           file_size)
+
+    def new_id(self):
+        """Get a new, unique object ID."""
+        self._last_id += 1
+        return self._last_id
+
+    def add_dataset(self, pid, name, did=None):
+        """Add a dataset to a project, return its ID."""
+        proj = self.projects[pid]
+        if did is None:
+            did = self.new_id()
+        self.datasets[did] = {'id': did, 'name': name, 'owner': proj['owner'],
+                              'group': proj['group'], 'project': pid}
+        self.children.setdefault(('Project', pid), []).append(did)
+        return did
+
+    def list_children(self, cls, oid):
+        """Get the dicts of the children of a project or dataset by name."""
+        if cls == 'Project':
+            table = self.datasets
+        else:
+            table = self.images
+        children = [table[child]
+                    for child in self.children.get((cls, oid), [])]
+        return sorted(children, key=lambda obj: obj['name'])
+
+    def add_image(self, did, name, size=0, data=None):
+        """Add an image with a single original file to a dataset.
+
+        Parameters
+        ==========
+        did : int - the ID of the dataset
+        name : str - the name of the image and its original file
+        size : int - the size of the (generated) file content
+        data : str - (optional) the file content to use instead
+
+        Returns
+        =======
+        int - the ID of the new image
+        """
+        dset = self.datasets[did]
+        iid = self.new_id()
+        fid = self.new_id()
+        if data is None:
+            pattern = hashlib.sha1(str(fid)).hexdigest()
+            data = (pattern * (size // len(pattern) + 1))[:size]
+        self.ofiles[fid] = {'id': fid, 'name': name, 'data': data,
+                            'hash': hashlib.sha1(data).hexdigest(),
+                            'group': dset['group']}
+        self.images[iid] = {'id': iid, 'name': name, 'owner': dset['owner'],
+                            'group': dset['group'], 'dataset': did,
+                            'fileset': iid, 'files': [fid]}
+        self.children.setdefault(('Dataset', did), []).append(iid)
+        return iid
+
+    def add_series_images(self, did, name, series, size=0):
+        """Add several images sharing a fileset of one file (e.g. a LIF).
+
+        The images are named "<name> [<series>]" like OMERO does for files
+        containing several series.
+
+        Returns
+        =======
+        list(int) - the IDs of the new images
+        """
+        dset = self.datasets[did]
+        fid = self.new_id()
+        pattern = hashlib.sha1(str(fid)).hexdigest()
+        data = (pattern * (size // len(pattern) + 1))[:size]
+        self.ofiles[fid] = {'id': fid, 'name': name, 'data': data,
+                            'hash': hashlib.sha1(data).hexdigest(),
+                            'group': dset['group']}
+        iids = []
+        for label in series:
+            iid = self.new_id()
+            self.images[iid] = {'id': iid, 'name': '%s [%s]' % (name, label),
+                                'owner': dset['owner'], 'group': dset['group'],
+                                'dataset': did, 'fileset': fid, 'files': [fid]}
+            self.children.setdefault(('Dataset', did), []).append(iid)
+            iids.append(iid)
+        return iids
+
+    def add_legacy_image(self, did, name, sizes=(64, 48, 3, 2, 1),
+                         pixel_type='uint16'):
+        """Add an image without original files (only pixel data) to a dataset.
+
+        Parameters
+        ==========
+        did : int - the ID of the dataset
+        name : str - the name of the image
+        sizes : tuple(int) - the dimensions X, Y, Z, C and T
+        pixel_type : str - the OMERO pixel type
+
+        Returns
+        =======
+        int - the ID of the new image
+        """
+        dset = self.datasets[did]
+        iid = self.new_id()
+        self.images[iid] = {'id': iid, 'name': name, 'owner': dset['owner'],
+                            'group': dset['group'], 'dataset': did,
+                            'fileset': None, 'files': [],
+                            'pixels': {'id': iid, 'sizes': sizes,
+                                       'type': pixel_type}}
+        self.children.setdefault(('Dataset', did), []).append(iid)
+        return iid
+
+    def rename(self, cls, oid, name):
+        """Rename a project, dataset or image (a new update event)."""
+        self.table(cls)[oid].update(name=name, event=self.new_id())
+
+    def remove_image(self, iid):
+        """Delete an image."""
+        image = self.images.pop(iid)
+        for did in image.get('links', [image['dataset']]):
+            self.children[('Dataset', did)].remove(iid)
+
+    def table(self, cls):
+        """Get the objects of a class (Project, Dataset or Image) by ID."""
+        return {'Project': self.projects, 'Dataset': self.datasets,
+                'Image': self.images}[cls]
+
+    def visible_groups(self, user, group=None):
+        """Get the IDs of the groups visible to a user in a call context.
+
+        Parameters
+        ==========
+        user : str - the name of the user
+        group : int or str - the group of the call context, -1 for all groups
+                of the user, None for the default group of the user
+
+        Returns
+        =======
+        set(int) - the group IDs
+        """
+        uid = [usr['id'] for usr in self.users.values()
+               if usr['omeName'] == user][0]
+        member = sorted([gid for gid in self.groups
+                         if uid in self.groups[gid]['members']])
+        if group is None:
+            return set(member[:1])
+        if int(group) == -1:
+            return set(member)
+        return set([int(group)]) & set(member)
+
+    def find_dataset(self, owner=None):
+        """Get the ID of the first dataset (of the given user ID)."""
+        for did in sorted(self.datasets):
+            if owner is None or self.datasets[did]['owner'] == owner:
+                return did
+        return None
+
+    def call(self, name):
+        """Count (and optionally delay) a server call."""
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_calls(self):
+        """Reset the call counters, returning the previous ones."""
+        with self.lock:
+            calls = self.calls
+            self.calls = dict()
+        return calls
+
+
+# the server answering the calls of all fake objects:
+SERVER = [None]
+
+
+def server():
+    """Get the currently installed fake server."""
+    return SERVER[0]
+
+
+class SecurityViolation(Exception):
+
+    """Stand-in for omero.SecurityViolation."""
+
+
+def check_group(conn, gid, ctx=None):
+    """Raise SecurityViolation unless a group is visible in a call context.
+
+    Parameters
+    ==========
+    conn : BlitzGateway - the connection of the user
+    gid : int - the group of the object being accessed
+    ctx : ServiceOpts - (optional) the call context, conn.SERVICE_OPTS by
+          default
+    """
+    if ctx is None:
+        ctx = conn.SERVICE_OPTS
+    if gid not in server().visible_groups(conn.user_name(),
+                                          ctx.getOmeroGroup()):
+        raise SecurityViolation('group %s not in the call context' % gid)
+
+
+class ObjectWrapper(object):
+
+    """Stand-in for the BlitzGateway object wrappers."""
+
+    def __init__(self, cls, obj):
+        self.OMERO_CLASS = cls
+        self._obj = obj
+
+    def getId(self):
+        """Return the object ID."""
+        return self._obj['id']
+
+    def getName(self):
+        """Return the object name."""
+        return self._obj.get('name', self._obj.get('omeName'))
+
+    def isPrivate(self):
+        """Return whether a group is private (its permissions "rw----")."""
+        return self._obj['permissions'][2] != 'r'
+
+    def getFullName(self):
+        """Return the full name of an experimenter."""
+        return '%s %s' % (self._obj['firstName'], self._obj['lastName'])
+
+    def getOwnerOmeName(self):
+        """Return the user name of the owner (needs a server call)."""
+        server().call('getOwnerOmeName')
+        return server().users[self._obj['owner']]['omeName']
+
+    def listChildren(self):
+        """Return the datasets of a project or the images of a dataset."""
+        srv = server()
+        srv.call('listChildren')
+        cls = 'Image'
+        if self.OMERO_CLASS == 'Project':
+            cls = 'Dataset'
+        return [ObjectWrapper(cls, obj) for obj in
+                srv.list_children(self.OMERO_CLASS, self.getId())]
+
+    def getFileset(self):
+        """Return the fileset of an image (None if there is none)."""
+        srv = server()
+        srv.call('getFileset')
+        if not self._obj['files']:
+            return None
+        return FilesetWrapper(self._obj['fileset'], self._obj['files'])
+
+    def _sizes(self):
+        """Return the dimensions of the pixels of an image."""
+        return self._obj.get('pixels', DEFAULT_PIXELS)['sizes']
+
+    def getSizeX(self):
+        """Return the width of an image."""
+        return self._sizes()[0]
+
+    def getSizeY(self):
+        """Return the height of an image."""
+        return self._sizes()[1]
+
+    def getSizeZ(self):
+        """Return the number of z-slices of an image."""
+        return self._sizes()[2]
+
+    def getSizeC(self):
+        """Return the number of channels of an image."""
+        return self._sizes()[3]
+
+    def getSizeT(self):
+        """Return the number of time points of an image."""
+        return self._sizes()[4]
+
+    def getPixelsType(self):
+        """Return the pixel type of an image."""
+        return self._obj.get('pixels', DEFAULT_PIXELS)['type']
+
+    def getPixelSizeX(self):
+        """Return the pixel size in X (in microns)."""
+        return 0.1
+
+    def getPixelSizeY(self):
+        """Return the pixel size in Y (in microns)."""
+        return 0.1
+
+    def getPixelSizeZ(self):
+        """Return the pixel size in Z (in microns)."""
+        return 0.25
+
+    def getPrimaryPixels(self):
+        """Return the pixels of an image."""
+        return ObjectWrapper('Pixels', {'id': self.getId()})
+
+    def getThumbnail(self, size=(64, 64)):
+        """Return (fake) JPEG data as the thumbnail of an image."""
+        server().call('getThumbnail')
+        return self.thumbnail_data(size)
+
+    def thumbnail_data(self, size):
+        """Assemble the (fake) JPEG data of the thumbnail of an image."""
+        return '\xff\xd8\xff\xe0fake-thumbnail-%s-%s' % (self.getId(), size)
+
+
+class FilesetWrapper(ObjectWrapper):
+
+    """Stand-in for the fileset wrapper, listing its original files."""
+
+    def __init__(self, fsid, files):
+        ObjectWrapper.__init__(self, 'Fileset', {'id': fsid})
+        self._files = files
+
+    def listFiles(self):
+        """Return the original files of the fileset."""
+        return [ObjectWrapper('OriginalFile', server().ofiles[fid])
+                for fid in self._files]
+
+
+class RawFileStore(object):
+
+    """Stand-in for the RawFileStore proxy, serving the fake file data."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._data = None
+
+    def setFileId(self, fid, ctx=None):
+        """Select the original file to read (of a group of the context)."""
+        server().call('setFileId')
+        check_group(self._conn, server().ofiles[fid]['group'], ctx)
+        self._data = server().ofiles[fid]['data']
+
+    def size(self):
+        """Return the size of the file."""
+        return len(self._data)
+
+    def read(self, offset, length):
+        """Read a block of the file."""
+        server().call('read')
+        return self._data[offset:offset + length]
+
+    def close(self):
+        """Close the proxy (nothing to be done)."""
+        pass
+
+
+# the pixels of images added without explicit dimensions:
+DEFAULT_PIXELS = {'sizes': (64, 48, 1, 1, 1), 'type': 'uint8'}
+
+# the generated rows of pixel data, see pixel_data():
+ROWS = dict()
+
+
+def pixel_data(pixels_id, zidx, cidx, tidx, xpos, ypos, width, height):
+    """Generate the (big-endian) data of a region of a plane.
+
+    Every pixel holds the bit pattern of (z + c + t + x + y), modulo the
+    largest positive value of the pixel type.
+    """
+    pixels = server().images[pixels_id].get('pixels', DEFAULT_PIXELS)
+    size = {'int8': 1, 'uint8': 1, 'int16': 2, 'uint16': 2, 'double': 8}.get(
+        pixels['type'], 4)
+    rows = []
+    for y in range(ypos, ypos + height):
+        # rows with the same sum of coordinates are identical:
+        key = (size, xpos, width, zidx + cidx + tidx + y)
+        if key not in ROWS:
+            fmt = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}[size]
+            ROWS[key] = struct.pack(
+                '>%d%s' % (width, fmt),
+                *[(key[3] + x) % (2 ** (8 * size) // 2)
+                  for x in range(xpos, xpos + width)])
+        rows.append(ROWS[key])
+    return ''.join(rows)
+
+
+class RawPixelsStore(object):
+
+    """Stand-in for the RawPixelsStore proxy, serving generated pixel data."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._pixels = None
+
+    def setPixelsId(self, pixels_id, bypass=True, ctx=None):
+        """Select the pixels to read (of a group of the context)."""
+        server().call('setPixelsId')
+        check_group(self._conn, server().images[pixels_id]['group'], ctx)
+        self._pixels = pixels_id
+
+    def getTile(self, zidx, cidx, tidx, xpos, ypos, width, height, ctx=None):
+        """Read a region of a plane."""
+        server().call('getTile')
+        return pixel_data(self._pixels, zidx, cidx, tidx, xpos, ypos, width,
+                          height)
+
+    def getPlane(self, zidx, cidx, tidx, ctx=None):
+        """Read a complete plane."""
+        server().call('getPlane')
+        sizes = server().images[self._pixels].get(
+            'pixels', DEFAULT_PIXELS)['sizes']
+        return pixel_data(self._pixels, zidx, cidx, tidx, 0, 0, sizes[0],
+                          sizes[1])
+
+    def close(self):
+        """Close the proxy (nothing to be done)."""
+        pass
+
+
+class QueryService(object):
+
+    """Stand-in for the query service, answering the connector's queries.
+
+    Only the objects of the groups in the call context are returned, see
+    FakeServer.visible_groups().
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def projection(self, query, params, ctx=None):
+        """Run one of the (known) projection queries of the connector."""
+        srv = server()
+        srv.call('projection')
+        if ctx is None:
+            ctx = self._conn.SERVICE_OPTS
+        groups = srv.visible_groups(self._conn.user_name(),
+                                    ctx.getOmeroGroup())
+        oid = unwrap(params.map.get('id'))
+        if 'from GroupExperimenterMap' in query:
+            gids = [unwrap(gid) for gid in unwrap(params.map['ids'])]
+            rows = []
+            for gid in [gid for gid in gids if gid in groups]:
+                for uid in srv.groups[gid]['members']:
+                    user = srv.users[uid]
+                    rows.append([rtype(gid),
+                                 rtype(uid in srv.groups[gid]['leaders']),
+                                 rtype(uid),
+                                 rtype(user['firstName']), None,
+                                 rtype(user['lastName']),
+                                 rtype(user['omeName'])])
+            return rows
+        if 'from Fileset fs' in query:
+            hashes = set([unwrap(val) for val in unwrap(params.map['hashes'])])
+            rows = []
+            for image in srv.images.values():
+                if image['group'] not in groups:
+                    continue
+                for fid in image['files']:
+                    if srv.ofiles[fid]['hash'] not in hashes:
+                        continue
+                    for did in image.get('links', [image['dataset']]):
+                        rows.append([rtype(srv.ofiles[fid]['hash']),
+                                     rtype(image['id']), rtype(did)])
+            return rows
+        if 'fs.usedFiles' in query:
+            return self.container_query(query, oid, params, groups)
+        match = re.search(r'from (\w+) x', query)
+        if match:
+            return self.index_query(match.group(1), query, params, groups)
+        if 'from OriginalFile f' in query:
+            ofile = srv.ofiles[oid]
+            if ofile['group'] not in groups:
+                return []
+            return [[rtype(len(ofile['data'])), rtype(ofile['hash']),
+                     rtype('SHA1-160')]]
+        if 'from Project p' in query:
+            rows = [obj for obj in sorted(srv.projects.values(),
+                                          key=lambda obj: obj['id'])
+                    if obj['owner'] == oid]
+        elif 'from ProjectDatasetLink' in query:
+            rows = srv.list_children('Project', oid)
+        elif 'from DatasetImageLink' in query:
+            rows = srv.list_children('Dataset', oid)
+        else:
+            raise NotImplementedError('unsupported query: ' + query)
+        rows = [obj for obj in rows if obj['group'] in groups]
+        if params.offset is not None:
+            rows = rows[params.offset:params.offset + params.limit]
+        return [[rtype(obj['id']), rtype(obj['name']),
+                 rtype(srv.users[obj['owner']]['omeName'])] for obj in rows]
+
+
+    def container_query(self, query, oid, params, groups):
+        """Answer the query for the images of a project or dataset."""
+        srv = server()
+        if 'from ProjectDatasetLink' in query:
+            dids = srv.children.get(('Project', oid), [])
+        else:
+            dids = [oid]
+        rows = []
+        for iid in sorted(set([iid for did in dids
+                               for iid in srv.children.get(('Dataset', did),
+                                                           [])])):
+            image = srv.images[iid]
+            if image['group'] not in groups:
+                continue
+            for fid in image['files'] or [None]:
+                rows.append([rtype(iid), rtype(image['name'])] + (
+                    [rtype(image['fileset']), rtype(fid),
+                     rtype(srv.ofiles[fid]['name'])]
+                    if fid is not None else [None, None, None]))
+        if params.offset is not None:
+            rows = rows[params.offset:params.offset + params.limit]
+        return rows
+
+    def index_query(self, cls, query, params, groups):
+        """Answer the queries of the connector for the search index.
+
+        The ID of the update event of an object is its own ID unless it was
+        modified (see FakeServer.rename()).
+        """
+        objs = sorted([obj for obj in server().table(cls).values()
+                       if obj['group'] in groups], key=lambda obj: obj['id'])
+        owner = lambda obj: server().users[obj['owner']]['omeName']
+        if 'count(x.id)' in query:
+            return [[rtype(len(objs))]]
+        if 'x.id in (:ids)' in query:
+            ids = set([unwrap(oid) for oid in unwrap(params.map['ids'])])
+            return [[rtype(obj['id']), rtype(obj['group']), rtype(obj['name']),
+                     rtype(owner(obj))] for obj in objs if obj['id'] in ids]
+        last = unwrap(params.map['id'])
+        if 'updateEvent' in query:
+            event = unwrap(params.map['event'])
+            objs = sorted([obj for obj in objs
+                           if (obj.get('event', obj['id']), obj['id']) >
+                           (event, last)],
+                          key=lambda obj: (obj.get('event', obj['id']),
+                                           obj['id']))
+            rows = [[rtype(obj['id']), rtype(obj['group']), rtype(obj['name']),
+                     rtype(owner(obj)), rtype(obj.get('event', obj['id']))]
+                    for obj in objs]
+        else:
+            rows = [[rtype(obj['id'])] for obj in objs if obj['id'] > last]
+        if params.offset is not None:
+            rows = rows[params.offset:params.offset + params.limit]
+        return rows
+
+
+class UpdateService(object):
+
+    """Stand-in for the update service, saving dataset-image links only."""
+
+    def saveObject(self, obj, ctx=None):
+        """Save a new DatasetImageLink."""
+        srv = server()
+        srv.call('saveObject')
+        if not isinstance(obj, DatasetImageLinkI):
+            raise NotImplementedError('unsupported object: %r' % obj)
+        did, iid = obj.parent.id, obj.child.id
+        with srv.lock:
+            image = srv.images[iid]
+            image.setdefault('links', [image['dataset']]).append(did)
+            srv.children.setdefault(('Dataset', did), []).append(iid)
+
+
+class ModelObject(object):
+
+    """Stand-in for an unloaded omero.model object (e.g. DatasetI)."""
+
+    def __init__(self, oid=None, loaded=True):
+        self.id = oid
+
+
+class DatasetImageLinkI(object):
+
+    """Stand-in for omero.model.DatasetImageLinkI."""
+
+    def __init__(self):
+        self.parent = None
+        self.child = None
+
+    def setParent(self, parent):
+        """Set the dataset of the link."""
+        self.parent = parent
+
+    def setChild(self, child):
+        """Set the image of the link."""
+        self.child = child
+
+
+class ServiceFactory(object):
+
+    """Stand-in for the service factory of a client."""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def createRawFileStore(self):
+        """Create a new RawFileStore proxy."""
+        return RawFileStore(self._conn)
+
+    def createRawPixelsStore(self):
+        """Create a new RawPixelsStore proxy."""
+        return RawPixelsStore(self._conn)
+
+
+class Client(object):
+
+    """Stand-in for omero.client, as used through BlitzGateway.c."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.sf = ServiceFactory(conn)
+        self._detached = False
+
+    def getSessionId(self):
+        """Return the UUID of the session."""
+        return self._conn.session_uuid
+
+    def detachOnDestroy(self):
+        """Keep the session alive when closing the connection."""
+        self._detached = True
+
+    def closeSession(self, hard=True):
+        """End the session (unless being detached)."""
+        if hard or not self._detached:
+            server().sessions.pop(self._conn.session_uuid, None)
+
+
+class ServiceOpts(object):
+
+    """Stand-in for the call context of a BlitzGateway."""
+
+    def __init__(self):
+        self.group = None
+
+    def setOmeroGroup(self, gid):
+        """Set the group context."""
+        self.group = gid
+
+    def getOmeroGroup(self):
+        """Return the group context."""
+        return self.group
+
+    def copy(self):
+        """Return a copy of the context."""
+        opts = ServiceOpts()
+        opts.group = self.group
+        return opts
+
+
+class BlitzGateway(object):
+
+    """Stand-in for omero.gateway.BlitzGateway."""
+
+    def __init__(self, username=None, passwd=None, host=None, port=None,
+                 secure=False, useragent=None):
+        self._user = username
+        self._passwd = passwd
+        self._connected = False
+        self.session_uuid = None
+        self.SERVICE_OPTS = ServiceOpts()
+        self.c = Client(self)
+
+    def connect(self, sUuid=None):
+        """Log in or join an existing session."""
+        srv = server()
+        if sUuid is not None:
+            srv.call('joinSession')
+            if sUuid not in srv.sessions:
+                return False
+            self.session_uuid = sUuid
+            self._user = srv.sessions[sUuid]
+            self._connected = True
+            return True
+        if self._connected:
+            return True
+        srv.call('createSession')
+        names = [user['omeName'] for user in srv.users.values()]
+        if self._passwd != srv.passwd or self._user not in names:
+            return False
+        self.session_uuid = str(uuid.uuid4())
+        srv.sessions[self.session_uuid] = self._user
+        self._connected = True
+        return True
+
+    def isConnected(self):
+        """Check if the connection is established."""
+        return self._connected
+
+    def keepAlive(self):
+        """Check if the session is still alive."""
+        server().call('keepAlive')
+        return self.session_uuid in server().sessions
+
+    def close(self, hard=True):
+        """Close the connection (and the session unless detached)."""
+        self.c.closeSession(hard)
+        self._connected = False
+
+    def user_name(self):
+        """Return the name of the logged in user."""
+        return self._user
+
+    def _me(self):
+        """Return the dict of the logged in user."""
+        for user in server().users.values():
+            if user['omeName'] == self._user:
+                return user
+
+    def getUserId(self):
+        """Return the ID of the logged in user."""
+        return self._me()['id']
+
+    def getUser(self):
+        """Return the wrapper of the logged in user."""
+        server().call('getUser')
+        return ObjectWrapper('Experimenter', self._me())
+
+    def getGroupsMemberOf(self):
+        """Return the wrappers of the groups of the logged in user."""
+        srv = server()
+        srv.call('getGroupsMemberOf')
+        uid = self.getUserId()
+        return [ObjectWrapper('ExperimenterGroup', group) for group in
+                sorted(srv.groups.values(), key=lambda group: group['id'])
+                if uid in group['members']]
+
+    def getGroupFromContext(self):
+        """Return the wrapper of the current group."""
+        gid = self.SERVICE_OPTS.getOmeroGroup()
+        if gid is None:
+            gid = min(server().visible_groups(self._user))
+        group = server().groups[int(gid)]
+        return ObjectWrapper('ExperimenterGroup', group)
+
+    def listColleagues(self):
+        """Return the other members of the current group.
+
+        Like a real server, the members of a private group are only listed
+        for its leaders.
+        """
+        srv = server()
+        srv.call('listColleagues')
+        uid = self.getUserId()
+        group = srv.groups[int(self.SERVICE_OPTS.getOmeroGroup())]
+        if ObjectWrapper('ExperimenterGroup', group).isPrivate() and \
+                uid not in group['leaders']:
+            return []
+        return [ObjectWrapper('Experimenter', srv.users[member])
+                for member in group['members'] if member != uid]
+
+    def getObject(self, cls, oid):
+        """Return the wrapper of an object, None if it doesn't exist."""
+        srv = server()
+        srv.call('getObject')
+        table = {'Image': srv.images, 'Dataset': srv.datasets,
+                 'Project': srv.projects, 'Experimenter': srv.users}[cls]
+        oid = int(oid)
+        if oid not in table:
+            return None
+        # experimenters don't belong to a group:
+        if 'group' in table[oid] and table[oid]['group'] not in \
+                srv.visible_groups(self._user,
+                                   self.SERVICE_OPTS.getOmeroGroup()):
+            return None
+        return ObjectWrapper(cls, table[oid])
+
+    def listProjects(self, eid=None):
+        """Return the projects of an experimenter."""
+        srv = server()
+        srv.call('listProjects')
+        return [ObjectWrapper('Project', proj) for proj in
+                sorted(srv.projects.values(), key=lambda proj: proj['id'])
+                if proj['owner'] == int(eid)]
+
+    def getThumbnailSet(self, image_ids, max_size=64):
+        """Return the thumbnails of several images in a single call."""
+        srv = server()
+        srv.call('getThumbnailSet')
+        return dict([(image_id, ObjectWrapper('Image', srv.images[image_id])
+                      .thumbnail_data((max_size, max_size)))
+                     for image_id in image_ids if image_id in srv.images])
+
+    def getQueryService(self):
+        """Return the query service."""
+        return QueryService(self)
+
+    def getUpdateService(self):
+        """Return the update service."""
+        return UpdateService()
+
+
+class CLI(object):
+
+    """Stand-in for omero.cli.CLI, supporting the "import" command only."""
+
+    def loadplugins(self):
+        """Load the CLI plugins (taking a while, like the real thing)."""
+        server().call('loadplugins')
+
+    def invoke(self, args, strict=False):
+        """Run an import, adding the file as an image to the dataset.
+
+        The annotation text and the transfer mode of the import (if any) are
+        recorded as 'annotation' and 'transfer' of the new image.
+        """
+        srv = server()
+        srv.call('import')
+        if args[0] != 'import':
+            raise NotImplementedError('unsupported command: %s' % args[0])
+        did = int(args[args.index('-d') + 1])
+        fname = args[-1]
+        with open(fname, 'rb') as infile:
+            data = infile.read()
+        with srv.lock:
+            iid = srv.add_image(did, os.path.basename(fname), data=data)
+            for option in ('annotation_text', 'transfer'):
+                if '--' + option in args:
+                    srv.images[iid][option.split('_')[0]] = args[
+                        args.index('--' + option) + 1]
+
+
+def install(fake_server):
+    """Register the fake OMERO modules and set the server answering calls.
+
+    Parameters
+    ==========
+    fake_server : FakeServer - the server to use
+    """
+    SERVER[0] = fake_server
+    if 'omero' in sys.modules and hasattr(sys.modules['omero'], 'fake'):
+        return
+    omero = types.ModuleType('omero')
+    omero.__path__ = []
+    omero.fake = True
+    omero.SecurityViolation = SecurityViolation
+    modules = {'omero': omero}
+    submodules = {
+        'gateway': {'BlitzGateway': BlitzGateway},
+        'sys': {'ParametersI': ParametersI},
+        'rtypes': {'rlong': rtype, 'rstring': rtype, 'rlist': rlist,
+                   'unwrap': unwrap},
+        'model': {'DatasetI': ModelObject, 'ImageI': ModelObject,
+                  'DatasetImageLinkI': DatasetImageLinkI},
+        'cli': {'CLI': CLI},
+    }
+    for name, attrs in submodules.items():
+        module = types.ModuleType('omero.' + name)
+        module.__dict__.update(attrs)
+        setattr(omero, name, module)
+        modules['omero.' + name] = module
+    sys.modules.update(modules)
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+
+"""Benchmark the HRM OMERO connector against a fake, in-process OMERO server.
+
+The connector functions for assembling the tree (gen_base_tree, gen_children),
+transferring files (omero_to_hrm, hrm_to_omero) and parsing the parameter
+summary (gen_parameter_summary) are timed on synthetic data of different
+scales, see SCALES. No OMERO server (or even the OMERO Python bindings) is
+required, the server is simulated by fake_omero.py. Besides the run times,
+the number of (simulated) calls to the server is reported for every
+benchmark, and each call can be delayed by a fixed latency to mimic a remote
+server.
+
+Example
+=======
+python run_benchmark.py --scales small,medium --repeat 5 --latency 0.001 \\
+    --json results.json
+"""
+
+# pylint: disable=superfluous-parens
+
+import sys
+import os
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+import fake_omero
+
+
+BIN_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                       '..', '..', '..', 'bin'))
+
+# the sizes of the synthetic data: the regular tree ('groups' to 'images'),
+# the number of images in an additional large dataset ('big_dataset'), the
+# number of files to transfer and their size and the number of rows in each
+# table of the parameter summary:
+SCALES = {
+    'small': {
+        'groups': 1, 'users': 3, 'projects': 2, 'datasets': 2, 'images': 5,
+        'big_dataset': 1000, 'files': 4, 'file_size': 1024 * 1024,
+        'param_rows': 20,
+    },
+    'medium': {
+        'groups': 3, 'users': 10, 'projects': 5, 'datasets': 4, 'images': 10,
+        'big_dataset': 10000, 'files': 8, 'file_size': 8 * 1024 * 1024,
+        'param_rows': 200,
+    },
+    'large': {
+        'groups': 5, 'users': 30, 'projects': 10, 'datasets': 5,
+        'images': 10, 'big_dataset': 50000, 'files': 8,
+        'file_size': 64 * 1024 * 1024, 'param_rows': 2000,
+    },
+}
+
+# the names of the benchmarks in the order they are run:
+BENCHMARKS = [
+    'gen_base_tree',
+    'gen_children_experimenter',
+    'gen_children_project',
+    'gen_children_dataset',
+    'omero_to_hrm',
+    'hrm_to_omero',
+    'gen_parameter_summary',
+]
+
+
+class NullWriter(object):
+
+    """A file-like object discarding everything written to it."""
+
+    def write(self, text):
+        """Discard the text."""
+        pass
+
+    def flush(self):
+        """Nothing to flush."""
+        pass
+
+
+def write_hrm_conf(workdir):
+    """Write a minimal HRM config file pointing to a private directory.
+
+    Returns
+    =======
+    str - the name of the config file
+    """
+    fname = os.path.join(workdir, 'hrm.conf')
+    with open(fname, 'w') as outfile:
+        outfile.write('OMERO_HOSTNAME="localhost"\n')
+        outfile.write('OMERO_PKG="%s"\n' % os.path.join(workdir, 'omero'))
+        outfile.write('OMERO_CONNECTOR_DIR="%s"\n' %
+                      os.path.join(workdir, 'connector'))
+        outfile.write('OMERO_TREE_CACHE_TTL="0"\n')
+    return fname
+
+
+def import_connector(workdir):
+    """Import the connector using a config file of the benchmark."""
+    os.environ['HRM_CONF'] = write_hrm_conf(workdir)
+    sys.path.insert(0, BIN_DIR)
+    import ome_hrm
+    return ome_hrm
+
+
+def write_parameter_summary(fname, rows):
+    """Write an HTML parameter summary as created by the HRM.
+
+    The file contains two tables (image and restoration parameters) with a
+    title row, a legend row and 'rows' rows of parameters each.
+    """
+    def cell(content, style, colspan=1):
+        """Assemble a table cell the same way the HRM does."""
+        return '<td class="%s" colspan="%s">%s</td>' % (style, colspan,
+                                                         content)
+
+    html = ['<div id="jobParameters">']
+    for title in ['Image Parameters', 'Restoration Parameters']:
+        html.append('<br /><b><u>%s summary</u></b>' % title)
+        html.append('<table><tr>%s</tr>' % cell(title, 'header', 4))
+        html.append('<tr>%s%s%s%s</tr>' % (
+            cell('Parameter', 'param'), cell('Channel', 'channel'),
+            cell('Source', 'source'), cell('Value', 'value')))
+        for row in range(rows):
+            html.append('<tr>%s%s%s%s</tr>' % (
+                cell('Sample size x (&mu;m)' if row % 2 else 'Parameter %d'
+                     % row, 'param'),
+                cell(str(row % 4), 'channel'),
+                cell('template', 'source'),
+                cell('%.3f' % (row * 0.125), 'value')))
+        html.append('</table>')
+    html.append('</div><!-- jobParameters -->')
+    with open(fname, 'w') as outfile:
+        outfile.write('\n'.join(html))
+
+
+def setup_server(scale, latency):
+    """Create the fake server for a scale, including the large dataset.
+
+    Returns
+    =======
+    (server, big_dataset, images) : (fake_omero.FakeServer, int, list(int)) -
+    the server, the ID of the large dataset and the IDs of the images to
+    download (having files of the size given for the scale)
+    """
+    server = fake_omero.FakeServer(
+        groups=scale['groups'], users=scale['users'],
+        projects=scale['projects'], datasets=scale['datasets'],
+        images=scale['images'], file_size=1024)
+    big_dataset = server.find_dataset()
+    for inum in range(scale['big_dataset']):
+        server.add_image(big_dataset, 'big_%06d.tif' % inum, 1024)
+    # the images to transfer go to a dataset of their own:
+    transfer_dataset = server.add_dataset(
+        server.datasets[big_dataset]['project'], 'transfer')
+    images = [server.add_image(transfer_dataset, 'file_%02d.tif' % fnum,
+                               scale['file_size'])
+              for fnum in range(scale['files'])]
+    server.latency = latency
+    return server, big_dataset, images
+
+
+def time_function(server, func, repeat, prepare=None):
+    """Time a function, collecting the server calls of the last run.
+
+    Parameters
+    ==========
+    server : fake_omero.FakeServer
+    func : callable - the function to time
+    repeat : int - the number of runs
+    prepare : callable - (optional) called before every run (not timed)
+
+    Returns
+    =======
+    dict - the minimum and median run time (in seconds) and the calls
+    """
+    times = []
+    calls = dict()
+    for _ in range(repeat):
+        if prepare is not None:
+            prepare()
+        server.reset_calls()
+        stdout = sys.stdout
+        sys.stdout = NullWriter()
+        start = time.time()
+        try:
+            func()
+        finally:
+            times.append(time.time() - start)
+            sys.stdout = stdout
+        calls = server.reset_calls()
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2],
+            'calls': calls}
+
+
+def run_scale(ome_hrm, name, scale, repeat, latency, workdir):
+    """Run all benchmarks for one scale.
+
+    Returns
+    =======
+    dict - the results, keyed by benchmark name
+    """
+    server, big_dataset, images = setup_server(scale, latency)
+    fake_omero.install(server)
+    uid = sorted(server.users)[0]
+    user = server.users[uid]['omeName']
+    conn = ome_hrm.omero_login(user, server.passwd, 'localhost', 4064)
+    gid = server.datasets[big_dataset]['group']
+    pfx = 'G:%s:' % gid
+    project = server.datasets[big_dataset]['project']
+    dest = os.path.join(workdir, 'dest')
+    upload = os.path.join(workdir, 'upload_0123456789abc_hrm.tif')
+    with open(upload, 'wb') as outfile:
+        outfile.write(os.urandom(min(scale['file_size'], 1024 * 1024)))
+    summary = os.path.join(workdir, 'upload_0123456789abc_hrm.parameters.txt')
+    write_parameter_summary(summary, scale['param_rows'])
+
+    def clean_dest():
+        """Provide an empty destination directory for the downloads."""
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        os.makedirs(os.path.join(dest, 'hrm_previews'))
+
+    def download():
+        """Download all files to transfer, one image at a time."""
+        for image in images:
+            ome_hrm.omero_to_hrm(conn, pfx + 'Image:%s' % image, dest)
+
+    runs = {
+        'gen_base_tree': (lambda: ome_hrm.gen_base_tree(conn), None),
+        'gen_children_experimenter': (lambda: ome_hrm.gen_children(
+            conn, pfx + 'Experimenter:%s' % uid), None),
+        'gen_children_project': (lambda: ome_hrm.gen_children(
+            conn, pfx + 'Project:%s' % project), None),
+        'gen_children_dataset': (lambda: ome_hrm.gen_children(
+            conn, pfx + 'Dataset:%s' % big_dataset), None),
+        'omero_to_hrm': (download, clean_dest),
+        'hrm_to_omero': (lambda: ome_hrm.hrm_to_omero(
+            conn, pfx + 'Dataset:%s' % big_dataset, upload), None),
+        'gen_parameter_summary': (
+            lambda: ome_hrm.gen_parameter_summary(summary), None),
+    }
+    results = dict()
+    for bench in BENCHMARKS:
+        func, prepare = runs[bench]
+        results[bench] = time_function(server, func, repeat, prepare)
+        print_result(name, bench, results[bench])
+    ome_hrm.omero_logout(conn)
+    return results
+
+
+def print_result(scale, bench, result):
+    """Print a line with the result of a single benchmark."""
+    ncalls = sum(result['calls'].values())
+    print("%-8s %-26s %10.2f ms %10.2f ms %8d" % (
+        scale, bench, result['min'] * 1000, result['median'] * 1000, ncalls))
+    sys.stdout.flush()
+
+
+def parse_arguments():
+    """Parse the commandline arguments."""
+    argparser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    argparser.add_argument(
+        '-s', '--scales', type=str, default='small,medium',
+        help='comma separated list of the scales to run, out of: %s '
+        '(default: %%(default)s)' % ', '.join(sorted(SCALES)))
+    argparser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='number of runs per benchmark (default: %(default)s)')
+    argparser.add_argument(
+        '-l', '--latency', type=float, default=0.0,
+        help='simulated latency of every server call in seconds '
+        '(default: %(default)s)')
+    argparser.add_argument(
+        '-j', '--json', type=str,
+        help='file to write the results to (JSON)')
+    args = argparser.parse_args()
+    for scale in args.scales.split(','):
+        if scale not in SCALES:
+            argparser.error('unknown scale: %s' % scale)
+    return args
+
+
+def main():
+    """Run the benchmarks for the requested scales."""
+    args = parse_arguments()
+    workdir = tempfile.mkdtemp(prefix='hrm_omero_benchmark_')
+    try:
+        # the connector needs the fake modules right from the start:
+        fake_omero.install(None)
+        ome_hrm = import_connector(workdir)
+        print("%-8s %-26s %13s %13s %8s" % (
+            'scale', 'benchmark', 'min', 'median', 'calls'))
+        results = dict()
+        for name in args.scales.split(','):
+            results[name] = run_scale(ome_hrm, name, SCALES[name],
+                                      args.repeat, args.latency, workdir)
+    finally:
+        shutil.rmtree(workdir)
+    if args.json is not None:
+        with open(args.json, 'w') as outfile:
+            json.dump(results, outfile, sort_keys=True, indent=4)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""Common fixtures for the unit tests of the OMERO connector.
+
+The connector modules are imported from the bin directory of the HRM, using a
+minimal HRM config file in a temporary directory (written before any of them
+is imported) and the fake OMERO bindings of the benchmark suite (see
+../benchmark/fake_omero.py), so neither an HRM installation nor an OMERO
+server is required.
+
+Run the tests with "python -m pytest tests/omero_connector/unit" (Python 2).
+"""
+
+import sys
+import os
+import atexit
+import shutil
+import tempfile
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', '..', '..', 'bin'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmark'))
+
+import fake_omero
+import run_benchmark
+
+WORKDIR = tempfile.mkdtemp(prefix='hrm_omero_tests_')
+atexit.register(shutil.rmtree, WORKDIR, True)
+os.environ['HRM_CONF'] = run_benchmark.write_hrm_conf(WORKDIR)
+
+
+@pytest.fixture
+def fake():
+    """A small fake OMERO server with two groups, installed for the test."""
+    server = fake_omero.FakeServer(groups=2, users=2, projects=1, datasets=1,
+                                   images=2, file_size=1000)
+    fake_omero.install(server)
+    return server
+
+
+@pytest.fixture
+def ome_hrm(fake, tmpdir, monkeypatch):
+    """The connector module, using a private connector directory."""
+    import ome_hrm as connector
+    monkeypatch.setattr(connector, 'CONNECTOR_DIR', str(tmpdir.join('conn')))
+    monkeypatch.setattr(connector, 'TRANSFER_SLOTS', 0)
+    monkeypatch.setattr(connector, 'THUMBNAIL_CACHE_SIZE', 0)
+    return connector
+
+
+@pytest.fixture
+def user(fake):
+    """The name of the first user of the fake server."""
+    return fake.users[min(fake.users)]['omeName']
+
+
+@pytest.fixture
+def conn(ome_hrm, fake, user):
+    """A connection of the first user of the fake server."""
+    return ome_hrm.omero_login(user, fake.passwd, 'localhost', 4064)
@@ -0,0 +1,183 @@
+"""Tests for the connector daemon and its client."""
+
+import sys
+import json
+import shutil
+import tempfile
+import threading
+
+import pytest
+
+import ome_hrm_client
+import ome_hrm_daemon
+import ome_hrm_events
+from ome_hrm_cache import TreeCache
+
+
+@pytest.fixture
+def server(ome_hrm):
+    """A daemon serving requests on a temporary socket."""
+    # the path of a Unix socket is limited to ~100 characters:
+    sockdir = tempfile.mkdtemp(prefix='hrm_')
+    pool = ome_hrm_daemon.SessionPool('localhost', 4064)
+    daemon = ome_hrm_daemon.ConnectorServer(sockdir + '/socket', pool)
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield daemon
+    daemon.shutdown()
+    daemon.server_close()
+    pool.close_all()
+    shutil.rmtree(sockdir)
+
+
+def request(daemon, argv):
+    """Send a request to the daemon through the client, return the status."""
+    # the daemon dispatches the output of its threads (see main()):
+    stdout, stderr = sys.stdout, sys.stderr
+    if not hasattr(stdout, 'set_sink'):
+        sys.stdout = ome_hrm_daemon.ThreadLocalStream(stdout)
+        sys.stderr = ome_hrm_daemon.ThreadLocalStream(stderr)
+    sock = ome_hrm_client.connect_daemon(daemon.server_address)
+    try:
+        return ome_hrm_client.forward_request(
+            sock, ome_hrm_client.encode_request(argv))
+    finally:
+        sock.close()
+        sys.stdout, sys.stderr = stdout, stderr
+
+
+def test_credentials_are_checked_by_a_new_login(server, fake, user):
+    argv = ['--user', user, '--password', fake.passwd, 'checkCredentials']
+    assert request(server, argv) == 0
+    entry = server.pool.acquire(user, fake.passwd)
+    server.pool.release(entry)
+    # the password gets changed on the server:
+    old_passwd, fake.passwd = fake.passwd, 'changed'
+    argv = ['--user', user, '--password', old_passwd, 'checkCredentials']
+    assert request(server, argv) == 1
+    assert user not in server.pool._entries
+
+
+def test_exit_of_an_action_is_reported(server, ome_hrm, fake, user,
+                                       monkeypatch):
+    def run_action(conn, args):
+        sys.exit(2)
+    monkeypatch.setattr(ome_hrm, 'run_action', run_action)
+    argv = ['--user', user, '--password', fake.passwd, 'retrieveChildren',
+            '--id', 'ROOT']
+    assert request(server, argv) == 2
+    # the pooled connection has been handed back:
+    entry = server.pool._entries[user][0]
+    assert entry.lock.acquire(False)
+    entry.lock.release()
+
+
+def test_transfer_status_needs_valid_credentials(server, ome_hrm, fake,
+                                                user):
+    queue = ome_hrm.open_transfer_queue()
+    job_id = queue.enqueue(user, 'session', 'OMEROtoHRM', [], {'jobs': 1})
+    queue.close()
+    argv = ['transferStatus', '--job', str(job_id)]
+    assert request(server, ['--user', user, '--password', 'wrong'] + argv) == 1
+    assert request(server, ['--user', user, '--password', fake.passwd] +
+                   argv) == 0
+
+
+def test_tree_cache_is_closed_after_a_request(server, ome_hrm, fake, user,
+                                              monkeypatch):
+    monkeypatch.setattr(ome_hrm, 'TREE_CACHE_TTL', 300)
+    opened, closed = [], []
+    open_tree_cache, close = ome_hrm.open_tree_cache, TreeCache.close
+
+    def open_and_record():
+        opened.append(open_tree_cache())
+        return opened[-1]
+
+    def close_and_record(cache):
+        closed.append(cache)
+        close(cache)
+    monkeypatch.setattr(ome_hrm, 'open_tree_cache', open_and_record)
+    monkeypatch.setattr(TreeCache, 'close', close_and_record)
+    argv = ['--user', user, '--password', fake.passwd, 'retrieveChildren',
+            '--id', 'ROOT']
+    assert request(server, argv) == 0
+    assert len(opened) == 1 and closed == opened
+
+
+def test_requests_of_a_user_run_on_separate_connections(server, ome_hrm,
+                                                        fake, user):
+    first = server.pool.acquire(user, fake.passwd)
+    second = server.pool.acquire(user, fake.passwd)
+    assert second is not None and second.conn is not first.conn
+    server.pool.release(second)
+    fake.reset_calls()
+    # a free connection is handed out again, without a new login:
+    assert server.pool.acquire(user, fake.passwd) is second
+    assert 'createSession' not in fake.reset_calls()
+    server.pool.release(second)
+    server.pool.release(first)
+
+
+def test_long_request_does_not_block_the_user(server, ome_hrm, fake, user,
+                                              monkeypatch):
+    running = threading.Event()
+    done = threading.Event()
+    run_action = ome_hrm.run_action
+
+    def slow_run_action(conn, args):
+        if args.action == 'OMEROtoHRM':
+            running.set()
+            done.wait(10)
+            return True
+        return run_action(conn, args)
+    monkeypatch.setattr(ome_hrm, 'run_action', slow_run_action)
+    transfer = ['--user', user, '--password', fake.passwd, 'OMEROtoHRM',
+                '--imageid', 'G:1:Image:1', '--dest', '/tmp']
+    thread = threading.Thread(target=request, args=(server, transfer))
+    thread.start()
+    running.wait(10)
+    try:
+        argv = ['--user', user, '--password', fake.passwd,
+                'retrieveChildren', '--id', 'ROOT']
+        assert request(server, argv) == 0
+        # answered while the transfer is still running:
+        assert thread.is_alive()
+    finally:
+        done.set()
+        thread.join()
+
+
+def test_arguments_not_being_utf8_are_run_by_the_connector(monkeypatch):
+    calls = []
+
+    def run_connector(argv):
+        # like os.execv(), this doesn't return:
+        calls.append(argv)
+        sys.exit(0)
+    monkeypatch.setattr(ome_hrm_client, 'run_connector', run_connector)
+    argv = ['HRMtoOMERO', '--file', '/data/r\xe9sultat.tif']
+    assert ome_hrm_client.encode_request(argv) is None
+    monkeypatch.setattr(sys, 'argv', ['ome_hrm_client.py'] + argv)
+    with pytest.raises(SystemExit):
+        ome_hrm_client.main()
+    assert calls == [argv]
+
+
+def test_events_are_sent_to_the_client_only(server, ome_hrm, fake, conn,
+                                            user, tmpdir, monkeypatch,
+                                            capsys):
+    def redirect_stdout():
+        raise AssertionError('the stdout of the daemon must not be touched')
+    monkeypatch.setattr(ome_hrm_events, 'redirect_stdout', redirect_stdout)
+    image = [img for iid, img in sorted(fake.images.items())
+             if img['owner'] == conn.getUser().getId()][0]
+    argv = ['--user', user, '--password', fake.passwd, 'OMEROtoHRM',
+            '--imageid', 'G:%d:Image:%d' % (image['group'], image['id']),
+            '--dest', str(tmpdir), '--events']
+    assert request(server, argv) == 0
+    out, err = capsys.readouterr()
+    events = [json.loads(line)['event'] for line in out.splitlines()]
+    assert events[0] == 'started' and events[-1] == 'finished'
+    assert 'file' in events
+    assert "downloaded as '%s'" % image['name'] in err
@@ -0,0 +1,165 @@
+"""Tests for downloading images and containers from OMERO to the HRM."""
+
+import pytest
+
+import fake_omero
+import ome_hrm_transfer
+
+
+def first_image(fake, conn, group=0):
+    """Get the ID string and the name of the first image of the user."""
+    uid = conn.getUser().getId()
+    gid = sorted(fake.groups)[group]
+    image = [img for iid, img in sorted(fake.images.items())
+             if img['owner'] == uid and img['group'] == gid][0]
+    return 'G:%d:Image:%d' % (gid, image['id']), image['name']
+
+
+def test_image_of_another_group_is_downloaded(ome_hrm, fake, conn, tmpdir):
+    id_str, name = first_image(fake, conn, group=1)
+    item = ome_hrm.new_transfer_item(id_str, dest=str(tmpdir))
+    assert ome_hrm.omero_to_hrm_batch(conn, [item])
+    assert tmpdir.join(name).size() == 1000
+
+
+def test_batch_spanning_two_groups_is_downloaded(ome_hrm, fake, conn,
+                                                  tmpdir):
+    id_str, name = first_image(fake, conn, group=0)
+    other_id, other_name = first_image(fake, conn, group=1)
+    # an image without original files, exported from its pixels:
+    did = fake.images[int(id_str.split(':')[-1])]['dataset']
+    legacy = fake.add_legacy_image(did, 'legacy')
+    items = [ome_hrm.new_transfer_item(id_str, dest=str(tmpdir.mkdir('a'))),
+             ome_hrm.new_transfer_item('G:%d:Image:%d' % (
+                 fake.images[legacy]['group'], legacy),
+                                       dest=str(tmpdir.mkdir('b'))),
+             ome_hrm.new_transfer_item(other_id, dest=str(tmpdir.mkdir('c')))]
+    assert ome_hrm.omero_to_hrm_batch(conn, items, jobs=3)
+    assert tmpdir.join('a', name).size() == 1000
+    assert tmpdir.join('b', 'legacy.ome.tif').size() > 0
+    assert tmpdir.join('c', other_name).size() == 1000
+
+
+def test_complete_copy_is_kept(ome_hrm, fake, conn, tmpdir):
+    id_str, name = first_image(fake, conn)
+    item = ome_hrm.new_transfer_item(id_str, dest=str(tmpdir))
+    assert ome_hrm.omero_to_hrm_batch(conn, [item])
+    fake.reset_calls()
+    item = ome_hrm.new_transfer_item(id_str, dest=str(tmpdir))
+    assert ome_hrm.omero_to_hrm_batch(conn, [item])
+    assert "already downloaded as '%s'" % name in item['messages'][0]
+    assert 'read' not in fake.reset_calls()
+
+
+def test_target_created_meanwhile_is_not_reported_as_downloaded(
+        ome_hrm, fake, conn, tmpdir, monkeypatch):
+    id_str, name = first_image(fake, conn)
+    gen_download_list = ome_hrm.gen_download_list
+
+    def gen_and_create(conn, item, claimed):
+        downloads = gen_download_list(conn, item, claimed)
+        tmpdir.join(name).write('created by somebody else')
+        return downloads
+    monkeypatch.setattr(ome_hrm, 'gen_download_list', gen_and_create)
+    item = ome_hrm.new_transfer_item(id_str, dest=str(tmpdir))
+    assert not ome_hrm.omero_to_hrm_batch(conn, [item])
+    assert 'already existing' in item['messages'][-1]
+    assert tmpdir.join(name).read() == 'created by somebody else'
+
+
+def first_file(fake, conn):
+    """Get the ID and the content of the original file of the first image."""
+    image_id = int(first_image(fake, conn)[0].split(':')[3])
+    fid = fake.images[image_id]['files'][0]
+    return fid, fake.ofiles[fid]['data']
+
+
+def test_interrupted_download_is_resumed(fake, conn, tmpdir):
+    fid, data = first_file(fake, conn)
+    target = str(tmpdir.join('img.tif'))
+    tmpdir.join('img.tif' + ome_hrm_transfer.PART_SUFFIX).write(data[:400])
+    fake.reset_calls()
+    assert ome_hrm_transfer.download_original_file(
+        conn, fid, target, chunk_size=100) == 600
+    assert fake.reset_calls()['read'] == 6
+    assert open(target).read() == data
+    assert tmpdir.listdir() == [tmpdir.join('img.tif')]
+
+
+def test_corrupted_download_is_not_kept(fake, conn, tmpdir):
+    fid, data = first_file(fake, conn)
+    target = str(tmpdir.join('img.tif'))
+    part = tmpdir.join('img.tif' + ome_hrm_transfer.PART_SUFFIX)
+    part.write('x' * 400)
+    with pytest.raises(ome_hrm_transfer.TransferError):
+        ome_hrm_transfer.download_original_file(conn, fid, target,
+                                                chunk_size=100)
+    assert tmpdir.listdir() == []
+    # the next attempt starts from scratch:
+    assert ome_hrm_transfer.download_original_file(
+        conn, fid, target, chunk_size=100) == 1000
+    assert open(target).read() == data
+
+
+def test_file_is_downloaded_over_parallel_streams(fake, conn, tmpdir):
+    fid, data = first_file(fake, conn)
+    target = str(tmpdir.join('img.tif'))
+    fake.reset_calls()
+    assert ome_hrm_transfer.download_original_file(
+        conn, fid, target, chunk_size=100, streams=3) == 1000
+    # a proxy of its own for every stream:
+    calls = fake.reset_calls()
+    assert calls['setFileId'] == 3 and calls['read'] == 10
+    assert open(target).read() == data
+    assert tmpdir.listdir() == [tmpdir.join('img.tif')]
+
+
+def test_parallel_download_resumes_the_missing_chunks(fake, conn, tmpdir):
+    fid, data = first_file(fake, conn)
+    target = str(tmpdir.join('img.tif'))
+    part = tmpdir.join('img.tif' + ome_hrm_transfer.PART_SUFFIX)
+    # chunks 0, 3 and 9 have been transferred by an earlier attempt:
+    part.write(''.join([data[idx * 100:idx * 100 + 100]
+                        if idx in (0, 3, 9) else '\0' * 100
+                        for idx in range(10)]))
+    tmpdir.join('img.tif.part' + ome_hrm_transfer.CHUNKS_SUFFIX).write(
+        '0\n3\n9\n')
+    fake.reset_calls()
+    assert ome_hrm_transfer.download_original_file(
+        conn, fid, target, chunk_size=100, streams=2) == 700
+    assert fake.reset_calls()['read'] == 7
+    assert open(target).read() == data
+
+
+def test_only_the_selected_subvolume_is_transferred(ome_hrm, fake, conn,
+                                                    user, tmpdir):
+    id_str, _ = first_image(fake, conn)
+    did = fake.images[int(id_str.split(':')[3])]['dataset']
+    iid = fake.add_legacy_image(did, 'timelapse', sizes=(16, 12, 3, 2, 4))
+    tmpdir.mkdir('hrm_previews')
+    args = ome_hrm.parse_arguments([
+        '--user', user, '--password', fake.passwd, 'OMEROtoHRM',
+        '--imageid', 'G:%d:Image:%d' % (fake.images[iid]['group'], iid),
+        '--dest', str(tmpdir), '--channels', '1', '--zslices', '0,2',
+        '--timepoints', '1-2', '--crop', '2,3,8,5'])
+    fake.reset_calls()
+    assert ome_hrm.run_action(conn, args)
+    # a single strip for each of the 2 x 2 planes:
+    assert fake.reset_calls()['getTile'] == 4
+    data = tmpdir.join('timelapse_c1_z0.2_t1-2_x2y3w8h5.ome.tif').read_binary()
+    for tidx in (1, 2):
+        for zidx in (0, 2):
+            assert fake_omero.pixel_data(iid, zidx, 1, tidx, 2, 3, 8, 5) in data
+
+
+def test_move_into_place_never_replaces_the_target(tmpdir):
+    part = tmpdir.join('img.tif.part')
+    part.write('new')
+    target = tmpdir.join('img.tif')
+    target.write('old')
+    with pytest.raises(ome_hrm_transfer.TransferError):
+        ome_hrm_transfer.move_into_place(str(part), str(target))
+    assert target.read() == 'old' and part.read() == 'new'
+    target.remove()
+    ome_hrm_transfer.move_into_place(str(part), str(target))
+    assert target.read() == 'new' and not part.exists()
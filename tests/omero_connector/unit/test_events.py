@@ -0,0 +1,73 @@
+"""Tests for the NDJSON event stream of the transfers (ome_hrm_events)."""
+
+import os
+import sys
+import json
+import subprocess
+from StringIO import StringIO
+
+import ome_hrm_events
+from ome_hrm_events import EventStream
+
+ITEM = {'id': 'G:3:Dataset:5', 'file': '/data/dst/img.tif',
+        'success': False, 'messages': ['ERROR: upload failed']}
+
+
+def read_events(outfile):
+    """Parse the events written to a StringIO."""
+    lines = outfile.getvalue().splitlines()
+    return [json.loads(line) for line in lines]
+
+
+def test_every_event_is_a_line_of_json():
+    outfile = StringIO()
+    events = EventStream(outfile)
+    events.started(ITEM, ['/data/dst/img.tif'])
+    events.file_done(ITEM, '/data/dst/img.tif', 1000, 'import')
+    events.thumbnail(42, '/data/dst/hrm_previews/img.tif.preview_xy.png')
+    events.failed(ITEM, 'upload failed', '/data/dst/img.tif')
+    events.finished(ITEM)
+    started, done, thumb, failed, finished = read_events(outfile)
+    assert started['event'] == 'started'
+    assert started['item'] == 'G:3:Dataset:5'
+    assert started['source'] == '/data/dst/img.tif'
+    assert started['files'] == ['/data/dst/img.tif']
+    assert isinstance(started['time'], float)
+    assert (done['bytes'], done['method']) == (1000, 'import')
+    assert thumb['image'] == 42 and 'item' not in thumb
+    assert (failed['message'], failed['file']) == ('upload failed',
+                                                   '/data/dst/img.tif')
+    assert finished['success'] is False
+    assert finished['messages'] == ['ERROR: upload failed']
+
+
+def test_progress_is_throttled_per_file():
+    outfile = StringIO()
+    events = EventStream(outfile, interval=60)
+    item = {'id': 'G:3:Image:7'}
+    events.progress(item, 'a.tif', 10, 100)
+    events.progress(item, 'a.tif', 20, 100)
+    events.progress(item, 'b.tif', 10, 100)
+    # the completion of a file is always reported:
+    events.progress(item, 'a.tif', 100, 100)
+    assert [(event['file'], event['done']) for event in
+            read_events(outfile)] == [('a.tif', 10), ('b.tif', 10),
+                                      ('a.tif', 100)]
+
+
+def test_redirect_stdout_keeps_other_output_off_the_stream():
+    script = '\n'.join([
+        'import os, ome_hrm_events',
+        'outfile = ome_hrm_events.redirect_stdout()',
+        'print "a message"',
+        'os.system("echo subprocess output")',
+        'outfile.write("event\\n")',
+    ])
+    env = dict(os.environ,
+               PYTHONPATH=os.path.dirname(ome_hrm_events.__file__))
+    proc = subprocess.Popen([sys.executable, '-c', script], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    assert proc.returncode == 0
+    assert out == 'event\n'
+    assert 'a message' in err and 'subprocess output' in err
@@ -0,0 +1,76 @@
+"""Tests for the cache of downloaded original files."""
+
+import os
+import stat
+
+import pytest
+
+from ome_hrm_filecache import FileCache
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return FileCache(str(tmpdir.mkdir('cache')), 10000)
+
+
+def downloaded(tmpdir, name, data='original data'):
+    """Write a file as if it had just been downloaded by a user."""
+    fname = tmpdir.join(name)
+    fname.write(data)
+    return str(fname)
+
+
+def test_stored_file_stays_writable(cache, tmpdir):
+    fname = downloaded(tmpdir, 'img.tif')
+    cache.store('SHA1-160/abcd', fname)
+    assert os.stat(fname).st_mode & stat.S_IWUSR
+    with open(fname, 'a') as outfile:
+        outfile.write(' and more')
+
+
+def test_stored_file_is_fetched(cache, tmpdir):
+    cache.store('SHA1-160/abcd', downloaded(tmpdir, 'img.tif'))
+    target = str(tmpdir.join('copy.tif'))
+    assert cache.fetch('SHA1-160/abcd', target) is not None
+    assert open(target).read() == 'original data'
+    # fetching again doesn't invalidate the cached file:
+    os.unlink(target)
+    assert cache.fetch('SHA1-160/abcd', target) is not None
+
+
+def test_file_is_hardlinked_for_the_same_user_only(cache, tmpdir):
+    fname = downloaded(tmpdir, 'img.tif')
+    cache.store('SHA1-160/abcd', fname, 'alice')
+    own = str(tmpdir.join('own.tif'))
+    assert cache.fetch('SHA1-160/abcd', own, 'alice') == 'hardlink'
+    other = str(tmpdir.join('other.tif'))
+    assert cache.fetch('SHA1-160/abcd', other, 'bob') in ('reflink', 'copy')
+    assert os.stat(other).st_ino != os.stat(fname).st_ino
+    assert open(other).read() == 'original data'
+
+
+def test_file_modified_in_place_is_not_fetched(cache, tmpdir):
+    fname = downloaded(tmpdir, 'img.tif')
+    cache.store('SHA1-160/abcd', fname)
+    with open(fname, 'r+') as outfile:
+        outfile.write('modified')
+    # keeping the size, but later on:
+    mtime = os.stat(fname).st_mtime + 10
+    os.utime(fname, (mtime, mtime))
+    target = str(tmpdir.join('copy.tif'))
+    assert cache.fetch('SHA1-160/abcd', target) is None
+    assert not os.path.exists(target)
+    assert not os.path.exists(cache._filename('SHA1-160/abcd'))
+
+
+def test_least_recently_used_files_are_pruned(cache, tmpdir):
+    cache.max_bytes = 15000
+    for name in ('aa00', 'bb00'):
+        cache.store('SHA1-160/' + name,
+                    downloaded(tmpdir, name, 'x' * 10000))
+    cache.fetch('SHA1-160/aa00', str(tmpdir.join('copy.tif')))
+    os.utime(cache._filename('SHA1-160/bb00'), (0, 0))
+    cache.prune()
+    assert os.path.exists(cache._filename('SHA1-160/aa00'))
+    assert not os.path.exists(cache._filename('SHA1-160/bb00'))
+    assert not os.path.exists(cache._filename('SHA1-160/bb00') + '.stamp')
@@ -0,0 +1,136 @@
+"""Tests for the machine-wide limits of transfers (ome_hrm_governor)."""
+
+import fcntl
+import json
+import threading
+import time
+from StringIO import StringIO
+
+import pytest
+
+import ome_hrm_governor
+from ome_hrm_events import EventStream
+from ome_hrm_governor import TransferGovernor, try_lock, is_locked
+
+
+@pytest.fixture
+def governor(tmpdir):
+    return TransferGovernor(str(tmpdir), slots=2, poll=0.01)
+
+
+def test_is_locked(tmpdir):
+    fname = str(tmpdir.join('lock'))
+    assert not is_locked(fname)
+    fdesc = try_lock(fname)
+    assert is_locked(fname)
+    assert try_lock(fname) is None
+    ome_hrm_governor.os.close(fdesc)
+    assert not is_locked(fname)
+
+
+def test_checks_dont_get_in_the_way(tmpdir):
+    governor = TransferGovernor(str(tmpdir), slots=1)
+    fname = governor._slot_file(0)
+    # a check running concurrently, holding its lock for a moment:
+    probe = try_lock(fname, fcntl.LOCK_SH)
+    assert not is_locked(fname)
+    threading.Timer(0.002, ome_hrm_governor.os.close, [probe]).start()
+    locks = governor._try_take('1')
+    assert locks is not None
+    assert governor.active() == 1
+    for fdesc in locks:
+        ome_hrm_governor.os.close(fdesc)
+
+
+def test_waiting_users_are_seen(governor):
+    wait_lock = try_lock(governor._wait_file('2'), fcntl.LOCK_SH)
+    assert governor.usage() == ({}, set(['2']))
+    ome_hrm_governor.os.close(wait_lock)
+    assert governor.usage() == ({}, set())
+
+
+def test_number_of_slots_is_limited(governor):
+    first = governor.acquire('1')
+    second = governor.acquire('2')
+    assert governor.active() == 2
+    assert governor._try_take('3') is None
+    first.release()
+    assert governor.active() == 1
+    third = governor.acquire('3')
+    assert governor.usage() == ({'2': 1, '3': 1}, set())
+    second.release()
+    third.release()
+    assert governor.active() == 0
+
+
+def test_users_with_an_equal_share_yield_to_waiting_users(governor):
+    slot = governor.acquire('1')
+    assert governor._may_take('1')
+    wait_lock = try_lock(governor._wait_file('2'), fcntl.LOCK_SH)
+    assert not governor._may_take('1')
+    assert governor._may_take('2')
+    ome_hrm_governor.os.close(wait_lock)
+    assert governor._may_take('1')
+    slot.release()
+
+
+def test_acquire_waits_for_a_free_slot(tmpdir):
+    governor = TransferGovernor(str(tmpdir), slots=1, poll=0.01)
+    slot = governor.acquire('1')
+    reported = []
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(
+        governor.acquire('2', lambda active, slots: reported.append(
+            (active, slots)))))
+    waiter.start()
+    while not reported:
+        time.sleep(0.01)
+    assert governor.usage() == ({'1': 1}, set(['2']))
+    time.sleep(0.05)
+    slot.release()
+    waiter.join()
+    assert reported == [(1, 1)]
+    assert result[0].waited >= 0.05
+    result[0].release()
+
+
+def test_bandwidth_is_split_between_active_slots(tmpdir, monkeypatch):
+    governor = TransferGovernor(str(tmpdir), slots=2, bandwidth=1000)
+    delays = []
+    monkeypatch.setattr(ome_hrm_governor.time, 'sleep', delays.append)
+    with governor.acquire('1') as first, governor.acquire('2'):
+        first.throttle(0)
+        first.throttle(250)
+    assert len(delays) == 1
+    # 250 bytes at half of the bandwidth take half a second:
+    assert 0.4 < delays[0] <= 0.5
+
+
+def test_resumed_transfer_is_throttled_from_its_offset(tmpdir, monkeypatch):
+    governor = TransferGovernor(str(tmpdir), slots=1, bandwidth=1000)
+    delays = []
+    monkeypatch.setattr(ome_hrm_governor.time, 'sleep', delays.append)
+    with governor.acquire('1') as slot:
+        # continuing a partial file of 100 kB:
+        slot.throttle(100000)
+        slot.throttle(100250)
+    assert len(delays) == 1
+    assert 0.2 < delays[0] <= 0.25
+
+
+def test_waiting_is_reported_as_event(ome_hrm, conn, tmpdir):
+    governor = TransferGovernor(str(tmpdir), slots=1, poll=0.01)
+    slot = governor.acquire('99')
+    outfile = StringIO()
+    item = ome_hrm.new_transfer_item('G:3:Image:7', dest=str(tmpdir))
+    waiter = threading.Thread(target=lambda: ome_hrm.acquire_transfer_slot(
+        governor, conn, item, 'img.tif', EventStream(outfile)).release())
+    waiter.start()
+    while not outfile.getvalue():
+        time.sleep(0.01)
+    slot.release()
+    waiter.join()
+    event = json.loads(outfile.getvalue())
+    assert (event['event'], event['item'], event['file']) == (
+        'waiting', 'G:3:Image:7', 'img.tif')
+    assert (event['active'], event['slots']) == (1, 1)
@@ -0,0 +1,54 @@
+"""Tests for logging into OMERO and reusing the sessions of the connector."""
+
+import os
+
+import pytest
+
+from ome_hrm_sessions import SessionStore
+
+
+@pytest.fixture
+def sessions(ome_hrm):
+    return SessionStore(os.path.join(ome_hrm.CONNECTOR_DIR, 'sessions'),
+                        '%s:%s' % (ome_hrm.HOST, ome_hrm.PORT))
+
+
+def login(ome_hrm, user, passwd, sessions, reuse=True):
+    return ome_hrm.omero_login(user, passwd, ome_hrm.HOST, ome_hrm.PORT,
+                               sessions, reuse)
+
+
+def run(ome_hrm, user, passwd, action='checkCredentials'):
+    args = ome_hrm.parse_arguments(['--user', user, '--password', passwd,
+                                    action])
+    return ome_hrm.connect_and_run(args)
+
+
+def test_remembered_session_is_joined(ome_hrm, fake, user, sessions):
+    conn = login(ome_hrm, user, fake.passwd, sessions)
+    uuid = conn.c.getSessionId()
+    ome_hrm.omero_logout(conn, keep_session=True)
+    fake.reset_calls()
+    conn = login(ome_hrm, user, fake.passwd, sessions)
+    assert conn.c.getSessionId() == uuid
+    assert 'joinSession' in fake.reset_calls()
+
+
+def test_new_login_ends_the_remembered_session(ome_hrm, fake, user,
+                                               sessions):
+    conn = login(ome_hrm, user, fake.passwd, sessions)
+    old_uuid = conn.c.getSessionId()
+    ome_hrm.omero_logout(conn, keep_session=True)
+    conn = login(ome_hrm, user, fake.passwd, sessions, reuse=False)
+    assert conn.c.getSessionId() != old_uuid
+    assert old_uuid not in fake.sessions
+    assert sessions.lookup(user, fake.passwd) == conn.c.getSessionId()
+
+
+def test_failed_login_keeps_the_record_untouched(ome_hrm, fake, user,
+                                                 sessions):
+    assert run(ome_hrm, user, fake.passwd)
+    record = sessions._read(user)
+    assert run(ome_hrm, user, 'wrong') is False
+    assert sessions._read(user) == record
+    assert record['uuid'] in fake.sessions
@@ -0,0 +1,58 @@
+"""Tests for the performance metrics of the connector (ome_hrm_metrics)."""
+
+import json
+import pstats
+import sys
+
+from ome_hrm_metrics import Metrics
+
+
+def read_records(fname):
+    """Get the records of a metrics file."""
+    return [json.loads(line) for line in fname.readlines()]
+
+
+def test_transfers_are_recorded(ome_hrm, fake, conn, tmpdir, monkeypatch):
+    metrics = tmpdir.join('metrics.json')
+    monkeypatch.setattr(ome_hrm.METRICS, 'fname', str(metrics))
+    image = [img for iid, img in sorted(fake.images.items())
+             if img['owner'] == conn.getUser().getId()][0]
+    item = ome_hrm.new_transfer_item(
+        'G:%d:Image:%d' % (image['group'], image['id']),
+        dest=str(tmpdir.mkdir('dest')))
+    assert ome_hrm.omero_to_hrm_batch(conn, [item])
+    records = read_records(metrics)
+    transfers = [rec for rec in records if rec['kind'] == 'transfer']
+    assert [(rec['name'], rec['bytes'], rec['ofile'])
+            for rec in transfers] == [('download', 1000, image['files'][0])]
+    assert transfers[0]['file'].endswith(image['name'])
+    assert 'thumbnails' in [rec['name'] for rec in records
+                            if rec['kind'] == 'phase']
+
+
+def test_request_is_recorded_and_profiled(ome_hrm, fake, user, tmpdir,
+                                          monkeypatch):
+    metrics = tmpdir.join('metrics.json')
+    profile = tmpdir.join('connector.prof')
+    monkeypatch.setattr(ome_hrm.METRICS, 'fname', None)
+    monkeypatch.setattr(ome_hrm.METRICS, 'context', dict())
+    monkeypatch.setattr(sys, 'argv', [
+        'ome_hrm.py', '--user', user, '--password', fake.passwd,
+        '--metrics', str(metrics), '--profile', str(profile),
+        'retrieveChildren', '--id', 'ROOT'])
+    assert ome_hrm.main()
+    records = read_records(metrics)
+    assert records[-1]['kind'] == 'request'
+    assert records[-1]['success'] is True
+    assert set(rec['user'] for rec in records) == set([user])
+    assert 'login' in [rec['name'] for rec in records
+                       if rec['kind'] == 'phase']
+    assert pstats.Stats(str(profile)).total_calls > 0
+
+
+def test_unwritable_metrics_file_is_ignored(tmpdir):
+    metrics = Metrics(str(tmpdir.join('missing', 'metrics.json')))
+    with metrics.phase('login'):
+        pass
+    metrics.transfer('download', 'img.tif', 1000, 0.5)
+    assert not tmpdir.join('missing').exists()
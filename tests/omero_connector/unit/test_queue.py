@@ -0,0 +1,93 @@
+"""Tests for the queue of background transfers (ome_hrm_queue)."""
+
+import pytest
+
+from ome_hrm_queue import TransferQueue, QUEUED, RUNNING, DONE, FAILED
+
+ITEMS = [{'id': 'G:3:Image:7', 'dest': '/data/src'},
+         {'id': 'G:3:Image:8', 'dest': '/data/src'}]
+
+
+@pytest.fixture
+def queue(tmpdir):
+    return TransferQueue(str(tmpdir.join('queue.sqlite')), max_attempts=2,
+                         backoff=0)
+
+
+def test_claim_marks_job_running(queue):
+    job_id = queue.enqueue('alice', 'uuid-1', 'OMEROtoHRM', ITEMS,
+                           {'jobs': 2})
+    job = queue.claim(worker=1)
+    assert job['id'] == job_id
+    assert job['session'] == 'uuid-1'
+    assert job['options'] == {'jobs': 2}
+    assert [item['state'] for item in job['items']] == [RUNNING, RUNNING]
+    # a job can only be claimed once:
+    assert queue.claim(worker=1) is None
+
+
+def test_status_is_restricted_to_the_owner(queue):
+    job_id = queue.enqueue('alice', 'uuid-1', 'OMEROtoHRM', ITEMS)
+    assert queue.status(job_id, 'alice')['state'] == QUEUED
+    assert queue.status(job_id, 'bob') is None
+    assert queue.status(job_id + 1) is None
+
+
+def test_successful_job(queue):
+    job_id = queue.enqueue('alice', 'uuid-1', 'OMEROtoHRM', ITEMS)
+    queue.claim(worker=1)
+    queue.progress(job_id, 0, 50, 100)
+    assert queue.status(job_id)['items'][0]['done'] == 50
+    for idx in range(len(ITEMS)):
+        queue.finish_item(job_id, idx, True, ['ok'])
+    assert queue.finish(job_id) == DONE
+    job = queue.status(job_id)
+    assert [item['success'] for item in job['items']] == [True, True]
+
+
+def test_failed_items_are_retried_up_to_max_attempts(queue):
+    job_id = queue.enqueue('alice', 'uuid-1', 'OMEROtoHRM', ITEMS)
+    job = queue.claim(worker=1)
+    queue.finish_item(job_id, 0, True, [])
+    queue.finish_item(job_id, 1, False, ['ERROR'])
+    assert queue.finish(job_id) == QUEUED
+    # only the failed item is transferred again:
+    job = queue.claim(worker=1)
+    assert [item['index'] for item in job['items']] == [1]
+    queue.finish_item(job_id, 1, False, ['ERROR'])
+    assert queue.finish(job_id) == FAILED
+    assert queue.status(job_id)['items'][1]['messages'] == ['ERROR']
+
+
+def test_failures_retrying_cant_fix_are_given_up(queue):
+    job_id = queue.enqueue('alice', 'uuid-1', 'OMEROtoHRM', ITEMS)
+    queue.claim(worker=1)
+    queue.finish_item(job_id, 0, True, [])
+    queue.finish_item(job_id, 1, False, ['ERROR: existing'], retry=False)
+    assert queue.finish(job_id) == FAILED
+
+
+def test_items_interrupted_in_the_last_attempt_are_given_up(queue):
+    job_id = queue.enqueue('alice', 'uuid-1', 'OMEROtoHRM', ITEMS)
+    queue.claim(worker=1)
+    assert queue.finish(job_id) == QUEUED
+    queue.claim(worker=1)
+    assert queue.finish(job_id) == FAILED
+
+
+def test_jobs_of_dead_workers_are_recovered(queue):
+    job_id = queue.enqueue('alice', 'uuid-1', 'OMEROtoHRM', ITEMS)
+    queue.claim(worker=2 ** 22 + 1)
+    assert queue.status(job_id)['state'] == RUNNING
+    assert queue.claim(worker=1)['id'] == job_id
+
+
+def test_fail_and_purge(queue):
+    job_id = queue.enqueue('alice', 'uuid-1', 'OMEROtoHRM', ITEMS)
+    queue.fail(job_id, 'ERROR: session expired')
+    job = queue.status(job_id)
+    assert job['state'] == FAILED
+    assert job['items'][0]['messages'] == ['ERROR: session expired']
+    assert queue.waiting() == []
+    queue.purge(-1)
+    assert queue.status(job_id) is None
@@ -0,0 +1,89 @@
+"""Tests for the local search index of the OMERO hierarchy (ome_hrm_search)."""
+
+import sqlite3
+
+import pytest
+
+from ome_hrm_search import SearchIndex, search_words
+
+
+@pytest.fixture
+def index(tmpdir):
+    index = SearchIndex(str(tmpdir.join('search.sqlite')))
+    index.update('alice', 'Image', [(7, 3, u'img_00042.tif', u'alice'),
+                                    (8, 3, u'img_00043.tif', u'alice')])
+    index.update('alice', 'Dataset', [(5, 3, u'Images of mouse', u'alice')])
+    index.update('bob', 'Image', [(9, 4, u'img_00042.tif', u'bob')])
+    return index
+
+
+def test_search_words():
+    assert search_words(u'Mouse  img_') == [u'Mouse', u'img']
+    assert search_words(u' - ') == []
+
+
+@pytest.mark.parametrize('trigrams', [True, False])
+def test_parts_of_words_are_found(index, trigrams):
+    index._trigrams = trigrams
+    assert index.search('alice', u'img 42') == [
+        ('Image', 7, 3, u'img_00042.tif', u'alice')]
+    assert index.search('alice', u'0004 IMG') == [
+        ('Image', 7, 3, u'img_00042.tif', u'alice'),
+        ('Image', 8, 3, u'img_00043.tif', u'alice'),
+    ]
+    assert index.search('alice', u'ouse') == [
+        ('Dataset', 5, 3, u'Images of mouse', u'alice')]
+
+
+def test_word_index_of_older_versions_is_replaced(tmpdir):
+    path = str(tmpdir.join('search.sqlite'))
+    index = SearchIndex(path)
+    index.update('alice', 'Image', [(7, 3, u'img_00042.tif', u'alice')])
+    index.close()
+    db = sqlite3.connect(path)
+    db.execute("DROP TABLE trigrams")
+    db.execute("CREATE VIRTUAL TABLE names USING fts5(name)")
+    db.commit()
+    db.close()
+    index = SearchIndex(path)
+    assert index.search('alice', u'00042') == [
+        ('Image', 7, 3, u'img_00042.tif', u'alice')]
+
+
+def test_results_are_ordered_by_class_and_name(index):
+    assert index.search('alice', u'im') == [
+        ('Dataset', 5, 3, u'Images of mouse', u'alice'),
+        ('Image', 7, 3, u'img_00042.tif', u'alice'),
+        ('Image', 8, 3, u'img_00043.tif', u'alice'),
+    ]
+    assert len(index.search('alice', u'im', limit=2)) == 2
+
+
+def test_all_words_have_to_match(index):
+    assert index.search('alice', u'images MOUSE') == [
+        ('Dataset', 5, 3, u'Images of mouse', u'alice')]
+    assert index.search('alice', u'images rat') == []
+
+
+def test_results_are_per_user(index):
+    assert index.search('bob', u'img') == [
+        ('Image', 9, 4, u'img_00042.tif', u'bob')]
+    assert index.search('carol', u'img') == []
+
+
+def test_renamed_and_removed_objects(index):
+    index.update('alice', 'Image', [(7, 3, u'cells.tif', u'alice')],
+                 position=(12, 7))
+    assert index.search('alice', u'cells') == [
+        ('Image', 7, 3, u'cells.tif', u'alice')]
+    assert index.position('alice', 'Image') == (12, 7)
+    assert index.count('alice', 'Image') == 2
+    index.remove('alice', 'Image', [7, 99])
+    assert index.search('alice', u'cells') == []
+    assert index.ids('alice', 'Image') == set([8])
+
+
+def test_last_sync(index):
+    assert index.last_sync('alice') == 0
+    index.set_synced('alice', 1234.5)
+    assert index.last_sync('alice') == 1234.5
@@ -0,0 +1,72 @@
+"""Tests for the session records of the connector (ome_hrm_sessions)."""
+
+import os
+import stat
+
+from ome_hrm_sessions import SessionStore, secure_dir
+
+
+def test_secure_dir_creates_private_directory(tmpdir):
+    path = str(tmpdir.join('private'))
+    assert secure_dir(path)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+
+
+def test_secure_dir_rejects_directory_accessible_by_others(tmpdir):
+    path = str(tmpdir.join('shared'))
+    os.mkdir(path)
+    os.chmod(path, 0o755)
+    assert not secure_dir(path)
+
+
+def test_lookup_requires_matching_password(tmpdir):
+    store = SessionStore(str(tmpdir.join('sessions')), 'omero:4064')
+    store.save('alice', 'secret', 'uuid-1')
+    assert store.lookup('alice', 'secret') == 'uuid-1'
+    assert store.lookup('alice', 'wrong') is None
+    assert store.lookup('bob', 'secret') is None
+
+
+def test_records_are_per_host(tmpdir):
+    path = str(tmpdir.join('sessions'))
+    SessionStore(path, 'omero-a:4064').save('alice', 'secret', 'uuid-1')
+    assert SessionStore(path, 'omero-b:4064').lookup('alice', 'secret') is None
+
+
+def test_expired_record_is_removed(tmpdir):
+    store = SessionStore(str(tmpdir.join('sessions')), 'omero:4064',
+                         max_idle=-1)
+    store.save('alice', 'secret', 'uuid-1')
+    assert store.lookup('alice', 'secret') is None
+    assert not os.listdir(store.path)
+
+
+def test_touch_and_remove(tmpdir):
+    store = SessionStore(str(tmpdir.join('sessions')), 'omero:4064')
+    store.save('alice', 'secret', 'uuid-1')
+    record = store._read('alice')
+    record['last_used'] -= 100
+    store._write('alice', record)
+    store.touch('alice')
+    assert store._read('alice')['last_used'] > record['last_used']
+    store.remove('alice')
+    assert store.lookup('alice', 'secret') is None
+
+
+def test_password_is_not_stored(tmpdir):
+    store = SessionStore(str(tmpdir.join('sessions')), 'omero:4064')
+    store.save('alice', 'secret', 'uuid-1')
+    for fname in os.listdir(store.path):
+        with open(os.path.join(store.path, fname)) as infile:
+            assert 'secret' not in infile.read()
+
+
+def test_unusable_directory_disables_the_store(tmpdir):
+    path = str(tmpdir.join('shared'))
+    os.mkdir(path)
+    os.chmod(path, 0o777)
+    store = SessionStore(path, 'omero:4064')
+    assert not store.usable
+    store.save('alice', 'secret', 'uuid-1')
+    assert store.lookup('alice', 'secret') is None
+    assert not os.listdir(path)
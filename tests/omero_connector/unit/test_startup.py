@@ -0,0 +1,68 @@
+"""Tests for the cold start of the connector (config cache, lazy imports)."""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+import hrm_config
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', '..', '..', 'bin')
+
+
+@pytest.fixture
+def config(tmpdir, monkeypatch):
+    """A config file, its cache being kept in the temporary directory."""
+    monkeypatch.setenv('TMPDIR', str(tmpdir))
+    fname = tmpdir.join('hrm.conf')
+    fname.write('OMERO_PKG="/opt/OMERO"\nOMERO_HOSTNAME="omero.example.org"\n')
+    return fname
+
+
+def count_parsing(monkeypatch):
+    """Count the calls of parse_hrm_conf()."""
+    parsed = []
+    parse_hrm_conf = hrm_config.parse_hrm_conf
+    monkeypatch.setattr(hrm_config, 'parse_hrm_conf',
+                        lambda name: parsed.append(name) or
+                        parse_hrm_conf(name))
+    return parsed
+
+
+def test_parsed_config_is_reused_until_modified(config, monkeypatch):
+    parsed = count_parsing(monkeypatch)
+    first = hrm_config.load_hrm_conf(str(config))
+    assert hrm_config.load_hrm_conf(str(config)) == first
+    assert len(parsed) == 1
+    config.write('OMERO_PORT="4064"\n', mode='a')
+    assert hrm_config.load_hrm_conf(str(config))['OMERO_PORT'] == '4064'
+    assert len(parsed) == 2
+
+
+def test_cache_writable_by_others_is_not_trusted(config, monkeypatch):
+    hrm_config.load_hrm_conf(str(config))
+    os.chmod(hrm_config.cache_filename(str(config)), 0o666)
+    parsed = count_parsing(monkeypatch)
+    hrm_config.load_hrm_conf(str(config))
+    assert len(parsed) == 1
+
+
+def test_omero_is_not_imported_at_startup():
+    env = dict(os.environ, PYTHONPATH=BIN_DIR)
+    output = subprocess.check_output([
+        sys.executable, '-c', 'import sys, ome_hrm; print(sorted(['
+        'name for name in sys.modules if name.split(".")[0] == "omero"]))'],
+                                     env=env)
+    assert output.strip() == '[]'
+
+
+def test_startup_timing_is_reported(ome_hrm, fake, user, capsys):
+    args = ome_hrm.parse_arguments(['--user', user, '--password', fake.passwd,
+                                    '--startup-timing', 'checkCredentials'])
+    assert ome_hrm.connect_and_run(args)
+    phases = [line.split()[2] for line in capsys.readouterr()[1].splitlines()
+              if line.startswith('startup timing:')]
+    assert phases[:2] == ['config', 'imports']
+    assert phases[-3:] == ['login', 'action', 'total']
@@ -0,0 +1,50 @@
+"""Tests for parsing the HRM parameter summary (ome_hrm_summary)."""
+
+import os
+
+import ome_hrm_summary
+from ome_hrm_summary import parse_tables, parameter_summary
+
+import run_benchmark
+
+TABLE = ('<table><tr><td colspan="4">Image Parameters</td></tr>'
+         '<tr><td>Parameter</td><td>Channel</td><td>Source</td>'
+         '<td>Value</td></tr>'
+         '<tr><td>Sample size x (\xce\xbcm)</td><td>0</td><td>template</td>'
+         '<td>0.125</td></tr></table>')
+
+
+def test_characters_spanning_blocks_are_decoded(tmpdir):
+    fname = tmpdir.join('summary.html')
+    fname.write_binary(TABLE)
+    # the block ends in the middle of the two bytes of the "mu":
+    block_size = TABLE.index('\xce') + 1
+    tables = parse_tables(str(fname), block_size)
+    assert tables[0][2][0] == u'Sample size x (\u03bcm)'
+
+
+def test_summary_is_formatted_as_text(tmpdir):
+    fname = str(tmpdir.join('summary.html'))
+    run_benchmark.write_parameter_summary(fname, 2)
+    assert parameter_summary(fname).splitlines()[:4] == [
+        u'Image Parameters',
+        u'==============================',
+        u'Parameter 0 [Ch: 0]: 0.000',
+        u'Sample size x (um) [Ch: 1]: 0.125']
+
+
+def test_summary_is_parsed_again_once_modified(tmpdir, monkeypatch):
+    fname = tmpdir.join('summary.html')
+    fname.write_binary(TABLE)
+    parsed = []
+    monkeypatch.setattr(ome_hrm_summary, 'parse_tables',
+                        lambda name: parsed.append(name) or
+                        parse_tables(name))
+    first = parameter_summary(str(fname))
+    assert parameter_summary(str(fname)) == first
+    assert len(parsed) == 1
+    fname.write_binary(TABLE.replace('0.125', '0.250'))
+    mtime = os.stat(str(fname)).st_mtime + 10
+    os.utime(str(fname), (mtime, mtime))
+    assert u'0.250' in parameter_summary(str(fname))
+    assert len(parsed) == 2
@@ -0,0 +1,65 @@
+"""Tests for fetching and caching the thumbnails (ome_hrm_thumbs)."""
+
+import os
+
+from ome_hrm_thumbs import ThumbnailCache
+
+
+def image_ids(fake, conn):
+    """Get the IDs of the images of the user in the default group."""
+    uid = conn.getUser().getId()
+    gid = min(fake.groups)
+    return sorted([iid for iid, img in fake.images.items()
+                   if img['owner'] == uid and img['group'] == gid])
+
+
+def previews(ome_hrm, conn, ids, dest):
+    """Write the previews of some images, return the messages."""
+    messages = []
+    thumbs = [(iid, str(dest.join('img%d.tif' % iid)), messages)
+              for iid in ids]
+    assert ome_hrm.download_thumbs(conn, thumbs)
+    return messages
+
+
+def test_thumbnails_are_fetched_at_once_and_cached(ome_hrm, fake, conn,
+                                                   tmpdir, monkeypatch):
+    monkeypatch.setattr(ome_hrm, 'THUMBNAIL_CACHE_SIZE', 1024 * 1024)
+    dest = tmpdir.mkdir('dest')
+    dest.mkdir('hrm_previews')
+    ids = image_ids(fake, conn)
+    fake.reset_calls()
+    previews(ome_hrm, conn, ids, dest)
+    calls = fake.reset_calls()
+    assert calls['getThumbnailSet'] == 1
+    assert 'getObject' not in calls and 'getThumbnail' not in calls
+    for iid in ids:
+        # the JPEG data of OMERO is written as it is:
+        preview = dest.join('hrm_previews', 'img%d.tif.preview_xy.jpg' % iid)
+        assert preview.read_binary().startswith(
+            '\xff\xd8\xff\xe0fake-thumbnail-%d-' % iid)
+    # the same previews again, e.g. for another destination:
+    other = tmpdir.mkdir('other')
+    other.mkdir('hrm_previews')
+    previews(ome_hrm, conn, ids, other)
+    assert 'getThumbnailSet' not in fake.reset_calls()
+    assert len(other.join('hrm_previews').listdir()) == len(ids)
+
+
+def test_least_recently_used_thumbnails_are_pruned(tmpdir):
+    cache = ThumbnailCache(str(tmpdir), max_bytes=150)
+    cache.put(1, '\xff\xd8' + 'a' * 98)
+    os.utime(str(tmpdir.join('1_64.jpg')), (0, 0))
+    cache.put(2, '\xff\xd8' + 'b' * 98)
+    assert cache.get(1) is None
+    assert cache.get(2) == '\xff\xd8' + 'b' * 98
+
+
+def test_preview_is_not_linked_to_the_cache(tmpdir):
+    cache = ThumbnailCache(str(tmpdir.mkdir('cache')))
+    cache.put(1, '\xff\xd8jpeg')
+    target = tmpdir.join('preview.jpg')
+    assert cache.place(1, str(target))
+    assert target.read_binary() == '\xff\xd8jpeg'
+    assert os.stat(str(target)).st_ino != os.stat(
+        cache._filename(1, 64)).st_ino
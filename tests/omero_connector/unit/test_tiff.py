@@ -0,0 +1,126 @@
+"""Tests for the streaming OME-TIFF writer (ome_hrm_tiff)."""
+
+import struct
+from StringIO import StringIO
+
+import pytest
+
+from ome_hrm_tiff import write_ome_tiff, TiffError
+
+META = {'sizeX': 3, 'sizeY': 5, 'sizeZ': 2, 'sizeC': 1, 'sizeT': 1,
+        'type': 'uint16', 'name': 'img & co.tif', 'physicalSizeX': 0.5}
+
+FIELD_FORMATS = {2: 's', 3: 'H', 4: 'I', 16: 'Q'}
+
+
+def read_tiff(data):
+    """Parse the IFDs of a big-endian (Big)TIFF file.
+
+    Returns
+    =======
+    list(dict) - the values of the tags of every IFD (lists of numbers, or a
+    string for ASCII tags)
+    """
+    order, magic = struct.unpack('>2sH', data[:4])
+    assert order == 'MM'
+    if magic == 43:
+        offset = struct.unpack('>Q', data[8:16])[0]
+        count_fmt, entry_fmt, off_fmt = '>Q', '>HHQ8s', '>Q'
+    else:
+        assert magic == 42
+        offset = struct.unpack('>I', data[4:8])[0]
+        count_fmt, entry_fmt, off_fmt = '>H', '>HHI4s', '>I'
+    ifds = []
+    while offset:
+        entries = struct.unpack_from(count_fmt, data, offset)[0]
+        pos = offset + struct.calcsize(count_fmt)
+        tags = dict()
+        for _ in range(entries):
+            tag, ftype, count, raw = struct.unpack_from(entry_fmt, data, pos)
+            pos += struct.calcsize(entry_fmt)
+            fmt = FIELD_FORMATS[ftype]
+            size = count * struct.calcsize('>' + fmt)
+            if size > len(raw):
+                ptr = struct.unpack(off_fmt, raw)[0]
+                raw = data[ptr:ptr + size]
+            if fmt == 's':
+                tags[tag] = raw[:count]
+            else:
+                tags[tag] = list(struct.unpack('>%d%s' % (count, fmt),
+                                               raw[:size]))
+        offset = struct.unpack_from(off_fmt, data, pos)[0]
+        ifds.append(tags)
+    return ifds
+
+
+def gen_planes(meta):
+    """Generate the big-endian pixel data of all planes of an image."""
+    planes = meta['sizeZ'] * meta['sizeC'] * meta['sizeT']
+    pixels = meta['sizeX'] * meta['sizeY']
+    return [struct.pack('>%dH' % pixels,
+                        *range(plane * 1000, plane * 1000 + pixels))
+            for plane in range(planes)]
+
+
+def strips_of(planes, row_bytes):
+    """Get the strips() callable of write_ome_tiff() for some planes."""
+    def strips(rows):
+        for plane in planes:
+            for start in range(0, len(plane), rows * row_bytes):
+                yield plane[start:start + rows * row_bytes]
+    return strips
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+def test_written_file_can_be_read(bigtiff):
+    planes = gen_planes(META)
+    outfile = StringIO()
+    progress = []
+    # 2 rows of 3 pixels per strip:
+    size = write_ome_tiff(outfile, META, strips_of(planes, 6), buffer_size=13,
+                          progress=lambda done, total: progress.append(done),
+                          bigtiff=bigtiff)
+    data = outfile.getvalue()
+    assert size == len(data) == progress[-1]
+    # the header and 3 strips per plane:
+    assert len(progress) == 1 + 2 * 3
+    ifds = read_tiff(data)
+    assert struct.unpack('>H', data[2:4])[0] == (43 if bigtiff else 42)
+    assert len(ifds) == 2
+    desc = ifds[0][270]
+    assert desc.startswith('<?xml') and desc.endswith('\0')
+    assert 'Name="img &amp; co.tif"' in desc
+    assert 'PhysicalSizeX="0.5"' in desc
+    assert 'SizeZ="2"' in desc
+    assert 270 not in ifds[1]
+    for tags, plane in zip(ifds, planes):
+        assert tags[256] == [3] and tags[257] == [5]
+        assert tags[258] == [16] and tags[339] == [1]
+        assert tags[278] == [2]
+        assert tags[279] == [12, 12, 6]
+        assert ''.join([data[offset:offset + count] for offset, count in
+                        zip(tags[273], tags[279])]) == plane
+
+
+def test_single_strip_per_plane():
+    planes = gen_planes(META)
+    outfile = StringIO()
+    write_ome_tiff(outfile, META, strips_of(planes, 6))
+    data = outfile.getvalue()
+    for tags, plane in zip(read_tiff(data), planes):
+        assert tags[279] == [len(plane)]
+        assert data[tags[273][0]:tags[273][0] + len(plane)] == plane
+
+
+def test_unexpected_amount_of_data_is_rejected():
+    planes = gen_planes(META)
+    with pytest.raises(TiffError):
+        write_ome_tiff(StringIO(), META, strips_of(planes[:1], 6))
+    with pytest.raises(TiffError):
+        write_ome_tiff(StringIO(), META, strips_of([planes[0][:-2]], 6))
+
+
+def test_unsupported_pixel_type():
+    meta = dict(META, type='bit')
+    with pytest.raises(TiffError):
+        write_ome_tiff(StringIO(), meta, strips_of([], 6))
@@ -0,0 +1,136 @@
+"""Tests for the tree of OMERO objects and the group context of the queries."""
+
+import os
+import json
+
+from ome_hrm_cache import TreeCache
+
+
+def owned(fake, table, user_id, gid):
+    """Get the IDs of the objects of a user in a group."""
+    return sorted([oid for oid, obj in table.items()
+                   if obj['owner'] == user_id and obj['group'] == gid])
+
+
+def test_base_tree_lists_all_groups_with_the_user_first(ome_hrm, fake, conn):
+    uid = conn.getUser().getId()
+    tree = ome_hrm.gen_base_tree(conn)
+    assert [group['id'] for group in tree] == [
+        'ExperimenterGroup:%d' % gid for gid in sorted(fake.groups)]
+    for group, gid in zip(tree, sorted(fake.groups)):
+        assert [member['id'] for member in group['children']] == [
+            'G:%d:Experimenter:%d' % (gid, member) for member in
+            [uid] + [other for other in sorted(fake.users) if other != uid]]
+
+
+def test_members_of_private_groups_are_listed_for_leaders_only(ome_hrm,
+                                                               fake, conn):
+    uid = conn.getUser().getId()
+    private, led = sorted(fake.groups)
+    fake.groups[private]['permissions'] = 'rw----'
+    fake.groups[led]['permissions'] = 'rw----'
+    fake.groups[led]['leaders'].append(uid)
+    fake.reset_calls()
+    tree = ome_hrm.gen_base_tree(conn)
+    # by the single query, not by asking each group:
+    assert 'listColleagues' not in fake.reset_calls()
+    assert [len(group['children']) for group in tree] == [1, len(fake.users)]
+    # the same as asking each group for its members:
+    assert tree == [ome_hrm.gen_group_tree(conn, group)
+                    for group in conn.getGroupsMemberOf()]
+
+
+def test_children_are_restricted_to_the_group(ome_hrm, fake, conn):
+    uid = conn.getUser().getId()
+    for gid in fake.groups:
+        children = ome_hrm.gen_children(
+            conn, 'G:%d:Experimenter:%d' % (gid, uid))
+        assert [child['id'] for child in children] == [
+            'G:%d:Project:%d' % (gid, pid)
+            for pid in owned(fake, fake.projects, uid, gid)]
+
+
+def test_objects_of_other_groups_are_not_found(ome_hrm, fake, conn):
+    uid = conn.getUser().getId()
+    first, second = sorted(fake.groups)
+    pid = owned(fake, fake.projects, uid, second)[0]
+    assert ome_hrm.gen_children(conn, 'G:%d:Project:%d' % (second, pid))
+    assert ome_hrm.gen_children(conn, 'G:%d:Project:%d' % (first, pid)) == []
+
+
+def test_container_of_another_group_is_downloaded(ome_hrm, fake, conn,
+                                                  tmpdir):
+    uid = conn.getUser().getId()
+    gid = sorted(fake.groups)[1]
+    did = owned(fake, fake.datasets, uid, gid)[0]
+    item = ome_hrm.new_transfer_item('G:%d:Dataset:%d' % (gid, did),
+                                     dest=str(tmpdir))
+    tmpdir.mkdir('hrm_previews')
+    assert ome_hrm.omero_to_hrm_batch(conn, [item])
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'hrm_previews', 'img_00000.tif', 'img_00001.tif']
+    assert sorted(os.listdir(str(tmpdir.join('hrm_previews')))) == [
+        'img_00000.tif.preview_xy.jpg', 'img_00001.tif.preview_xy.jpg']
+
+
+def test_fileset_of_a_project_is_downloaded_once(ome_hrm, fake, conn,
+                                                 tmpdir):
+    uid = conn.getUser().getId()
+    gid = min(fake.groups)
+    pid = owned(fake, fake.projects, uid, gid)[0]
+    did = [dset for dset in owned(fake, fake.datasets, uid, gid)
+           if fake.datasets[dset]['project'] == pid][0]
+    fake.add_series_images(did, 'exp.lif', ['s1', 's2', 's3'], size=500)
+    item = ome_hrm.new_transfer_item('G:%d:Project:%d' % (gid, pid),
+                                     dest=str(tmpdir))
+    tmpdir.mkdir('hrm_previews')
+    fake.reset_calls()
+    assert ome_hrm.omero_to_hrm_batch(conn, [item])
+    # the two images of their own and the fileset shared by the series:
+    assert fake.reset_calls()['setFileId'] == 3
+    assert sorted(os.listdir(str(tmpdir))) == [
+        'exp.lif', 'hrm_previews', 'img_00000.tif', 'img_00001.tif']
+    assert sorted(os.listdir(str(tmpdir.join('hrm_previews')))) == [
+        'exp.lif (%s).preview_xy.jpg' % label for label in ('s1', 's2', 's3')
+    ] + ['img_00000.tif.preview_xy.jpg', 'img_00001.tif.preview_xy.jpg']
+
+
+def test_refresh_bypasses_the_cache(ome_hrm, fake, conn, user, tmpdir,
+                                    capsys):
+    cache = TreeCache(str(tmpdir.join('tree.sqlite')))
+    uid = conn.getUser().getId()
+    gid = min(fake.groups)
+    id_str = 'G:%d:Experimenter:%d' % (gid, uid)
+    stale = [{'id': 'G:%d:Project:0' % gid, 'label': 'deleted meanwhile'}]
+    cache.put(user, id_str, stale)
+    assert ome_hrm.print_children_json(conn, id_str, cache, user)
+    assert json.loads(capsys.readouterr()[0]) == stale
+    assert ome_hrm.print_children_json(conn, id_str, cache, user,
+                                       refresh=True)
+    fresh = json.loads(capsys.readouterr()[0])
+    assert [node['id'] for node in fresh] == [
+        'G:%d:Project:%d' % (gid, pid)
+        for pid in owned(fake, fake.projects, uid, gid)]
+    assert cache.get(user, id_str) == fresh
+
+
+def test_failure_leaves_no_partial_json(ome_hrm, conn, monkeypatch, capsys):
+    def iter_children(conn, id_str, limit=None):
+        yield {'id': 'G:3:Project:4', 'label': 'proj_0'}
+        raise RuntimeError('connection lost')
+    monkeypatch.setattr(ome_hrm, 'iter_children', iter_children)
+    assert not ome_hrm.print_children_json(conn, 'G:3:Experimenter:1')
+    assert capsys.readouterr()[0] == 'ERROR generating OMERO tree / node!\n'
+
+
+def test_groups_of_root_are_paged(ome_hrm, fake, conn, user, capsys):
+    first, second = ['ExperimenterGroup:%d' % gid
+                     for gid in sorted(fake.groups)]
+    nodes = ome_hrm.gen_children(conn, 'ROOT', limit=1)
+    assert [node['id'] for node in nodes] == [first, 'ROOT:1']
+    args = ome_hrm.parse_arguments([
+        '--user', user, '--password', fake.passwd, 'retrieveChildren',
+        '--id', 'ROOT', '--offset', '1', '--limit', '1'])
+    assert ome_hrm.run_action(conn, args)
+    nodes = json.loads(capsys.readouterr()[0])
+    assert [node['id'] for node in nodes] == [second]
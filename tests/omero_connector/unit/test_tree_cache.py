@@ -0,0 +1,57 @@
+"""Tests for the shared cache of the tree nodes (ome_hrm_cache)."""
+
+import time
+
+from ome_hrm_cache import TreeCache
+
+NODES = [{'id': 'G:3:Image:7', 'label': 'img.tif', 'children': []}]
+
+
+def test_entries_are_per_user(tmpdir):
+    cache = TreeCache(str(tmpdir.join('tree.sqlite')))
+    cache.put('alice', 'G:3:Dataset:5', NODES)
+    assert cache.get('alice', 'G:3:Dataset:5') == NODES
+    assert cache.get('bob', 'G:3:Dataset:5') is None
+
+
+def test_entries_are_shared_between_processes(tmpdir):
+    fname = str(tmpdir.join('tree.sqlite'))
+    TreeCache(fname).put('alice', 'G:3:Dataset:5', NODES)
+    assert TreeCache(fname).get('alice', 'G:3:Dataset:5') == NODES
+
+
+def test_entries_expire(tmpdir, monkeypatch):
+    cache = TreeCache(str(tmpdir.join('tree.sqlite')), ttl=60)
+    cache.put('alice', 'G:3:Dataset:5', NODES)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert cache.get('alice', 'G:3:Dataset:5') is None
+
+
+def test_invalidate_removes_all_pages_for_all_users(tmpdir):
+    cache = TreeCache(str(tmpdir.join('tree.sqlite')))
+    for user in ('alice', 'bob'):
+        cache.put(user, 'G:3:Dataset:5', NODES)
+        cache.put(user, 'G:3:Dataset:5:1000', NODES)
+    cache.put('alice', 'G:3:Dataset:51', NODES)
+    cache.invalidate('G:3:Dataset:5')
+    for user in ('alice', 'bob'):
+        assert cache.get(user, 'G:3:Dataset:5') is None
+        assert cache.get(user, 'G:3:Dataset:5:1000') is None
+    assert cache.get('alice', 'G:3:Dataset:51') == NODES
+
+
+def test_least_recently_used_entries_are_evicted(tmpdir, monkeypatch):
+    cache = TreeCache(str(tmpdir.join('tree.sqlite')), max_entries=2)
+    clock = [time.time()]
+    monkeypatch.setattr(time, 'time', lambda: clock[0])
+    for node in ('A', 'B'):
+        clock[0] += 1
+        cache.put('alice', node, NODES)
+    clock[0] += 1
+    cache.get('alice', 'A')
+    clock[0] += 1
+    cache.put('alice', 'C', NODES)
+    assert cache.get('alice', 'A') == NODES
+    assert cache.get('alice', 'B') is None
+    assert cache.get('alice', 'C') == NODES
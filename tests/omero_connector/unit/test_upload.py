@@ -0,0 +1,155 @@
+"""Tests for uploading images from the HRM to OMERO."""
+
+from StringIO import StringIO
+import json
+
+import pytest
+
+import fake_omero
+from ome_hrm_events import EventStream
+
+import run_benchmark
+
+
+@pytest.fixture
+def dataset(fake, conn):
+    """The ID string of the first dataset of the user."""
+    did = fake.find_dataset(conn.getUser().getId())
+    return 'G:%d:Dataset:%d' % (fake.datasets[did]['group'], did)
+
+
+def copy_of(fake, tmpdir, iid, name):
+    """Write a file having the content of the original file of an image."""
+    fname = tmpdir.join(name)
+    fname.write(fake.ofiles[fake.images[iid]['files'][0]]['data'])
+    return str(fname)
+
+
+def upload(ome_hrm, conn, items, dedup, scope='dataset'):
+    """Upload some items, return the success and the events reported."""
+    outfile = StringIO()
+    success = ome_hrm.hrm_to_omero_batch(conn, items, dedup=dedup,
+                                         scope=scope,
+                                         events=EventStream(outfile))
+    events = [json.loads(line) for line in outfile.getvalue().splitlines()]
+    return success, [(event['event'], event.get('method')) for event in events]
+
+
+def test_batch_is_imported_with_its_parameter_summaries(ome_hrm, fake, conn,
+                                                        dataset, tmpdir):
+    items = []
+    for num in range(3):
+        basename = 'result%d_0123456789ab%d_hrm' % (num, num)
+        run_benchmark.write_parameter_summary(
+            str(tmpdir.join(basename + '.parameters.txt')), 2)
+        fname = tmpdir.join(basename + '.ics')
+        fname.write('deconvolved %d' % num)
+        items.append(ome_hrm.new_transfer_item(dataset, file=str(fname)))
+    items.append(ome_hrm.new_transfer_item(
+        dataset, file=str(tmpdir.join('result.h5'))))
+    fake.reset_calls()
+    assert not ome_hrm.hrm_to_omero_batch(conn, items, jobs=2, dedup='off')
+    assert [item['success'] for item in items] == [True, True, True, False]
+    # the plugins are loaded once per parallel import, not once per file:
+    calls = fake.reset_calls()
+    assert calls['import'] == 3 and calls['loadplugins'] <= 2
+    did = int(dataset.split(':')[3])
+    imported = [image for image in fake.list_children('Dataset', did)
+                if image['name'].startswith('result')]
+    assert len(imported) == 3
+    for image in imported:
+        assert image['annotation'].startswith('Image Parameters\n')
+
+
+@pytest.fixture
+def inplace(ome_hrm, tmpdir, monkeypatch):
+    """Enable in-place imports into a repository next to the results."""
+    monkeypatch.setattr(ome_hrm, 'IMPORT_TRANSFER', 'ln_s')
+    monkeypatch.setattr(ome_hrm, 'MANAGED_REPO', str(tmpdir.mkdir('repo')))
+
+
+def import_one(ome_hrm, fake, conn, dataset, tmpdir):
+    """Import a single file, return the item and the new image."""
+    fname = tmpdir.join('result_0123456789abc_hrm.ics')
+    fname.write('deconvolved')
+    item = ome_hrm.new_transfer_item(dataset, file=str(fname))
+    success = ome_hrm.hrm_to_omero_batch(conn, [item], dedup='off')
+    assert success == item['success']
+    did = int(dataset.split(':')[3])
+    images = [image for image in fake.list_children('Dataset', did)
+              if image['name'] == fname.basename]
+    return item, images
+
+
+def test_results_on_shared_storage_are_imported_in_place(
+        ome_hrm, fake, conn, dataset, tmpdir, inplace):
+    item, images = import_one(ome_hrm, fake, conn, dataset, tmpdir)
+    assert item['success']
+    assert [image.get('transfer') for image in images] == ['ln_s']
+
+
+def test_results_on_other_storage_are_uploaded(ome_hrm, fake, conn, dataset,
+                                               tmpdir, inplace, monkeypatch):
+    monkeypatch.setattr(ome_hrm, 'MANAGED_REPO', '/proc')
+    item, images = import_one(ome_hrm, fake, conn, dataset, tmpdir)
+    assert item['success']
+    assert [image.get('transfer') for image in images] == [None]
+
+
+def test_failed_in_place_import_falls_back_to_an_upload(
+        ome_hrm, fake, conn, dataset, tmpdir, inplace, monkeypatch):
+    invoke = fake_omero.CLI.invoke
+
+    def invoke_without_links(cli, args, strict=False):
+        if '--transfer' in args:
+            raise RuntimeError('repository not writable')
+        return invoke(cli, args, strict)
+    monkeypatch.setattr(fake_omero.CLI, 'invoke', invoke_without_links)
+    item, images = import_one(ome_hrm, fake, conn, dataset, tmpdir)
+    assert item['success']
+    assert 'In-place import failed' in item['messages'][0]
+    assert [image.get('transfer') for image in images] == [None]
+
+
+def test_duplicates_are_imported_by_default(ome_hrm, fake, conn, dataset,
+                                            tmpdir, user):
+    args = ome_hrm.parse_arguments(['--user', user, '--password', 'secret',
+                                    'HRMtoOMERO', '--dset', dataset,
+                                    '--file', 'img.tif'])
+    assert args.dedup == 'off'
+    iid = fake.children[('Dataset', int(dataset.split(':')[3]))][0]
+    item = ome_hrm.new_transfer_item(
+        dataset, file=copy_of(fake, tmpdir, iid, 'copy.tif'))
+    assert upload(ome_hrm, conn, [item], args.dedup) == (True, [
+        ('started', None), ('progress', None), ('file', 'import'),
+        ('finished', None)])
+    assert 'skipped' not in item
+
+
+def test_skipped_files_are_reported(ome_hrm, fake, conn, dataset, tmpdir):
+    iid = fake.children[('Dataset', int(dataset.split(':')[3]))][0]
+    item = ome_hrm.new_transfer_item(
+        dataset, file=copy_of(fake, tmpdir, iid, 'copy.tif'))
+    assert upload(ome_hrm, conn, [item], 'skip') == (True, [
+        ('started', None), ('file', 'skip'), ('finished', None)])
+    assert item['skipped']
+    assert item['existing'] == 'G:%s:Image:%d' % (dataset.split(':')[1], iid)
+
+
+def test_failed_links_are_reported(ome_hrm, fake, conn, dataset, tmpdir,
+                                   monkeypatch):
+    gid = int(dataset.split(':')[1])
+    # an image of another user in the same group:
+    iid = [img['id'] for img in fake.images.values()
+           if img['group'] == gid and
+           img['owner'] != conn.getUser().getId()][0]
+    item = ome_hrm.new_transfer_item(
+        dataset, file=copy_of(fake, tmpdir, iid, 'copy.tif'))
+
+    def link_image(conn, gid, dset_id, image_id):
+        raise RuntimeError('permission denied')
+    monkeypatch.setattr(ome_hrm, 'link_image', link_image)
+    assert upload(ome_hrm, conn, [item], 'link', 'group') == (False, [
+        ('started', None), ('failed', None), ('finished', None)])
+    assert item['messages'] == [
+        'ERROR: linking existing Image:%d to %s failed!' % (iid, dataset)]
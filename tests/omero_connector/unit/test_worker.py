@@ -0,0 +1,60 @@
+"""Tests for running queued transfers (ome_hrm_worker)."""
+
+import pytest
+
+import ome_hrm_worker
+from ome_hrm_queue import QUEUED, FAILED
+
+
+@pytest.fixture
+def queue(ome_hrm):
+    return ome_hrm.open_transfer_queue()
+
+
+def enqueue(ome_hrm, fake, conn, user, queue, dest):
+    """Queue the download of the first image of the user, claim the job."""
+    image = [img for iid, img in sorted(fake.images.items())
+             if img['owner'] == conn.getUser().getId()][0]
+    session = ome_hrm.omero_login(user, fake.passwd, 'localhost', 4064)
+    uuid = session.c.getSessionId()
+    ome_hrm.omero_logout(session, keep_session=True)
+    items = [ome_hrm.new_transfer_item(
+        'G:%d:Image:%d' % (image['group'], image['id']), dest=dest)]
+    queue.enqueue(user, uuid, 'OMEROtoHRM', items, {'jobs': 1})
+    return queue.claim(), image['name']
+
+
+def test_job_is_finished_if_preparing_it_fails(ome_hrm, fake, conn, user,
+                                               queue, tmpdir, monkeypatch):
+    job, _ = enqueue(ome_hrm, fake, conn, user, queue, str(tmpdir))
+
+    def new_transfer_item(id_str, **details):
+        raise RuntimeError('broken item')
+    monkeypatch.setattr(ome_hrm, 'new_transfer_item', new_transfer_item)
+    with pytest.raises(RuntimeError):
+        ome_hrm_worker.run_job(queue, job)
+    assert queue.status(job['id'])['state'] == QUEUED
+
+
+def test_existing_target_is_not_retried(ome_hrm, fake, conn, user, queue,
+                                        tmpdir):
+    job, name = enqueue(ome_hrm, fake, conn, user, queue, str(tmpdir))
+    tmpdir.join(name).write('somebody else')
+    assert ome_hrm_worker.run_job(queue, job) == FAILED
+    status = queue.status(job['id'])
+    assert status['attempts'] == 1
+    assert 'already existing' in status['items'][0]['messages'][0]
+
+
+def test_transfer_status_needs_valid_credentials(ome_hrm, fake, conn, user,
+                                                queue, tmpdir, capsys):
+    job, _ = enqueue(ome_hrm, fake, conn, user, queue, str(tmpdir))
+    argv = ['transferStatus', '--job', str(job['id'])]
+    args = ome_hrm.parse_arguments(['--user', user, '--password', 'wrong'] +
+                                   argv)
+    assert not ome_hrm.connect_and_run(args)
+    assert '"state"' not in capsys.readouterr()[0]
+    args = ome_hrm.parse_arguments(['--user', user, '--password',
+                                    fake.passwd] + argv)
+    assert ome_hrm.connect_and_run(args)
+    assert '"state": "running"' in capsys.readouterr()[0]